@@ -3,11 +3,10 @@ import os
 from collections import Counter
 import re
 from typing import Optional, List
-import json
 
 # Third-party library imports
+import numpy as np
 from llama_index.core import Document, VectorStoreIndex, Settings, StorageContext, load_index_from_storage
-from llama_index.core.node_parser import SimpleNodeParser
 from llama_index.core.schema import MetadataMode, RelatedNodeInfo, NodeRelationship, NodeWithScore, QueryBundle, Node
 from llama_index.core.indices import SummaryIndex
 from llama_index.core.response.notebook_utils import display_response
@@ -19,6 +18,14 @@ from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
 # Custom imports
 import utils
+import prompt_cache
+import models
+import devices
+import memory_budget
+from hybrid_retrieval import HybridIndex
+from portfolio_store import PortfolioStore, PortfolioIndex
+from patent_data import PatentData
+from patent_chunking import PatentNodeParser, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP, nodes_from_chunks
 
 def extract_keywords_from_template(template: str) -> List[str]:
     """
@@ -45,6 +52,143 @@ def extract_keywords_from_template(template: str) -> List[str]:
     
     return list(word_counts.keys())
 
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text with the global llama-index tokenizer.
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        int: Number of tokens.
+    """
+    return len(Settings.tokenizer(text))
+
+def _shingles(text: str, size: int = 8) -> set:
+    """
+    Get the word shingles of a text, used to detect overlapping chunks.
+
+    Args:
+        text (str): Input text.
+        size (int): Number of words per shingle.
+
+    Returns:
+        set: Set of word tuples.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def similarity_score(node: NodeWithScore) -> float:
+    """
+    Get the similarity of a retrieved node to the query, comparable across sections.
+
+    Dense and portfolio retrievers score by cosine similarity. Hybrid
+    retrievers fuse it with a BM25 score normalized per section, so their
+    dense similarity is used instead.
+
+    Args:
+        node (NodeWithScore): Retrieved node.
+
+    Returns:
+        float: Cosine similarity to the query.
+    """
+    dense_score = getattr(node, 'dense_score', None)
+    if dense_score is not None:
+        return dense_score
+    return node.score or 0.0
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut a text on a word boundary so it fits in a number of tokens.
+
+    Args:
+        text (str): Input text.
+        max_tokens (int): Maximum number of tokens.
+
+    Returns:
+        str: Longest prefix of whole words within max_tokens, the text itself if it fits.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Binary search the number of words kept
+    ends = [match.end() for match in re.finditer(r'\S+', text)]
+    low, high = 0, len(ends)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:ends[middle - 1]]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:ends[low - 1]] if low else ''
+
+def fit_dependent_claims(dependent_claims: List[str], available_tokens: int) -> List[str]:
+    """
+    Keep the first dependent claims that fit in a number of tokens, they refine the claim most directly.
+
+    Args:
+        dependent_claims (List[str]): Texts of the dependent claims, in claim order.
+        available_tokens (int): Tokens left for the dependent claims, one per line.
+
+    Returns:
+        List[str]: Dependent claims kept.
+    """
+    kept_claims, used_tokens = [], 0
+    for dependent_claim in dependent_claims:
+        used_tokens += count_tokens(dependent_claim + "\n")
+        if used_tokens > available_tokens:
+            break
+        kept_claims.append(dependent_claim)
+    if len(kept_claims) < len(dependent_claims):
+        print(f'Context budget: {len(dependent_claims) - len(kept_claims)} of {len(dependent_claims)} dependent claims dropped')
+    return kept_claims
+
+def select_context_nodes(section_nodes: dict, token_budget: Optional[int] = None, max_overlap: float = 0.5) -> dict:
+    """
+    Select the section chunks to include in the context within a token budget.
+
+    The chunks of every section are ranked together by their similarity to
+    the query (see similarity_score), which is on the same scale whichever
+    retriever searched the section. Chunks overlapping an already selected
+    chunk are dropped and the remaining ones are added greedily while they
+    fit in the budget.
+
+    Args:
+        section_nodes (dict): Retrieved nodes keyed by section name.
+        token_budget (int, optional): Maximum number of tokens of the selected chunks. No limit if None.
+        max_overlap (float): Maximum fraction of shared shingles with a selected chunk.
+
+    Returns:
+        dict: Selected nodes keyed by section name, in ranking order.
+    """
+    candidates = [
+        (similarity_score(node), node, section)
+        for section, nodes in section_nodes.items()
+        for node in nodes
+    ]
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    selected = {section: [] for section in section_nodes}
+    selected_shingles = []
+    used_tokens = 0
+    for _, node, section in candidates:
+        text = node.node.get_content()
+        shingles = _shingles(text)
+        if any(len(shingles & other) > max_overlap * len(shingles) for other in selected_shingles):
+            continue
+
+        tokens = count_tokens(text)
+        if token_budget is not None and used_tokens + tokens > token_budget:
+            continue
+
+        selected[section].append(node)
+        selected_shingles.append(shingles)
+        used_tokens += tokens
+
+    print(f'Context chunks: {sum(len(nodes) for nodes in selected.values())}/{len(candidates)} ({used_tokens} tokens)')
+    return selected
+
 class HierarchicalQueryEngine:
     """
     Main engine of the RAG pipeline for patent analysis.
@@ -61,49 +205,102 @@ class HierarchicalQueryEngine:
         self.claim_index = claim_index
         self.patent_information_indices = kwargs
 
-    def query(self, prompt_template: str, claim_k: int = 2, additional_k: int = 2, print_prompt: bool = False) -> str:
+    def query(self, prompt_template: str, dependent_claims: Optional[List[str]] = None, claim_k: int = 2, additional_k: int = 2, print_prompt: bool = False, on_partial=None, token_budget: Optional[int] = None) -> tuple:
         """
         Execute the hierarchical query process.
 
+        The retrieved patent context is sent as a cached prompt prefix and the
+        prompt template, without the context, as the stage instructions. The
+        claim chunks and dependent claims get the token budget first, truncated
+        to it (the last dependent claims are dropped first), and the section
+        chunks fill the remaining budget by similarity score.
+
+        The context has two cached parts: the section chunks, then the claims.
+        The section chunks are retrieved with the claim, so another claim only
+        reads the first part from the cache when it selects the same chunks.
+
         Args:
             prompt_template (str): Template for the prompt.
+            dependent_claims (List[str], optional): Texts of the dependent claims.
             claim_k (int): Number of top claims to retrieve.
             additional_k (int): Number of additional information chunks to retrieve.
             print_prompt (bool): Whether to print the generated prompt.
+            on_partial (callable, optional): Called with the partial summary text while streaming.
+            token_budget (int, optional): Maximum number of tokens of the context. No limit if None.
 
         Returns:
-            str: Generated summary based on the query.
+            tuple: Parsed JSON response and the input prompt as a dict with 'context' (the section and
+                claim parts of the cached prefix) and 'instructions'.
         """
+        dependent_claims = dependent_claims or []
+        dependent_claims_block = "\n".join(dependent_claims)
+
         # Extract relevant keywords from the initial claim prompt
-        keywords = " ".join(extract_keywords_from_template(prompt_template))
+        keywords = " ".join(extract_keywords_from_template(prompt_template + " " + " ".join(dependent_claims)))
 
         claim_nodes = self.claim_index.as_retriever(similarity_top_k=claim_k).retrieve(keywords)
 
         combined_response = "Claims Information:\n"
         combined_response += self._format_response(claim_nodes, "")
-        
-        # Add extra instructions to the prompts if additional indices were used
+        if token_budget is not None and count_tokens(combined_response) > token_budget:
+            print(f'Context budget: the claim is truncated to {token_budget} tokens')
+            combined_response = truncate_to_tokens(combined_response, token_budget)
+
+        if dependent_claims:
+            kept_claims = dependent_claims
+            if token_budget is not None:
+                available_tokens = token_budget - count_tokens(combined_response) - count_tokens("\nDependant claims:\n")
+                kept_claims = fit_dependent_claims(dependent_claims, available_tokens)
+            if kept_claims:
+                combined_response += "\nDependant claims:\n" + "\n".join(kept_claims) + "\n"
+
+        # Point the template to the context, and to the description sections if additional indices were used
+        information = prompt_cache.CONTEXT_REFERENCE
         if self.patent_information_indices:
-            prompt_template = prompt_template.replace("{information}", "You can use the additional information to improve your answer:\n Additional information \n {information}")
+            information = prompt_cache.CONTEXT_REFERENCE_WITH_SECTIONS
 
-        # Query additional indices if they exist
+        # Query additional indices with the claim content so reference numerals and terms match
+        section_query = self._format_response(claim_nodes, "") + dependent_claims_block
+        section_nodes = {}
         for index_name, index in self.patent_information_indices.items():
             if 'claim_text_index' not in index_name:
-                additional_nodes = index.as_retriever(similarity_top_k=additional_k).retrieve(self._format_response(claim_nodes, ""))
-                combined_response += f"\n{index_name.capitalize().split('_text')[0]} Information:\n"
-                combined_response += self._format_response(additional_nodes, "")
+                section_nodes[index_name] = index.as_retriever(similarity_top_k=additional_k).retrieve(section_query)
+
+        # Fill the remaining budget with the best chunks across sections
+        if token_budget is not None:
+            token_budget = max(0, token_budget - count_tokens(combined_response))
+        section_context = ""
+        for index_name, additional_nodes in select_context_nodes(section_nodes, token_budget).items():
+            if additional_nodes:
+                section_context += f"{index_name.capitalize().split('_text')[0]} Information:\n"
+                section_context += self._format_response(additional_nodes, "")
+
+        # Prepare the prompt for the LLM, the sections then the claims are the cached prefix
+        input_prompt = {
+            'context': [section_context, combined_response],
+            'instructions': PromptTemplate(prompt_template).format(information=information)
+        }
 
-        # Prepare the prompt for the LLM using the combined response
-        input_prompt = PromptTemplate(prompt_template)
-
-        
         if print_prompt:
-            print(input_prompt.format(information=combined_response))
-
-        # Query the LLM to generate the summary or answer
-        summary = Settings.llm.complete(input_prompt.format(information=combined_response))
-
-        return summary.text, input_prompt.format(information=combined_response)
+            print(section_context)
+            print(combined_response)
+            print(input_prompt['instructions'])
+
+        # Stream the LLM answer and stop as soon as the JSON object is complete
+        data_dict = utils.stream_json_completion(
+            lambda: prompt_cache.stream_cached_completion(
+                prompt_cache.get_client(),
+                model=Settings.llm.model,
+                context=input_prompt['context'],
+                instructions=input_prompt['instructions'],
+                max_tokens=Settings.llm.max_tokens,
+                temperature=Settings.llm.temperature
+            ),
+            partial_key='summary',
+            on_partial=on_partial
+        )
+
+        return data_dict, input_prompt
 
     def _format_response(self, nodes: List[NodeWithScore], source: str) -> str:
         """
@@ -118,7 +315,9 @@ class HierarchicalQueryEngine:
         """
         response = f"Source: {source}\n\n" if source else ""
         for i, node in enumerate(nodes, 1):
-            response += f"{i}. {node.node.get_content()}\n\n"
+            # Paragraph numbers of the description chunks, so the summary can cite them
+            paragraphs = node.node.metadata.get('paragraphs')
+            response += f"{i}. {paragraphs + ' ' if paragraphs else ''}{node.node.get_content()}\n\n"
         return response
 
 def create_document_from_text(text: str) -> Document:
@@ -142,64 +341,191 @@ def create_document_from_text(text: str) -> Document:
         metadata_seperator='\n'
     )
 
-def run_RAG_pipeline(llm, retrieved_images, prompt_template: str, data_patent: dict, print_prompt: bool = False) -> tuple:
+def setup_embed_model() -> HuggingFaceEmbedding:
+    """
+    Set up the embedding model used by every index.
+
+    Returns:
+        HuggingFaceEmbedding: Embedding model set in Settings.
+    """
+    device = devices.get_device(min_memory=5)
+    print(f"Using device: {device}")
+    Settings.embed_model = models.load_embed_model(device)
+    return Settings.embed_model
+
+def setup_node_parser(chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> PatentNodeParser:
+    """
+    Set up the paragraph-aware node parser used by every index.
+
+    Args:
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+
+    Returns:
+        PatentNodeParser: Node parser set in Settings.
+    """
+    parser = Settings.node_parser
+    if not isinstance(parser, PatentNodeParser) or (parser.chunk_size, parser.chunk_overlap) != (chunk_size, chunk_overlap):
+        Settings.node_parser = PatentNodeParser(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        Settings.transformations = [Settings.node_parser]
+    return Settings.node_parser
+
+def add_section_to_store(store: PortfolioStore, patent_number: str, section: str, index, nodes: List[Node]) -> None:
+    """
+    Add the chunks of a patent section to the portfolio store.
+
+    Args:
+        store (PortfolioStore): Portfolio store.
+        patent_number (str): Publication number of the patent.
+        section (str): Section name.
+        index: Section index, its embeddings are reused when it is a HybridIndex.
+        nodes (List[Node]): Chunks of the section.
+    """
+    if isinstance(index, HybridIndex):
+        embeddings = index.get_embeddings(list(range(len(nodes))))
+    else:
+        embeddings = Settings.embed_model.get_text_embedding_batch([node.get_content() for node in nodes])
+    store.add(patent_number, section, [node.get_content() for node in nodes], embeddings)
+
+def spill_vector_index(index: VectorStoreIndex, path: str) -> int:
+    """
+    Move the embeddings of a dense section index to a memory-mapped file, to stay within a memory budget.
+
+    The in-memory vector store keeps each embedding as a list of floats and
+    only needs array-like rows to rank them, as HybridIndex.spill does.
+
+    Args:
+        index (VectorStoreIndex): Index backed by the in-memory vector store.
+        path (str): Path to the .npy file to write.
+
+    Returns:
+        int: Number of embeddings spilled.
+    """
+    embedding_dict = index.vector_store.data.embedding_dict
+    in_memory = [node_id for node_id, embedding in embedding_dict.items() if not isinstance(embedding, np.memmap)]
+    if not in_memory:
+        return 0
+    np.save(path, np.asarray([embedding_dict[node_id] for node_id in in_memory], dtype=np.float32))
+    spilled = np.load(path, mmap_mode='r')
+    try:
+        # The mapping stays valid without the file on POSIX, so nothing is left behind
+        os.remove(path)
+    except OSError:
+        pass
+    for row, node_id in enumerate(in_memory):
+        embedding_dict[node_id] = spilled[row]
+    return len(in_memory)
+
+def build_section_indices(llm, data_patent: PatentData, hybrid: bool = True, store: Optional[PortfolioStore] = None, similar_patents: bool = False,
+                          chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> dict:
+    """
+    Create the indices of the additional patent information sections.
+
+    The sections do not depend on the selected claim, so the indices can be
+    shared by every claim of the same patent. With a portfolio store, sections
+    already stored are queried from the store without embedding them again and
+    new sections are added to it. The sections are chunked on their
+    paragraphs, the same chunks validation compares the summary with.
+    Under a memory budget the sections are processed one at a time and the
+    embeddings are spilled to disk whenever the budget is exceeded.
+
+    Args:
+        llm: Language model to use.
+        data_patent (PatentData): Patent data of one of the claims.
+        hybrid (bool): Whether to use hybrid BM25 + dense indices instead of dense VectorStoreIndex.
+        store (PortfolioStore, optional): Persistent store of the processed patents.
+        similar_patents (bool): Whether to also retrieve chunks of the other patents of the store.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+
+    Returns:
+        dict: Indices keyed by '<section>_index'.
+    """
+    patent_number = data_patent.patent_number
+
+    additional_indices = {}
+    for key in data_patent.sections():
+        print(f'Added: {key}')
+        if store is not None and store.has(patent_number, key):
+            additional_indices[f'{key}_index'] = PortfolioIndex(store, patent_numbers=[patent_number], sections=[key])
+            continue
+
+        nodes = nodes_from_chunks(data_patent.chunks(key, chunk_size, chunk_overlap), {"category": "patent_text"})
+        if hybrid:
+            index = HybridIndex(nodes)
+        else:
+            index = VectorStoreIndex(nodes, llm=llm)
+        additional_indices[f'{key}_index'] = index
+
+        if store is not None:
+            add_section_to_store(store, patent_number, key, index, nodes)
+
+        # Release the section before the next one, spilling the embeddings when over budget
+        del nodes
+        if memory_budget.enabled():
+            memory_budget.release()
+            if memory_budget.exceeded():
+                for name, built_index in additional_indices.items():
+                    if isinstance(built_index, HybridIndex):
+                        built_index.spill(memory_budget.spill_path(name))
+                    elif isinstance(built_index, VectorStoreIndex):
+                        spill_vector_index(built_index, memory_budget.spill_path(name))
+                memory_budget.release()
+
+    if store is not None and similar_patents:
+        additional_indices['similar_patents_text_index'] = PortfolioIndex(store, exclude_patents=[patent_number])
+
+    return additional_indices
+
+def run_RAG_pipeline(llm, retrieved_images, prompt_template: str, data_patent: PatentData, print_prompt: bool = False, on_partial=None, additional_indices: Optional[dict] = None, token_budget: Optional[int] = None, hybrid: bool = True, store: Optional[PortfolioStore] = None, similar_patents: bool = False,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> tuple:
     """
     Run the RAG pipeline for patent analysis.
 
     Args:
         llm: Language model to use.
         prompt_template (str): Template for the prompt.
-        data_patent (dict): Dictionary containing patent data.
+        data_patent (PatentData): Patent data of the claim.
         print_prompt (bool): Whether to print the generated prompt.
+        on_partial (callable, optional): Called with the partial summary text while streaming.
+        additional_indices (dict, optional): Prebuilt section indices from build_section_indices.
+        token_budget (int, optional): Maximum number of tokens of the patent context.
+        hybrid (bool): Whether to use hybrid BM25 + dense section indices.
+        store (PortfolioStore, optional): Persistent store of the processed patents.
+        similar_patents (bool): Whether to also retrieve chunks of the other patents of the store.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
 
     Returns:
-        tuple: Generated summary and references.
+        tuple: Generated summary, references and the input prompt (cached context and instructions).
     """
     Settings.llm = llm
 
-    # Set up the embedding model
-    device = 'cuda' if utils.check_gpu_is_free(min_memory=5) else 'cpu'
-    print(f"Using device: {device}")
-    embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-m3", device=device)
-    Settings.embed_model = embed_model
+    # Set up the embedding model and the paragraph-aware node parser
+    setup_embed_model()
+    setup_node_parser(chunk_size, chunk_overlap)
 
     # Create index for claims
-    document_claim = create_document_from_text(data_patent['claim_text'])
+    document_claim = create_document_from_text(data_patent.claim_text)
     claims_VectorIndex = VectorStoreIndex.from_documents([document_claim], llm=llm)
 
     # Create indices for additional patent information
-    additional_patent_info = [
-        'field_of_invention_text',
-        'background_of_the_invention_text',
-        'summary_of_the_invention_text',
-        'brief_description_of_the_drawings_text',
-        'detailed_description_of_the_embodiments_text'
-    ]
-
-    additional_indices = {}
-    for key in additional_patent_info:
-        if data_patent[key]:
-            print(f'Added: {key}')
-            document = create_document_from_text(data_patent[key])
-            index = VectorStoreIndex.from_documents([document], llm=llm)
-            additional_indices[f'{key}_index'] = index
+    if additional_indices is None:
+        additional_indices = build_section_indices(llm, data_patent, hybrid=hybrid, store=store, similar_patents=similar_patents,
+                                                   chunk_size=chunk_size, chunk_overlap=chunk_overlap)
 
     # Create the hierarchical query engine
     query_engine = HierarchicalQueryEngine(claims_VectorIndex, **additional_indices)
 
-    # Modify prompt template if dependent claims exist
-    if data_patent['dependent_claims_text']:
-        for text in reversed(data_patent['dependent_claims_text']):
-            prompt_template = prompt_template.replace("{information}", "{information} \n" + text + "\n ")
-        prompt_template = prompt_template.replace("{information}", "{information} \nDependant claims:\n ")
-
     # Execute the query
-    combined_response, input_prompt = query_engine.query(prompt_template, claim_k=1, additional_k=4, print_prompt=print_prompt)
-
-    # Extract and parse JSON from the response
-    json_start = combined_response.index('{')
-    json_end = combined_response.rindex('}') + 1
-    json_str = combined_response[json_start:json_end]
-    data_dict = json.loads(json_str)
+    data_dict, input_prompt = query_engine.query(
+        prompt_template,
+        dependent_claims=data_patent.dependent_claims_text,
+        claim_k=1,
+        additional_k=4,
+        print_prompt=print_prompt,
+        on_partial=on_partial,
+        token_budget=token_budget
+    )
 
     return data_dict['summary'], data_dict['reference'], input_prompt
\ No newline at end of file
@@ -1,10 +1,10 @@
 # Import required libraries
 import ipywidgets as widgets
 from IPython.display import display, HTML
-import json
-import os
-from main import main, load_config
-import base64
+import threading
+from main import main, load_config, PipelineCancelled
+from service import ServiceClient
+from results import as_bytes
 
 """
 Patent Analysis Widget
@@ -27,9 +27,20 @@ class PatentAnalysisWidget:
     - Metrics display dashboard
     """
     # Initialize the widget with configuration schema
-    def __init__(self, json_schema):
+    def __init__(self, json_schema, server_url=None):
+        """
+        Args:
+            json_schema (dict): Default configuration.
+            server_url (str, optional): URL of a running service.py. The pipeline runs in this kernel if None.
+        """
         self.schema = json_schema
+        self.client = ServiceClient(server_url) if server_url else None
         self.input_widgets = {}
+        self.relevant_image = []
+        # Background run state
+        self.worker = None
+        self.job_id = None
+        self.cancel_event = threading.Event()
         # Create main output image widget
         self.output_image = widgets.Image(format='svg+xml', layout=widgets.Layout(width='600px', height='450px'))
         self.output_text = widgets.HTML()
@@ -44,10 +55,19 @@ class PatentAnalysisWidget:
             layout=widgets.Layout(width='300px')
         )
         self.relevant_figures_image = widgets.Image(
-            format='png', 
+            format='jpeg', 
             layout=widgets.Layout(width='600px', height='450px')
         )
         self.relevant_figures_dropdown.observe(self.on_figure_change, names='value')
+
+        # Results of each claim of a multi-claim run, the selected claim is displayed
+        self.claim_results = {}
+        self.claim_dropdown = widgets.Dropdown(
+            options=[],
+            description='Select Claim:',
+            layout=widgets.Layout(width='300px', display='none')
+        )
+        self.claim_dropdown.observe(self.on_claim_change, names='value')
         
         self.create_ui()
 
@@ -69,7 +89,7 @@ class PatentAnalysisWidget:
         # Create individual section metrics
         section_metrics = []
         for section, values in metrics.items():
-            if section != 'overall_metrics':
+            if section not in ('overall_metrics', 'text_processing'):
                 section_name = section.replace('_text', '').replace('_', ' ').title()
                 section_box = widgets.VBox([
                     widgets.HTML(f"<h3>{section_name}</h3>"),
@@ -84,8 +104,12 @@ class PatentAnalysisWidget:
                 ], layout=widgets.Layout(margin='10px'))
                 section_metrics.append(section_box)
 
+        # Tokenizer and stop words the metrics were computed with
+        text_processing = ', '.join(f"{key}: {value}" for key, value in metrics.get('text_processing', {}).items())
+
         return widgets.VBox([
             overall_metrics,
+            widgets.HTML(f"<p>{text_processing}</p>"),
             widgets.HTML("<h2>Section Metrics</h2>"),
             widgets.VBox(section_metrics)
         ], layout=widgets.Layout(padding='20px'))
@@ -103,7 +127,7 @@ class PatentAnalysisWidget:
                     value=str(value),
                     layout=widgets.Layout(width='50%')
                 )
-            elif key == 'claim_number':
+            elif key == 'claim_number' and isinstance(value, int):
                 widget = widgets.IntText(
                     description=key,
                     value=int(value),
@@ -124,7 +148,7 @@ class PatentAnalysisWidget:
                     layout=widgets.Layout(width='50%')
                 )
             # Skip certain configuration fields
-            elif key in ['model_llm', 'prompt_template', 'prompt_template_image', 'temperature', 'max_tokens', 'max_tokens_code']:
+            elif key in ['model_llm', 'prompt_template', 'prompt_template_image', 'temperature', 'max_tokens', 'max_tokens_code', 'max_workers', 'context_token_budget', 'chunk_size', 'chunk_overlap', 'memory_budget_mb', 'epab_mock_dir', 'epab_fetch_workers', 'epab_prefetch', 'hybrid_retrieval', 'portfolio_store', 'portfolio_similar_patents', 'reference_image_selection', 'image_dedup', 'image_dedup_threshold', 'image_mmr_lambda', 'figure_label_extraction', 'embed_model', 'clip_model', 'model_quantization', 'torch_threads', 'torch_interop_threads', 'persist_results', 'results_store', 'stage_cache', 'svg_minify', 'svg_decimals', 'svg_max_elements', 'svg_max_bytes', 'svg_thumbnail_size']:
                 continue
             else:
                 widget = widgets.Text(
@@ -136,13 +160,21 @@ class PatentAnalysisWidget:
             self.input_widgets[key] = widget
             input_widgets.append(widget)
 
-        # Create Submit and Reset buttons
-        submit_button = widgets.Button(
+        # Create Submit, Cancel and Reset buttons
+        self.submit_button = widgets.Button(
             description="Submit",
             button_style='primary',
             layout=widgets.Layout(width='150px')
         )
-        submit_button.on_click(self.on_submit)
+        self.submit_button.on_click(self.on_submit)
+
+        self.cancel_button = widgets.Button(
+            description="Cancel",
+            button_style='danger',
+            disabled=True,
+            layout=widgets.Layout(width='150px')
+        )
+        self.cancel_button.on_click(self.on_cancel)
 
         reset_button = widgets.Button(
             description="Reset",
@@ -153,7 +185,7 @@ class PatentAnalysisWidget:
 
         # Create button container
         button_box = widgets.HBox(
-            [submit_button, reset_button],
+            [self.submit_button, reset_button],
             layout=widgets.Layout(
                 justify_content='space-around',
                 padding='20px'
@@ -174,7 +206,7 @@ class PatentAnalysisWidget:
         
         # Create output area
         self.output_box = widgets.VBox(
-            [self.output_image, self.output_text, self.loading_indicator],
+            [widgets.HBox([self.loading_indicator, self.cancel_button]), self.claim_dropdown, self.output_image, self.output_text],
             layout=widgets.Layout(padding='20px')
         )
         self.loading_indicator.layout.display = 'none'
@@ -202,65 +234,208 @@ class PatentAnalysisWidget:
     # Handle form submission
     def on_submit(self, b):
         """
-        Handle form submission and process patent analysis.
+        Start the patent analysis in a background thread so the notebook stays responsive.
         
         Args:
             b: Button click event
         """
+        if self.worker is not None and self.worker.is_alive():
+            return
+
+        self.loading_indicator.value = "Processing..."
         self.loading_indicator.layout.display = 'block'
-        self.output_text.value = ""
-        self.output_image.value = b''
+        self.clear_results()
+        self.claim_results = {}
+        self.claim_dropdown.options = []
+        self.claim_dropdown.layout.display = 'none'
+        self.submit_button.disabled = True
+        self.cancel_button.disabled = False
+        self.tab.selected_index = 1
 
         # Collect input data
         input_data = {key: widget.value for key, widget in self.input_widgets.items()}
         updated_schema = {**self.schema, **input_data}
-        temp_json_path = 'temp_config.json'
-        
-        # Save temporary configuration
-        with open(temp_json_path, 'w') as f:
-            json.dump(updated_schema, f)
+
+        self.cancel_event.clear()
+        self.job_id = None
+        self.worker = threading.Thread(target=self.run_pipeline, args=(updated_schema,), daemon=True)
+        self.worker.start()
+
+    # Run the pipeline in the background thread
+    def run_pipeline(self, config):
+        """
+        Run the patent analysis, filling each panel as soon as its stage finishes.
         
+        Args:
+            config (dict): Configuration parameters
+        """
         try:
-            # Run patent analysis
-            summary, output_filename, claim_info, relevant_image, metrics = main(load_config(temp_json_path))
-
-            # Format claims display
-            claims_text = [
-                f"<h3>Main Claim:</h3><p>{claim_info['claim_text']}</p>",
-                "<h3>Dependent Claims:</h3>"
-            ] + [f"<p>{claim}</p>" for claim in claim_info['dependent_claims_text']]
-            
-            self.claim_info.value = "<div style='padding: 20px'>" + "".join(claims_text) + "</div>"
-            
-            # Display output image if available
-            if output_filename and os.path.exists(output_filename):
-                with open(output_filename, 'rb') as f:
-                    self.output_image.value = f.read()
-            
-            # Handle relevant figures
-            if relevant_image:
-                self.relevant_image = relevant_image
-                self.relevant_figures_dropdown.options = [f'Figure {i+1}' for i in range(len(relevant_image))]
-                self.relevant_figures_dropdown.value = self.relevant_figures_dropdown.options[0]
-                self.update_relevant_figure(0)
+            # Run patent analysis, on the service when one is configured
+            if self.client:
+                self.job_id = self.client.submit(config)
+                status = self.client.wait(self.job_id, on_stage=self.on_stage, on_partial_summary=self.on_partial_summary)
+                if status['status'] == 'cancelled':
+                    raise PipelineCancelled()
+                if status['status'] != 'done':
+                    raise RuntimeError(status['error'] or f"Job {status['status']}")
             else:
-                self.relevant_image = []
-                self.relevant_figures_dropdown.options = []
-                self.relevant_figures_image.value = b''
+                main(config, on_partial_summary=self.check_cancelled(self.on_partial_summary), on_stage=self.check_cancelled(self.on_stage))
 
-            # Update summary and metrics display
-            self.output_text.value = f"<div style='padding: 20px'><h2>Summary</h2><p>{summary}</p></div>"
-            self.metrics_display.children = [self.format_metrics(metrics)]
+        except PipelineCancelled:
+            self.output_text.value = "<div style='padding: 20px'><strong>Cancelled</strong></div>"
 
         except Exception as e:
             self.output_text.value = f"<div style='color: red; padding: 20px;'><strong>Error:</strong> {str(e)}</div>"
 
         finally:
-            # Clean up temporary file and hide loading indicator
-            if os.path.exists(temp_json_path):
-                os.remove(temp_json_path)
+            # Hide loading indicator
             self.loading_indicator.layout.display = 'none'
-            self.tab.selected_index = 1
+            self.submit_button.disabled = False
+            self.cancel_button.disabled = True
+
+    # Wrap a progress callback so a cancelled run stops at the next stage or token
+    def check_cancelled(self, callback):
+        """
+        Wrap a progress callback of main to stop the run when it is cancelled.
+        
+        Args:
+            callback (callable): Progress callback
+            
+        Returns:
+            callable: Callback raising PipelineCancelled once the run is cancelled
+        """
+        def wrapper(*args):
+            if self.cancel_event.is_set():
+                raise PipelineCancelled()
+            callback(*args)
+        return wrapper
+
+    # Handle cancel button
+    def on_cancel(self, b):
+        """
+        Cancel the running patent analysis.
+        
+        Args:
+            b: Button click event
+        """
+        self.cancel_event.set()
+        self.loading_indicator.value = "Cancelling..."
+        if self.client and self.job_id:
+            self.client.cancel(self.job_id)
+
+    # Fill the panel of a finished stage
+    def on_stage(self, stage, data):
+        """
+        Display the results of a finished pipeline stage.
+        
+        Args:
+            stage (str): Name of the finished stage
+            data (dict): Results of the stage, listed per claim under 'claims' in multi-claim mode
+        """
+        self.loading_indicator.value = f"Processing... ({stage} done)"
+        if 'claims' not in data:
+            self.show_stage(stage, data)
+            return
+
+        # Multi-claim run: keep the results of every claim and refresh the selected one
+        for claim in data['claims']:
+            self.claim_results.setdefault(claim['claim_number'], {})[stage] = claim
+        if not self.claim_dropdown.options:
+            self.claim_dropdown.options = [(f'Claim {claim_number}', claim_number) for claim_number in self.claim_results]
+            self.claim_dropdown.layout.display = 'block'
+        self.show_claim_result(self.claim_dropdown.value)
+
+    # Display the panels of one stage
+    def show_stage(self, stage, data):
+        """
+        Fill the panel of a pipeline stage.
+        
+        Args:
+            stage (str): Name of the stage
+            data (dict): Results of the stage for a single claim
+        """
+        if stage == 'claims' and 'claim_text' in data:
+            self.show_claims(data['claim_text'], data['dependent_claims_text'])
+        elif stage in ('summary', 'image_summary') and 'summary' in data:
+            self.output_text.value = f"<div style='padding: 20px'><h2>Summary</h2><p>{data['summary']}</p></div>"
+        elif stage == 'images' and 'top_images' in data:
+            self.show_figures([as_bytes(image) for image in data['top_images']])
+        elif stage == 'svg' and data.get('svg'):
+            # Display output image if available
+            self.output_image.value = as_bytes(data['svg'])
+        elif stage == 'metrics' and 'metrics' in data:
+            self.metrics_display.children = [self.format_metrics(data['metrics'])]
+
+    # Display the results of one claim of a multi-claim run
+    def show_claim_result(self, claim_number):
+        """
+        Fill the panels with the finished stages of a claim.
+        
+        Args:
+            claim_number (int): Number of the claim
+        """
+        self.clear_results()
+        for stage, data in self.claim_results.get(claim_number, {}).items():
+            self.show_stage(stage, data)
+
+    # Handle claim selection change
+    def on_claim_change(self, change):
+        """
+        Handle claim selection change events.
+        """
+        if change.new is not None:
+            self.show_claim_result(change.new)
+
+    # Empty the result panels
+    def clear_results(self):
+        """Clear the summary, SVG, claims, figures and metrics panels."""
+        self.output_text.value = ""
+        self.output_image.value = b''
+        self.claim_info.value = ""
+        self.metrics_display.children = []
+        self.show_figures([])
+
+    # Format claims display
+    def show_claims(self, claim_text, dependent_claims_text):
+        """
+        Display the selected claim and its dependent claims.
+        
+        Args:
+            claim_text (str): Text of the selected claim
+            dependent_claims_text (list): Texts of the dependent claims
+        """
+        claims_text = [
+            f"<h3>Main Claim:</h3><p>{claim_text}</p>",
+            "<h3>Dependent Claims:</h3>"
+        ] + [f"<p>{claim}</p>" for claim in dependent_claims_text or []]
+        
+        self.claim_info.value = "<div style='padding: 20px'>" + "".join(claims_text) + "</div>"
+
+    # Handle relevant figures
+    def show_figures(self, relevant_image):
+        """
+        Display the retrieved figures.
+        
+        Args:
+            relevant_image (list): Encoded figures (JPEG bytes)
+        """
+        self.relevant_image = relevant_image or []
+        self.relevant_figures_dropdown.options = [f'Figure {i+1}' for i in range(len(self.relevant_image))]
+        if self.relevant_image:
+            self.relevant_figures_dropdown.value = self.relevant_figures_dropdown.options[0]
+            self.update_relevant_figure(0)
+        else:
+            self.relevant_figures_image.value = b''
+
+    # Show the summary while it is being generated
+    def on_partial_summary(self, text):
+        """
+        Display the partial summary streamed by the LLM.
+        
+        Args:
+            text (str): Summary text received so far
+        """
+        self.output_text.value = f"<div style='padding: 20px'><h2>Summary</h2><p>{text}...</p></div>"
 
     # Reset form to default values
     def on_reset(self, b):
@@ -283,8 +458,7 @@ class PatentAnalysisWidget:
             index (int): Index of the figure to display
         """
         if 0 <= index < len(self.relevant_image):
-            image_data = self.relevant_image[index]
-            self.relevant_figures_image.value = base64.b64decode(image_data)
+            self.relevant_figures_image.value = self.relevant_image[index]
 
     # Handle figure selection change
     def on_figure_change(self, change):
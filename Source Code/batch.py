@@ -0,0 +1,555 @@
+# Standard library imports
+import os
+import re
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import argparse
+import statistics
+import multiprocessing
+from datetime import datetime
+from contextlib import closing
+
+# Custom imports
+import main as pipeline
+import models
+import devices
+import epab_fetch
+from results import get_sink
+
+BATCH_QUEUE_PATH = './cache/batch.sqlite'
+CHECKPOINT_DIR = './cache/batch_checkpoints'
+
+def shard_of(patent_number: str, num_shards: int) -> int:
+    """
+    Get the shard of a patent, stable across processes and machines.
+
+    Args:
+        patent_number (str): Publication number of the patent.
+        num_shards (int): Number of shards.
+
+    Returns:
+        int: Shard index.
+    """
+    return zlib.crc32(patent_number.strip().upper().encode('utf-8')) % num_shards
+
+def read_manifest(path: str, default_claim_number) -> list:
+    """
+    Read a manifest of patents, one per line: a patent number optionally followed by the claim number(s),
+    e.g. "EP3000000 5", "EP3000000 [1, 5]" or "EP3000000 all independent".
+
+    Empty lines and lines starting with # are ignored.
+
+    Args:
+        path (str): Path to the manifest file.
+        default_claim_number: Claim number of the lines without one (e.g. 1 or "all independent").
+
+    Returns:
+        list: (patent_number, claim_number) tuples, claim_number as a JSON string.
+    """
+    tasks = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            patent_number, _, claim_number = line.partition(' ')
+            claim_number = claim_number.strip()
+            try:
+                # 3, [1, 5] or "all independent"
+                claim_number = json.loads(claim_number) if claim_number else default_claim_number
+            except json.JSONDecodeError:
+                pass
+            tasks.append((patent_number, json.dumps(claim_number)))
+    return tasks
+
+def read_checkpoints(checkpoint_dir: str = CHECKPOINT_DIR) -> set:
+    """
+    Read the tasks recorded as done in the shard checkpoint files.
+
+    Args:
+        checkpoint_dir (str): Directory of the shard checkpoint files.
+
+    Returns:
+        set: (patent_number, claim_number) of the finished tasks.
+    """
+    done = set()
+    if not os.path.isdir(checkpoint_dir):
+        return done
+    for filename in os.listdir(checkpoint_dir):
+        if not filename.endswith('.jsonl'):
+            continue
+        with open(os.path.join(checkpoint_dir, filename), 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line of a worker killed while writing
+                    continue
+                if record['status'] == 'done':
+                    done.add((record['patent_number'], record['claim_number']))
+    return done
+
+class BatchQueue:
+    """
+    Work queue of a batch, in SQLite.
+
+    Every machine running batch.py on the same database file pulls tasks from
+    it. A running task whose worker stops renewing its lease with heartbeat
+    (crashed worker or node) is queued again, and only the worker holding the
+    lease can record the outcome of a task.
+    """
+
+    def __init__(self, path: str = BATCH_QUEUE_PATH, lease: float = 3600, max_attempts: int = 3):
+        """
+        Open or create the queue.
+
+        Args:
+            path (str): Path to the SQLite database.
+            lease (float): Seconds without heartbeat after which a running task is considered abandoned.
+            max_attempts (int): Attempts of a task before it is marked as failed.
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks (patent_number TEXT, claim_number TEXT, shard INTEGER, status TEXT, '
+                'attempts INTEGER, worker TEXT, metrics TEXT, timings TEXT, error TEXT, created REAL, updated REAL, '
+                'PRIMARY KEY (patent_number, claim_number))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, shard)')
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the queue. Connections are not shared between processes.
+
+        Returns:
+            sqlite3.Connection: Database connection.
+        """
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def load(self, tasks: list, num_shards: int, skip: set = frozenset()) -> int:
+        """
+        Add the tasks of a manifest, keeping the tasks already in the queue.
+
+        Args:
+            tasks (list): (patent_number, claim_number) tuples from read_manifest.
+            num_shards (int): Number of shards the patents are partitioned into.
+            skip (set): Tasks already done according to the checkpoints.
+
+        Returns:
+            int: Number of tasks added.
+        """
+        now = time.time()
+        rows = [
+            (patent_number, claim_number, shard_of(patent_number, num_shards), 'done' if (patent_number, claim_number) in skip else 'queued', now, now)
+            for patent_number, claim_number in tasks
+        ]
+        with closing(self._connect()) as conn, conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, 0, NULL, NULL, NULL, NULL, ?, ?)', rows)
+            return conn.total_changes - before
+
+    def claim(self, worker: str, shards: list = None, preferred: tuple = None) -> dict:
+        """
+        Take a queued task and mark it as running.
+
+        Args:
+            worker (str): Id of the worker process.
+            shards (list, optional): Shards this node pulls from, all shards if None.
+            preferred (tuple, optional): (modulus, remainder) of the shards taken first by this worker, the
+                other shards are taken once these are empty.
+
+        Returns:
+            dict or None: Patent number, claim number, shard and worker of the task, None if the queue is empty.
+        """
+        now = time.time()
+        shard_filter = f"AND shard IN ({','.join('?' * len(shards))})" if shards else ''
+        order = 'ORDER BY (shard % ?) != ?, shard, created' if preferred else 'ORDER BY shard, created'
+        params = list(shards or []) + list(preferred or [])
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            # Requeue the tasks of crashed workers
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = 'Lease expired' "
+                "WHERE status = 'running' AND updated < ?",
+                (self.max_attempts, now - self.lease)
+            )
+            row = conn.execute(f"SELECT patent_number, claim_number, shard FROM tasks WHERE status = 'queued' {shard_filter} {order} LIMIT 1", params).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'running', attempts = attempts + 1, worker = ?, updated = ? WHERE patent_number = ? AND claim_number = ?",
+                (worker, now, row['patent_number'], row['claim_number'])
+            )
+            conn.commit()
+        return {**dict(row), 'worker': worker}
+
+    def heartbeat(self, task: dict) -> bool:
+        """
+        Renew the lease of a running task, so a long task is not queued again.
+
+        Args:
+            task (dict): Task from claim.
+
+        Returns:
+            bool: Whether the worker still holds the lease, False once the task was queued again.
+        """
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET updated = ? WHERE patent_number = ? AND claim_number = ? AND status = 'running' AND worker = ?",
+                (time.time(), task['patent_number'], task['claim_number'], task['worker'])
+            )
+            return cursor.rowcount > 0
+
+    def upcoming(self, limit: int, shards: list = None, preferred: tuple = None) -> list:
+        """
+        Get the patents of the next queued tasks, in the order claim takes them.
+
+        Args:
+            limit (int): Maximum number of patents.
+            shards (list, optional): Shards this node pulls from, all shards if None.
+            preferred (tuple, optional): (modulus, remainder) of the shards taken first by this worker.
+
+        Returns:
+            list: Distinct patent numbers.
+        """
+        if limit <= 0:
+            return []
+        shard_filter = f"AND shard IN ({','.join('?' * len(shards))})" if shards else ''
+        order = 'ORDER BY (shard % ?) != ?, shard, created' if preferred else 'ORDER BY shard, created'
+        params = list(shards or []) + list(preferred or [])
+        with closing(self._connect()) as conn:
+            rows = conn.execute(f"SELECT patent_number FROM tasks WHERE status = 'queued' {shard_filter} {order} LIMIT ?", params + [limit * 4]).fetchall()
+        return list(dict.fromkeys(row['patent_number'] for row in rows))[:limit]
+
+    def finish(self, task: dict, status: str, metrics: dict = None, timings: dict = None, error: str = None) -> bool:
+        """
+        Record the outcome of a task. A failed task is queued again until it reaches max_attempts.
+
+        The outcome is only recorded while the worker holds the lease, a worker
+        whose task was queued again does not overwrite the new attempt.
+
+        Args:
+            task (dict): Task from claim.
+            status (str): 'done' or 'failed'.
+            metrics (dict, optional): Validation metrics keyed by claim number.
+            timings (dict, optional): Seconds spent in each stage.
+            error (str, optional): Error message of a failed task.
+
+        Returns:
+            bool: Whether the outcome was recorded, False if the worker lost the lease.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT attempts FROM tasks WHERE patent_number = ? AND claim_number = ? AND status = 'running' AND worker = ?",
+                (task['patent_number'], task['claim_number'], task['worker'])
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return False
+            if status == 'failed':
+                status = 'failed' if row['attempts'] >= self.max_attempts else 'queued'
+            conn.execute(
+                'UPDATE tasks SET status = ?, metrics = ?, timings = ?, error = ?, updated = ? WHERE patent_number = ? AND claim_number = ? AND worker = ?',
+                (status, json.dumps(metrics) if metrics is not None else None, json.dumps(timings) if timings is not None else None,
+                 error, time.time(), task['patent_number'], task['claim_number'], task['worker'])
+            )
+            conn.commit()
+        return True
+
+    def rows(self) -> list:
+        """
+        Get every task of the queue.
+
+        Returns:
+            list: Tasks as dicts, with metrics and timings decoded.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT * FROM tasks').fetchall()
+        tasks = []
+        for row in rows:
+            task = dict(row)
+            task['metrics'] = json.loads(task['metrics']) if task['metrics'] else None
+            task['timings'] = json.loads(task['timings']) if task['timings'] else None
+            tasks.append(task)
+        return tasks
+
+def task_output_filename(output_filename: str, patent_number: str, claim_number) -> str:
+    """
+    Get the SVG path of a task, so parallel workers never write, or delete, each other's files.
+
+    Args:
+        output_filename (str): Configured output filename, only its directory and extension are kept.
+        patent_number (str): Patent number of the task.
+        claim_number (int, str or list): Claim number field of the task.
+
+    Returns:
+        str: e.g. ./images/EP1356755A2_claim1.svg. Multi-claim tasks get the patent number only,
+        main_multi_claim adds each claim number.
+    """
+    directory = os.path.dirname(output_filename or '') or './images'
+    ext = os.path.splitext(output_filename or '')[1] or '.svg'
+    root = os.path.join(directory, re.sub(r'[^A-Za-z0-9]+', '_', patent_number))
+    if pipeline.is_multi_claim(claim_number):
+        return f'{root}{ext}'
+    return pipeline.claim_output_filename(f'{root}{ext}', pipeline.parse_claim_numbers(claim_number))
+
+def append_checkpoint(checkpoint_dir: str, task: dict, status: str, metrics: dict = None) -> None:
+    """
+    Append the outcome of a task to the checkpoint file of its shard.
+
+    Args:
+        checkpoint_dir (str): Directory of the shard checkpoint files.
+        task (dict): Task from BatchQueue.claim.
+        status (str): 'done' or 'failed'.
+        metrics (dict, optional): Validation metrics keyed by claim number.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    record = {'patent_number': task['patent_number'], 'claim_number': task['claim_number'], 'status': status, 'metrics': metrics, 'time': time.time()}
+    with open(os.path.join(checkpoint_dir, f"shard_{task['shard']:04d}.jsonl"), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def result_metrics(result) -> dict:
+    """
+    Get the validation metrics of a pipeline result.
+
+    Args:
+        result (ClaimResult or PatentResult): Result of main.main.
+
+    Returns:
+        dict: Metrics keyed by claim number.
+    """
+    if hasattr(result, 'claims'):
+        return {str(claim_number): claim_result.metrics for claim_number, claim_result in result.claims.items()}
+    return {str(result.claim_number): result.metrics}
+
+def warm_up(config: dict) -> None:
+    """
+    Load the local models in the parent process, so the forked workers share their weights copy-on-write.
+
+    Args:
+        config (dict): Batch configuration.
+    """
+    print('Loading local models before forking the workers...')
+    models.configure(config)
+    from RAG_pipeline import setup_embed_model
+    setup_embed_model()
+    if config.get('retrieve_patent_images'):
+        import image_retrieval_pipeline
+        models.load_clip_model(image_retrieval_pipeline.get_clip_device())
+
+def run_worker(worker_index: int, num_workers: int, config: dict, queue_path: str, shards: list, checkpoint_dir: str, threads_per_worker: int) -> None:
+    """
+    Run tasks of the queue until it is empty. Entry point of the worker processes.
+
+    Args:
+        worker_index (int): Index of the worker on this node.
+        num_workers (int): Number of workers on this node.
+        config (dict): Batch configuration, patent and claim numbers are set per task.
+        queue_path (str): Path to the queue database.
+        shards (list): Shards this node pulls from, all shards if None.
+        checkpoint_dir (str): Directory of the shard checkpoint files.
+        threads_per_worker (int): Torch intra-op threads of the worker.
+    """
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    # The cores of the node are split between the workers
+    config = {**config, 'torch_threads': config.get('torch_threads') or threads_per_worker}
+    models.configure(config)
+    models.configure_threads()
+    epab_fetch.configure(config)
+    queue = BatchQueue(queue_path)
+
+    while True:
+        task = queue.claim(worker, shards=shards, preferred=(num_workers, worker_index))
+        if task is None:
+            break
+        print(f"[{worker}] Shard {task['shard']}: {task['patent_number']} claim {task['claim_number']}")
+        # The next patents are fetched while this one is processed
+        upcoming = queue.upcoming(int(config.get('epab_prefetch', 2)) + 1, shards=shards, preferred=(num_workers, worker_index))
+        epab_fetch.get_fetcher().prefetch(upcoming, drawings=bool(config.get('retrieve_patent_images')), current=task['patent_number'])
+
+        timings = {}
+        last = time.perf_counter()
+
+        def on_stage(stage, data):
+            nonlocal last
+            now = time.perf_counter()
+            timings[stage] = now - last
+            last = now
+            # Renew the lease after every stage, and stop if the task was given to another worker
+            if not queue.heartbeat(task):
+                raise pipeline.PipelineCancelled(f"Lease of {task['patent_number']} claim {task['claim_number']} lost")
+
+        claim_number = json.loads(task['claim_number'])
+        task_config = {
+            **config,
+            'patent_number': task['patent_number'],
+            'claim_number': claim_number,
+            'output_filename': task_output_filename(config.get('output_filename'), task['patent_number'], claim_number)
+        }
+        try:
+            result = pipeline.main(task_config, on_stage=on_stage)
+        except Exception as e:
+            print(f"[{worker}] {task['patent_number']} failed: {e}")
+            if queue.finish(task, 'failed', timings=timings, error=str(e)):
+                append_checkpoint(checkpoint_dir, task, 'failed')
+            continue
+
+        metrics = result_metrics(result)
+        if queue.finish(task, 'done', metrics=metrics, timings=timings):
+            append_checkpoint(checkpoint_dir, task, 'done', metrics)
+        else:
+            print(f"[{worker}] {task['patent_number']}: lease lost, the result of the new attempt is kept")
+
+    # The results are written in the background, wait for them before the process exits
+    failures = get_sink().close()
+    if failures:
+        print(f"[{worker}] {len(failures)} results could not be written: {', '.join(patent_number for patent_number, _, _ in failures)}")
+
+def run_batch(config: dict, queue_path: str = BATCH_QUEUE_PATH, workers: int = 0, shards: list = None, checkpoint_dir: str = CHECKPOINT_DIR) -> None:
+    """
+    Run the queued tasks with a pool of worker processes on this node.
+
+    The models are loaded before forking on CPU so the workers share their
+    weights. CUDA cannot be used in forked children, so on GPU each worker
+    is spawned and loads its own models.
+
+    Args:
+        config (dict): Batch configuration.
+        queue_path (str): Path to the queue database.
+        workers (int): Number of worker processes, 0 for one per 4 available cores.
+        shards (list, optional): Shards this node pulls from, all shards if None.
+        checkpoint_dir (str): Directory of the shard checkpoint files.
+    """
+    cores = len(devices.available_cores())
+    workers = workers or max(1, cores // 4)
+    threads_per_worker = max(1, cores // workers)
+
+    use_fork = 'fork' in multiprocessing.get_all_start_methods() and devices.get_device(min_memory=5) == 'cpu'
+    if use_fork:
+        warm_up(config)
+    context = multiprocessing.get_context('fork' if use_fork else 'spawn')
+
+    print(f'Starting {workers} workers with {threads_per_worker} threads each ({context.get_start_method()})')
+    processes = [
+        context.Process(target=run_worker, args=(i, workers, config, queue_path, shards, checkpoint_dir, threads_per_worker))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def summarize(values: list) -> dict:
+    """
+    Summarize a list of numbers.
+
+    Args:
+        values (list): Numbers.
+
+    Returns:
+        dict: Count, mean, median and max.
+    """
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 4),
+        'median': round(statistics.median(values), 4),
+        'max': round(max(values), 4)
+    }
+
+def build_report(queue: BatchQueue) -> dict:
+    """
+    Aggregate the progress, validation metrics and stage timings of a batch.
+
+    Args:
+        queue (BatchQueue): Queue of the batch.
+
+    Returns:
+        dict: Task counts by status and shard, metric and timing statistics, and the failed tasks.
+    """
+    tasks = queue.rows()
+    status_counts, shard_counts = {}, {}
+    metric_values, timing_values, failures = {}, {}, []
+    for task in tasks:
+        status_counts[task['status']] = status_counts.get(task['status'], 0) + 1
+        shard = shard_counts.setdefault(task['shard'], {})
+        shard[task['status']] = shard.get(task['status'], 0) + 1
+
+        if task['status'] == 'failed':
+            failures.append({'patent_number': task['patent_number'], 'claim_number': task['claim_number'], 'error': task['error']})
+        for stage, seconds in (task['timings'] or {}).items():
+            timing_values.setdefault(stage, []).append(seconds)
+        for claim_metrics in (task['metrics'] or {}).values():
+            for group, values in (claim_metrics or {}).items():
+                for name, value in values.items():
+                    if isinstance(value, (int, float)):
+                        metric_values.setdefault(f'{group} / {name}', []).append(value)
+
+    return {
+        'tasks': len(tasks),
+        'status': status_counts,
+        'shards': {str(shard): counts for shard, counts in sorted(shard_counts.items())},
+        'metrics': {name: summarize(values) for name, values in sorted(metric_values.items())},
+        'stage_timings_s': {stage: summarize(values) for stage, values in timing_values.items()},
+        'failures': failures
+    }
+
+def parse_shards(value: str) -> list:
+    """
+    Parse a shard selection such as "0-7" or "1,3,5".
+
+    Args:
+        value (str): Shard selection.
+
+    Returns:
+        list: Shard indices.
+    """
+    shards = []
+    for part in value.split(','):
+        start, _, end = part.partition('-')
+        shards.extend(range(int(start), int(end or start) + 1))
+    return shards
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the pipeline over a manifest of patents with sharded worker processes.")
+    parser.add_argument("command", choices=['load', 'run', 'report'], help="load a manifest into the queue, run the workers of this node or print the report")
+    parser.add_argument("-i", "--input_json", default='config.json', help="Path to the JSON config file of the batch")
+    parser.add_argument("--manifest", help="Patent numbers, one per line, optionally followed by the claim number(s) (load)")
+    parser.add_argument("--num_shards", type=int, default=64, help="Number of shards the manifest is partitioned into (load)")
+    parser.add_argument("--queue", default=BATCH_QUEUE_PATH, help="Path to the queue database, on a shared filesystem for several machines")
+    parser.add_argument("--checkpoints", default=CHECKPOINT_DIR, help="Directory of the shard checkpoint files")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes on this node, 0 for one per 4 cores (run)")
+    parser.add_argument("--shards", type=parse_shards, default=None, help='Shards this node pulls from, e.g. "0-31" (run)')
+    parser.add_argument("--output", default=None, help="Path to write the report JSON (report)")
+    args = parser.parse_args()
+
+    queue = BatchQueue(args.queue)
+    if args.command == 'load':
+        if not args.manifest:
+            parser.error('load requires --manifest')
+        config = pipeline.load_config(args.input_json)
+        tasks = read_manifest(args.manifest, config.get('claim_number', 1))
+        added = queue.load(tasks, args.num_shards, skip=read_checkpoints(args.checkpoints))
+        print(f'Added {added} of {len(tasks)} tasks in {args.num_shards} shards')
+    elif args.command == 'run':
+        run_batch(pipeline.load_config(args.input_json), args.queue, args.workers, args.shards, args.checkpoints)
+        print(json.dumps(build_report(queue)['status']))
+    else:
+        report = build_report(queue)
+        print(json.dumps(report, indent=4))
+        output = args.output or os.path.join('./summary', f"batch_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Report written to {output}')
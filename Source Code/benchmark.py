@@ -0,0 +1,395 @@
+# Standard library imports
+import os
+import json
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+# Third-party library imports
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Custom imports
+import models
+import memory_budget
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_PATH = os.path.join(SOURCE_DIR, 'benchmark_fixtures', 'retrieval.json')
+
+# Modules whose import time is measured by the cold start benchmark
+COLD_START_MODULES = ['main', 'utilsEPO', 'RAG_pipeline', 'image_retrieval_pipeline', 'image_generation_pipeline', 'validation']
+
+def load_fixture(path: str = FIXTURE_PATH) -> dict:
+    """
+    Load the retrieval fixture set.
+
+    Args:
+        path (str): Path to the fixture JSON file.
+
+    Returns:
+        dict: 'passages', 'queries' and 'images' of the fixture set.
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def draw_shape(shape: str, size: int = 224) -> Image.Image:
+    """
+    Draw a black-on-white line drawing of a simple shape, like a patent drawing sheet.
+
+    Args:
+        shape (str): 'circle', 'square', 'triangle', 'cross' or 'lines'.
+        size (int): Image side in pixels.
+
+    Returns:
+        PIL.Image: Drawn image.
+    """
+    image = Image.new('RGB', (size, size), 'white')
+    draw = ImageDraw.Draw(image)
+    lo, hi, mid = size // 5, size - size // 5, size // 2
+    if shape == 'circle':
+        draw.ellipse([lo, lo, hi, hi], outline='black', width=4)
+    elif shape == 'square':
+        draw.rectangle([lo, lo, hi, hi], outline='black', width=4)
+    elif shape == 'triangle':
+        draw.polygon([(mid, lo), (hi, hi), (lo, hi)], outline='black', width=4)
+    elif shape == 'cross':
+        draw.line([(mid, lo), (mid, hi)], fill='black', width=4)
+        draw.line([(lo, mid), (hi, mid)], fill='black', width=4)
+    elif shape == 'lines':
+        for y in range(lo, hi + 1, (hi - lo) // 4):
+            draw.line([(lo, y), (hi, y)], fill='black', width=4)
+    else:
+        raise ValueError(f'Unknown shape: {shape}')
+    return image
+
+def benchmark_embed_model(model_name: str, quantization: str, fixture: dict) -> dict:
+    """
+    Measure the text retrieval accuracy and latency of an embedding model on CPU.
+
+    Args:
+        model_name (str): Hugging Face model name.
+        quantization (str): 'none' or 'int8'.
+        fixture (dict): Fixture set.
+
+    Returns:
+        dict: Load time, latency per query and top-1 accuracy, plus the query embeddings.
+    """
+    start = time.perf_counter()
+    embed_model = models.load_embed_model('cpu', model_name, quantization)
+    load_time = time.perf_counter() - start
+
+    passages = np.asarray(embed_model.get_text_embedding_batch(fixture['passages']))
+    passages /= np.linalg.norm(passages, axis=1, keepdims=True)
+
+    queries, latencies = [], []
+    for query in fixture['queries']:
+        start = time.perf_counter()
+        queries.append(embed_model.get_query_embedding(query['text']))
+        latencies.append(time.perf_counter() - start)
+    queries = np.asarray(queries)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    predictions = np.argmax(queries @ passages.T, axis=1)
+    accuracy = float(np.mean([prediction == query['passage'] for prediction, query in zip(predictions, fixture['queries'])]))
+    return {
+        'load_s': load_time,
+        'latency_ms': 1000 * float(np.median(latencies)),
+        'top1': accuracy,
+        'embeddings': queries
+    }
+
+def benchmark_clip_model(model_name: str, quantization: str, fixture: dict) -> dict:
+    """
+    Measure the text-to-image retrieval accuracy and latency of a CLIP model on CPU.
+
+    Args:
+        model_name (str): Hugging Face model name.
+        quantization (str): 'none' or 'int8'.
+        fixture (dict): Fixture set.
+
+    Returns:
+        dict: Load time, latency per image and top-1 accuracy, plus the image embeddings.
+    """
+    import torch
+
+    start = time.perf_counter()
+    model, processor = models.load_clip_model('cpu', model_name, quantization)
+    load_time = time.perf_counter() - start
+
+    images = [draw_shape(item['shape']) for item in fixture['images']]
+    texts = [item['text'] for item in fixture['images']]
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        image_features = model.get_image_features(**processor(images=images, return_tensors='pt'))
+        latency = (time.perf_counter() - start) / len(images)
+        text_features = model.get_text_features(**processor(text=texts, return_tensors='pt', padding=True))
+
+    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    predictions = torch.argmax(text_features @ image_features.T, dim=1)
+    accuracy = float((predictions == torch.arange(len(images))).float().mean())
+    return {
+        'load_s': load_time,
+        'latency_ms': 1000 * latency,
+        'top1': accuracy,
+        'embeddings': image_features.numpy()
+    }
+
+def agreement(embeddings: np.ndarray, reference: np.ndarray) -> float:
+    """
+    Mean cosine similarity between the embeddings of a quantized model and its fp32 version.
+
+    Args:
+        embeddings (np.ndarray): Normalized embeddings.
+        reference (np.ndarray): Normalized fp32 embeddings of the same inputs.
+
+    Returns:
+        float: Mean cosine similarity.
+    """
+    return float(np.mean(np.sum(embeddings * reference, axis=1)))
+
+def run_benchmark(embed_models: list, clip_models: list, quantizations: list, fixture: dict) -> list:
+    """
+    Compare the accuracy and latency of every model and quantization option.
+
+    Args:
+        embed_models (list): Embedding model names.
+        clip_models (list): CLIP model names.
+        quantizations (list): Quantization options.
+        fixture (dict): Fixture set.
+
+    Returns:
+        list: One result row per model and quantization.
+    """
+    rows = []
+    for kind, model_names, benchmark_fn in [('embed', embed_models, benchmark_embed_model), ('clip', clip_models, benchmark_clip_model)]:
+        for model_name in model_names:
+            reference = None
+            for quantization in sorted(quantizations, key=lambda q: q != 'none'):
+                print(f'Benchmarking {kind} {model_name} ({quantization})')
+                result = benchmark_fn(model_name, quantization, fixture)
+                embeddings = result.pop('embeddings')
+                if quantization == 'none':
+                    reference = embeddings
+                result['fp32_agreement'] = agreement(embeddings, reference) if reference is not None else None
+                rows.append(dict(kind=kind, model=model_name, quantization=quantization, **result))
+    return rows
+
+def print_results(rows: list) -> None:
+    """
+    Print the benchmark results as a table.
+
+    Args:
+        rows (list): Result rows from run_benchmark.
+    """
+    print(f"{'kind':<6} {'model':<40} {'quant':<6} {'load s':>7} {'latency ms':>11} {'top1':>5} {'fp32 agr.':>9}")
+    for row in rows:
+        agreement_str = f"{row['fp32_agreement']:.3f}" if row['fp32_agreement'] is not None else '-'
+        print(f"{row['kind']:<6} {row['model']:<40} {row['quantization']:<6} {row['load_s']:>7.1f} {row['latency_ms']:>11.1f} {row['top1']:>5.2f} {agreement_str:>9}")
+
+def measure_cold_start(module: str, repeats: int = 3) -> dict:
+    """
+    Measure the time to import a module in a fresh interpreter.
+
+    Args:
+        module (str): Module name.
+        repeats (int): Number of fresh interpreters, the median is reported.
+
+    Returns:
+        dict: Median import time in seconds, None if the import failed, and the error.
+    """
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    timings = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-c', code], cwd=SOURCE_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            return {'module': module, 'import_s': None, 'error': result.stderr.strip().splitlines()[-1]}
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return {'module': module, 'import_s': float(np.median(timings)), 'error': None}
+
+def print_cold_start(rows: list) -> None:
+    """
+    Print the cold start results as a table.
+
+    Args:
+        rows (list): Results of measure_cold_start.
+    """
+    print(f"{'module':<28} {'import s':>9}")
+    for row in rows:
+        import_str = f"{row['import_s']:>9.3f}" if row['import_s'] is not None else f"{'failed':>9} ({row['error']})"
+        print(f"{row['module']:<28} {import_str}")
+
+def synthetic_description(fixture: dict, size_mb: float, seed: int = 0) -> list:
+    """
+    Build an EPAB result with a description of a given size, made of numbered paragraphs of fixture passages.
+
+    Args:
+        fixture (dict): Fixture set.
+        size_mb (float): Approximate size of the description HTML in MB.
+        seed (int): Random seed.
+
+    Returns:
+        list: Claims and description in the format of get_results('claims, description', output_type='list').
+    """
+    rng = random.Random(seed)
+    headings = ['Field of the invention', 'Summary of the invention', 'Brief description of the drawings', 'Detailed description of the embodiments']
+    # Most of the text of a long publication is in the detailed description
+    weights = [0.02, 0.08, 0.05, 0.85]
+
+    parts, number = [], 1
+    for heading, weight in zip(headings, weights):
+        parts.append(f'<heading>{heading}</heading>')
+        size = 0
+        while size < weight * size_mb * 2**20:
+            paragraph = ' '.join(rng.choice(fixture['passages']) for _ in range(rng.randint(3, 10)))
+            parts.append(f'<p num="{number:04d}">{paragraph}</p>')
+            size += len(paragraph)
+            number += 1
+    return [{'description': {'text': ''.join(parts)}, 'claims': [{'text': fixture['passages'][0]}]}]
+
+def measure_memory(size_mb: float, budget_mb: float, embed_model: str, chunk_size: int, chunk_overlap: int, fixture_path: str = FIXTURE_PATH) -> dict:
+    """
+    Run the parse, chunk, embed and validation stages on a synthetic description and sample the peak RSS of each stage.
+
+    Run it in a fresh interpreter (see run_memory_benchmark), the peaks depend on what the process allocated before.
+
+    Args:
+        size_mb (float): Size of the description HTML in MB.
+        budget_mb (float): Memory budget, 0 for none.
+        embed_model (str): Hugging Face embedding model, loaded on CPU.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+        fixture_path (str): Path to the fixture JSON file.
+
+    Returns:
+        dict: Peak RSS in MB of each stage and of the process, and the duration in seconds.
+    """
+    import utilsEPO
+    import validation
+    from llama_index.core import Settings
+    from patent_data import PatentData
+    from portfolio_store import PortfolioStore
+    from RAG_pipeline import build_section_indices, setup_node_parser
+
+    fixture = load_fixture(fixture_path)
+    memory_budget.configure({'memory_budget_mb': budget_mb})
+    sampler = memory_budget.PeakRSSSampler()
+    start = time.perf_counter()
+
+    with sampler.stage('load'):
+        Settings.embed_model = models.load_embed_model('cpu', embed_model)
+        setup_node_parser(chunk_size, chunk_overlap)
+    memory_budget.end_stage('load')
+
+    with sampler.stage('parse'):
+        query = synthetic_description(fixture, size_mb)
+        sections, paragraph_numbers = utilsEPO.get_patent_info_from_description(query, with_paragraph_numbers=True)
+        del query
+        headings = {
+            'field_of_invention_text': 'field of the invention',
+            'summary_of_the_invention_text': 'summary of the invention',
+            'brief_description_of_the_drawings_text': 'brief description of the drawings',
+            'detailed_description_of_the_embodiments_text': 'detailed description of the embodiments'
+        }
+        data_patent = PatentData(
+            patent_number='BENCHMARK',
+            claim_number=1,
+            claim_text=fixture['passages'][0],
+            paragraph_numbers={section: paragraph_numbers[heading] for section, heading in headings.items()},
+            **{section: sections[heading] for section, heading in headings.items()}
+        )
+        del sections
+    memory_budget.end_stage('parse')
+
+    with sampler.stage('chunk'):
+        n_chunks = sum(len(data_patent.chunks(section, chunk_size, chunk_overlap)) for section in data_patent.sections())
+    memory_budget.end_stage('chunk')
+
+    # Every chunk is embedded, as when the sections are added to a portfolio store
+    with tempfile.TemporaryDirectory() as store_dir, sampler.stage('embed'):
+        indices = build_section_indices(None, data_patent, hybrid=True, store=PortfolioStore(store_dir), chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        del indices
+    memory_budget.end_stage('embed')
+
+    with sampler.stage('validate'):
+        validation.evaluate_patent_claim_summary(data_patent, ' '.join(fixture['passages'][:3]), chunk_size, chunk_overlap)
+    memory_budget.end_stage('validate')
+
+    return {
+        'budget_mb': budget_mb,
+        'chunks': n_chunks,
+        'stages': sampler.close(),
+        'peak_rss_mb': round(memory_budget.peak_rss_mb(), 1),
+        'seconds': round(time.perf_counter() - start, 1)
+    }
+
+def run_memory_benchmark(size_mb: float, budgets: list, embed_model: str, chunk_size: int, chunk_overlap: int, fixture_path: str = FIXTURE_PATH) -> list:
+    """
+    Measure the peak RSS per stage with and without memory budgets, each in a fresh interpreter.
+
+    Args:
+        size_mb (float): Size of the description HTML in MB.
+        budgets (list): Memory budgets in MB, 0 for none.
+        embed_model (str): Hugging Face embedding model.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+        fixture_path (str): Path to the fixture JSON file.
+
+    Returns:
+        list: Results of measure_memory, or the error of the failed runs.
+    """
+    rows = []
+    for budget_mb in budgets:
+        print(f'Measuring the memory of a {size_mb} MB description, budget {budget_mb or "none"}')
+        call = f'measure_memory({size_mb!r}, {budget_mb!r}, {embed_model!r}, {chunk_size!r}, {chunk_overlap!r}, {fixture_path!r})'
+        code = f'import json, benchmark; print(json.dumps(benchmark.{call}))'
+        result = subprocess.run([sys.executable, '-c', code], cwd=SOURCE_DIR, capture_output=True, text=True)
+        if result.returncode != 0:
+            rows.append({'budget_mb': budget_mb, 'error': result.stderr.strip().splitlines()[-1]})
+        else:
+            rows.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return rows
+
+def print_memory(rows: list) -> None:
+    """
+    Print the peak RSS per stage as a table.
+
+    Args:
+        rows (list): Results of run_memory_benchmark.
+    """
+    stages = ['load', 'parse', 'chunk', 'embed', 'validate']
+    print(f"{'budget MB':>9} {'chunks':>6} " + ' '.join(f'{stage + " MB":>11}' for stage in stages) + f" {'peak MB':>8} {'s':>6}")
+    for row in rows:
+        budget_str = f"{row['budget_mb']:>9.0f}" if row['budget_mb'] else f"{'none':>9}"
+        if 'error' in row:
+            print(f"{budget_str} failed ({row['error']})")
+            continue
+        peaks = ' '.join(f"{row['stages'].get(stage, 0.0):>11.1f}" for stage in stages)
+        print(f"{budget_str} {row['chunks']:>6} {peaks} {row['peak_rss_mb']:>8.1f} {row['seconds']:>6.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the cold start and compares the accuracy and CPU latency of the local model options.")
+    parser.add_argument("--embed_models", nargs='*', default=['BAAI/bge-m3', 'BAAI/bge-small-en-v1.5'], help="Embedding models to compare")
+    parser.add_argument("--clip_models", nargs='*', default=['openai/clip-vit-large-patch14', 'openai/clip-vit-base-patch32'], help="CLIP models to compare")
+    parser.add_argument("--quantization", nargs='*', default=['none', 'int8'], choices=['none', 'int8'], help="Quantization options to compare")
+    parser.add_argument("--torch_threads", type=int, default=0, help="Number of torch CPU threads, 0 keeps the default")
+    parser.add_argument("--fixture", default=FIXTURE_PATH, help="Path to the fixture JSON file")
+    parser.add_argument("--suites", nargs='*', default=['cold_start', 'models'], choices=['cold_start', 'models', 'memory'], help="Benchmarks to run")
+    parser.add_argument("--description_mb", type=float, default=2.0, help="Size of the synthetic description of the memory benchmark")
+    parser.add_argument("--memory_budgets", nargs='*', type=float, default=[0, 256], help="Memory budgets in MB compared by the memory benchmark, 0 for none")
+    parser.add_argument("--memory_embed_model", default='BAAI/bge-small-en-v1.5', help="Embedding model of the memory benchmark")
+    parser.add_argument("--chunk_size", type=int, default=1024, help="Maximum number of tokens of a chunk (memory)")
+    parser.add_argument("--chunk_overlap", type=int, default=128, help="Maximum number of tokens repeated from the previous chunk (memory)")
+    args = parser.parse_args()
+
+    if 'cold_start' in args.suites:
+        print_cold_start([measure_cold_start(module) for module in COLD_START_MODULES])
+    if 'models' in args.suites:
+        models.configure({'torch_threads': args.torch_threads})
+        print_results(run_benchmark(args.embed_models, args.clip_models, args.quantization, load_fixture(args.fixture)))
+    if 'memory' in args.suites:
+        print_memory(run_memory_benchmark(args.description_mb, args.memory_budgets, args.memory_embed_model, args.chunk_size, args.chunk_overlap, args.fixture))
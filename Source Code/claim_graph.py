@@ -0,0 +1,220 @@
+# Standard library imports
+import os
+import re
+import json
+import hashlib
+from typing import Dict, List
+
+CACHE_DIR = './cache/claim_graphs'
+
+# Bump when the reference parsing changes, to rebuild the persisted graphs
+CLAIM_GRAPH_VERSION = 1
+
+# "claim 1", "claims 1 to 3", "any one of claims 1-4", "claims 1, 2 and/or 5"
+REFERENCE_PATTERN = re.compile(r'\bclaims?\s+(\d+(?:\s*(?:,|-|–|to|or|and/or|and)\s*\d+)*)', re.IGNORECASE)
+RANGE_PATTERN = re.compile(r'(\d+)\s*(?:-|–|to)\s*(\d+)', re.IGNORECASE)
+# "any of the preceding claims", "one of the previous claims"
+PRECEDING_PATTERN = re.compile(r'\b(?:preceding|previous|foregoing)\s+claims?\b', re.IGNORECASE)
+
+def parse_claim_references(claim_text: str, claim_number: int) -> List[int]:
+    """
+    Find the claims a claim refers to.
+
+    Only earlier claims are kept, a claim can only depend on the claims before it.
+
+    Args:
+        claim_text (str): Text of the claim.
+        claim_number (int): Number of the claim.
+
+    Returns:
+        List[int]: Referenced claim numbers, in order of appearance.
+    """
+    if PRECEDING_PATTERN.search(claim_text):
+        return list(range(1, claim_number))
+
+    references = []
+    for match in REFERENCE_PATTERN.finditer(claim_text):
+        group = match.group(1)
+        for start, end in RANGE_PATTERN.findall(group):
+            references.extend(range(int(start), int(end) + 1))
+        references.extend(int(number) for number in re.findall(r'\d+', RANGE_PATTERN.sub(' ', group)))
+    return list(dict.fromkeys(number for number in references if 1 <= number < claim_number))
+
+class ClaimGraph:
+    """
+    Dependency graph of the claims of a patent.
+
+    Nodes are claims and edges go from a claim to the claims it refers to.
+    Claims without references are the independent roots. The ancestors,
+    descendants and roots of every claim are computed once, so queries are
+    dictionary lookups.
+    """
+
+    def __init__(self, parents: Dict[int, List[int]]):
+        """
+        Build the graph and its closures.
+
+        Args:
+            parents (Dict[int, List[int]]): Claims referred to by each claim, keyed by claim number.
+        """
+        self.parents = {claim: list(references) for claim, references in sorted(parents.items())}
+        self.roots = [claim for claim, references in self.parents.items() if not references]
+
+        # Claims only refer to earlier claims, so increasing numbers are a topological order
+        self._ancestors = {}
+        for claim, references in self.parents.items():
+            ancestors = []
+            for reference in references:
+                for ancestor in [reference] + self._ancestors.get(reference, []):
+                    if ancestor not in ancestors:
+                        ancestors.append(ancestor)
+            self._ancestors[claim] = ancestors
+
+        self._descendants = {claim: [] for claim in self.parents}
+        for claim, ancestors in self._ancestors.items():
+            for ancestor in ancestors:
+                if ancestor in self._descendants:
+                    self._descendants[ancestor].append(claim)
+
+        self._claim_roots = {
+            claim: [ancestor for ancestor in [claim] + self._ancestors[claim] if not self.parents.get(ancestor)]
+            for claim in self.parents
+        }
+
+    @classmethod
+    def from_claims(cls, claim_texts: Dict[int, str]) -> 'ClaimGraph':
+        """
+        Build the graph from the claim texts.
+
+        Args:
+            claim_texts (Dict[int, str]): Text of each claim, keyed by claim number.
+
+        Returns:
+            ClaimGraph: Graph of the claims.
+        """
+        return cls({claim: parse_claim_references(text, claim) for claim, text in claim_texts.items()})
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def ancestors(self, claim: int) -> List[int]:
+        """
+        Get every claim a claim depends on, directly or through other claims.
+
+        Args:
+            claim (int): Claim number.
+
+        Returns:
+            List[int]: Ancestors, each direct reference followed by its own ancestors.
+        """
+        return self._ancestors.get(claim, [])
+
+    def descendants(self, claim: int) -> List[int]:
+        """
+        Get every claim depending on a claim, directly or through other claims.
+
+        Args:
+            claim (int): Claim number.
+
+        Returns:
+            List[int]: Descendants, in increasing order.
+        """
+        return self._descendants.get(claim, [])
+
+    def claim_roots(self, claim: int) -> List[int]:
+        """
+        Get the independent claims a claim belongs to.
+
+        Args:
+            claim (int): Claim number.
+
+        Returns:
+            List[int]: Independent claims, the claim itself if it is independent.
+        """
+        return self._claim_roots.get(claim, [claim])
+
+    def is_independent(self, claim: int) -> bool:
+        """
+        Check whether a claim refers to no other claim.
+
+        Args:
+            claim (int): Claim number.
+
+        Returns:
+            bool: True for an independent claim.
+        """
+        return not self.parents.get(claim)
+
+    def order(self, claims: List[int]) -> List[int]:
+        """
+        Order claims tree by tree: each independent claim followed by the claims depending on it.
+
+        Args:
+            claims (List[int]): Claim numbers.
+
+        Returns:
+            List[int]: The same claims, ancestors before descendants.
+        """
+        return sorted(dict.fromkeys(claims), key=lambda claim: (min(self.claim_roots(claim)), claim))
+
+    def to_dict(self) -> dict:
+        """
+        Convert to a dict of plain values for serialization.
+
+        Returns:
+            dict: References of each claim, keyed by claim number as a string.
+        """
+        return {str(claim): references for claim, references in self.parents.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ClaimGraph':
+        """
+        Rebuild from to_dict output.
+
+        Args:
+            data (dict): Output of to_dict.
+
+        Returns:
+            ClaimGraph: Rebuilt graph.
+        """
+        return cls({int(claim): references for claim, references in data.items()})
+
+def claims_hash(claim_texts: Dict[int, str]) -> str:
+    """
+    Hash the claim texts, so a republished patent with amended claims gets a new graph.
+
+    Args:
+        claim_texts (Dict[int, str]): Text of each claim, keyed by claim number.
+
+    Returns:
+        str: SHA-1 hex digest of the claims and of the graph version.
+    """
+    digest = hashlib.sha1(str(CLAIM_GRAPH_VERSION).encode('utf-8'))
+    for claim, text in sorted(claim_texts.items()):
+        digest.update(f'{claim}\0{text}\0'.encode('utf-8'))
+    return digest.hexdigest()
+
+def get_claim_graph(patent_number: str, claim_texts: Dict[int, str], cache_dir: str = CACHE_DIR) -> ClaimGraph:
+    """
+    Get the claim graph of a patent, building it only once.
+
+    Args:
+        patent_number (str): Publication number of the patent.
+        claim_texts (Dict[int, str]): Text of each claim, keyed by claim number.
+        cache_dir (str): Directory of the persisted graphs, keyed by patent number and claims hash.
+
+    Returns:
+        ClaimGraph: Graph of the claims.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f'{re.sub(r"[^A-Za-z0-9]+", "_", patent_number)}_{claims_hash(claim_texts)[:16]}.json')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            return ClaimGraph.from_dict(json.load(f))
+
+    graph = ClaimGraph.from_claims(claim_texts)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(graph.to_dict(), f)
+    os.replace(tmp_path, cache_path)
+    return graph
@@ -0,0 +1,94 @@
+# Standard library imports
+import os
+import threading
+from functools import lru_cache
+
+thread_config = {
+    'num_threads': None,
+    'interop_threads': None
+}
+_configure_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def probe_gpu() -> float:
+    """
+    Probe the free memory of the first GPU once per process.
+
+    Hosts without a GPU, without the NVIDIA driver or without a CUDA build
+    of torch report no free memory instead of raising.
+
+    Returns:
+        float: Free GPU memory in GB, 0.0 if no usable GPU.
+    """
+    import torch
+    if not torch.cuda.is_available():
+        print('No CUDA device available')
+        return 0.0
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            info = pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(0))
+        finally:
+            pynvml.nvmlShutdown()
+    except Exception as e:
+        # ImportError or NVMLError (driver not loaded, no device)
+        print(f'NVML not available ({e}), falling back to CPU')
+        return 0.0
+    return info.free * 1e-9  # Convert bytes to GB
+
+def get_device(min_memory: float = 5) -> str:
+    """
+    Select the device of the local models.
+
+    Args:
+        min_memory (float): Minimum free GPU memory in GB to use the GPU.
+
+    Returns:
+        str: 'cuda' if the GPU had enough free memory when probed, 'cpu' otherwise.
+    """
+    return 'cuda' if probe_gpu() > min_memory else 'cpu'
+
+def available_cores() -> list:
+    """
+    List the cores the process may run on, honouring the CPU affinity of containers.
+
+    Returns:
+        list: Core ids.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def configure_threads(num_threads: int = 0, interop_threads: int = 0) -> dict:
+    """
+    Set the torch thread pools for the available cores.
+
+    The inter-op pool can only be sized once per process, before torch runs
+    any parallel work, so the first call wins.
+
+    Args:
+        num_threads (int): Intra-op threads, 0 to use the available cores.
+        interop_threads (int): Inter-op threads, 0 to pick from the available cores.
+
+    Returns:
+        dict: Thread configuration in use.
+    """
+    import torch
+
+    with _configure_lock:
+        cores = available_cores()
+        num_threads = int(num_threads or 0) or len(cores)
+        if num_threads != thread_config['num_threads']:
+            torch.set_num_threads(num_threads)
+            thread_config['num_threads'] = num_threads
+
+        if thread_config['interop_threads'] is None:
+            interop_threads = int(interop_threads or 0) or max(1, min(4, len(cores) // 4))
+            try:
+                torch.set_interop_threads(interop_threads)
+                thread_config['interop_threads'] = interop_threads
+            except RuntimeError:
+                # Torch already started inter-op work
+                thread_config['interop_threads'] = torch.get_num_interop_threads()
+    return thread_config
@@ -0,0 +1,378 @@
+# Standard library imports
+import os
+import re
+import json
+import time
+import asyncio
+import argparse
+import threading
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+# EPAB fetch configuration, overridden by configure()
+fetch_config = {
+    'epab_mock_dir': '',
+    'epab_fetch_workers': 4,
+    'epab_prefetch': 2
+}
+
+# Drawing files of the mock backend, in sheet order
+DRAWING_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif')
+
+def configure(args: dict) -> dict:
+    """
+    Set the EPAB backend, the fetch threads and the prefetch depth from the configuration.
+
+    Args:
+        args (dict): Configuration parameters. Missing keys keep their defaults.
+
+    Returns:
+        dict: Fetch configuration in use.
+    """
+    for key in fetch_config:
+        if args.get(key) is not None:
+            fetch_config[key] = args[key]
+    return fetch_config
+
+class MockEPABQuery:
+    """
+    Query of a single publication in a MockEPABClient, mirroring the EPAB query results used by the pipeline.
+    """
+
+    def __init__(self, directory: str, latency: float = 0.0):
+        """
+        Args:
+            directory (str): Directory of the publication.
+            latency (float): Seconds each request waits, to simulate the network.
+        """
+        self.directory = directory
+        self.latency = latency
+
+    def get_results(self, fields: str, output_type: str = 'list') -> list:
+        """
+        Get the claims and the description of the publication.
+
+        Args:
+            fields (str): Requested fields, e.g. 'claims, description'.
+            output_type (str): Only 'list' is supported.
+
+        Returns:
+            list: One result with the requested 'claims' and 'description' fields.
+        """
+        if output_type != 'list':
+            raise ValueError(f"The mock EPAB backend only returns lists, not {output_type}")
+        time.sleep(self.latency)
+        with open(os.path.join(self.directory, 'document.json'), 'r') as f:
+            document = json.load(f)
+        result = {}
+        requested = {field.strip() for field in fields.split(',')}
+        if 'claims' in requested:
+            result['claims'] = [{'text': document['claims']}]
+        if 'description' in requested:
+            result['description'] = {'text': document['description']}
+        return [result]
+
+    def get_drawings(self, output_type: str = 'list') -> list:
+        """
+        Get the drawing sheets of the publication.
+
+        Args:
+            output_type (str): Only 'list' is supported.
+
+        Returns:
+            list: One result whose 'attachment' holds the raw bytes of each sheet.
+        """
+        if output_type != 'list':
+            raise ValueError(f"The mock EPAB backend only returns lists, not {output_type}")
+        time.sleep(self.latency)
+        drawings_dir = os.path.join(self.directory, 'drawings')
+        names = sorted(name for name in os.listdir(drawings_dir) if name.lower().endswith(DRAWING_EXTENSIONS)) if os.path.isdir(drawings_dir) else []
+        attachments = []
+        for name in names:
+            with open(os.path.join(drawings_dir, name), 'rb') as f:
+                attachments.append({'name': name, 'content': f.read()})
+        return [{'attachment': attachments}]
+
+class MockEPABClient:
+    """
+    Local EPAB backend for development and tests, reading publications from a directory.
+
+    Each publication is a directory named after its number with a
+    document.json file holding the 'claims' and 'description' XML, and an
+    optional drawings/ directory with one image per sheet.
+    """
+
+    def __init__(self, root: str, latency: float = 0.0):
+        """
+        Args:
+            root (str): Directory of the publications.
+            latency (float): Seconds each request waits, to simulate the network.
+        """
+        self.root = root
+        self.latency = latency
+
+    def query_epab_doc_id(self, patent_number: str) -> MockEPABQuery:
+        """
+        Query a publication.
+
+        Args:
+            patent_number (str): Publication number.
+
+        Returns:
+            MockEPABQuery: Query of the publication.
+
+        Raises:
+            ValueError: If the publication is not in the mock directory.
+        """
+        directory = os.path.join(self.root, patent_number)
+        if not os.path.isdir(directory):
+            raise ValueError(f'Publication {patent_number} not found in the mock EPAB backend {self.root}')
+        return MockEPABQuery(directory, self.latency)
+
+    @staticmethod
+    def clean_text(text: str) -> str:
+        """
+        Remove the XML tags of a text and normalize its whitespace.
+
+        Args:
+            text (str): Text with XML tags.
+
+        Returns:
+            str: Plain text.
+        """
+        return re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', ' ', text)).strip()
+
+def write_mock_patent(root: str, patent_number: str, claims: str, description: str, drawings: Optional[List[bytes]] = None) -> str:
+    """
+    Add a publication to a mock EPAB backend directory.
+
+    Args:
+        root (str): Directory of the publications.
+        patent_number (str): Publication number.
+        claims (str): Claims XML, as returned by EPAB.
+        description (str): Description XML, as returned by EPAB.
+        drawings (List[bytes], optional): Encoded image of each drawing sheet.
+
+    Returns:
+        str: Directory of the publication.
+    """
+    directory = os.path.join(root, patent_number)
+    os.makedirs(os.path.join(directory, 'drawings'), exist_ok=True)
+    with open(os.path.join(directory, 'document.json'), 'w') as f:
+        json.dump({'claims': claims, 'description': description}, f)
+    for idx, drawing in enumerate(drawings or []):
+        with open(os.path.join(directory, 'drawings', f'{idx:04d}.png'), 'wb') as f:
+            f.write(drawing)
+    return directory
+
+@lru_cache(maxsize=None)
+def get_client(mock_dir: str = ''):
+    """
+    Get the EPAB client, created on first use.
+
+    Args:
+        mock_dir (str): Directory of a mock backend, the production EPAB if empty.
+
+    Returns:
+        EPABClient or MockEPABClient: EPAB client.
+    """
+    if mock_dir:
+        return MockEPABClient(mock_dir)
+    from epo.tipdata.epab import EPABClient
+    return EPABClient(env='PROD')
+
+class FetchedPatent:
+    """
+    Requests of one publication in flight: claims and description, and the drawings.
+    """
+
+    def __init__(self, patent_number: str, texts: Future, drawings: Optional[Future]):
+        """
+        Args:
+            patent_number (str): Publication number.
+            texts (Future): Result of get_results('claims, description').
+            drawings (Future, optional): Raw bytes of the drawing sheets, None if not requested.
+        """
+        self.patent_number = patent_number
+        self.texts = texts
+        self.drawings = drawings
+
+    def claims_description(self) -> list:
+        """
+        Wait for the claims and the description.
+
+        Returns:
+            list: Result of get_results('claims, description', output_type='list').
+        """
+        return self.texts.result()
+
+    def attachments(self) -> Optional[List[bytes]]:
+        """
+        Wait for the drawings.
+
+        Returns:
+            List[bytes] or None: Raw bytes of each sheet, None if the drawings were not requested.
+        """
+        return self.drawings.result() if self.drawings is not None else None
+
+    def cancel(self) -> None:
+        """
+        Cancel the requests if they have not started yet.
+        """
+        # The drawings are requested by the texts task, they are not started if it is cancelled
+        if self.texts.cancel() and self.drawings is not None:
+            self.drawings.cancel()
+
+class EPABFetcher:
+    """
+    Fetch layer running the EPAB requests in a thread pool.
+
+    The claims and description request and the drawings request of a
+    publication run at the same time, and the next publications of a batch
+    can be prefetched while the current one is processed. The drawings are
+    kept as raw bytes, without building a DataFrame.
+    """
+
+    def __init__(self, client, max_workers: int = 4, prefetch: int = 2):
+        """
+        Args:
+            client: EPAB client, or MockEPABClient.
+            max_workers (int): Number of requests run at the same time.
+            prefetch (int): Maximum number of publications fetched ahead.
+        """
+        self.client = client
+        self.prefetch_depth = prefetch
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='epab')
+        self._pending: Dict[str, FetchedPatent] = {}
+        self._lock = threading.Lock()
+
+    def _fetch_drawings(self, query) -> List[bytes]:
+        result = query.get_drawings(output_type='list')
+        if not result:
+            return []
+        return [attachment['content'] for attachment in result[0].get('attachment') or []]
+
+    def _start(self, patent_number: str, drawings: bool) -> FetchedPatent:
+        """
+        Start the requests of a publication.
+
+        Args:
+            patent_number (str): Publication number.
+            drawings (bool): Whether to fetch the drawings.
+
+        Returns:
+            FetchedPatent: Requests in flight.
+        """
+        drawings_future = Future() if drawings else None
+
+        def fetch_texts():
+            try:
+                query = self.client.query_epab_doc_id(patent_number)
+            except BaseException as e:
+                if drawings_future is not None:
+                    drawings_future.set_exception(e)
+                raise
+            if drawings_future is not None:
+                # The drawings are requested before the texts so both run at the same time
+                inner = self._executor.submit(self._fetch_drawings, query)
+                inner.add_done_callback(lambda done: drawings_future.set_exception(done.exception()) if done.exception() else drawings_future.set_result(done.result()))
+            return query.get_results('claims, description', output_type='list')
+
+        return FetchedPatent(patent_number, self._executor.submit(fetch_texts), drawings_future)
+
+    def fetch(self, patent_number: str, drawings: bool = True) -> FetchedPatent:
+        """
+        Get the requests of a publication, started by prefetch or now.
+
+        Args:
+            patent_number (str): Publication number.
+            drawings (bool): Whether the drawings are needed.
+
+        Returns:
+            FetchedPatent: Requests in flight or done.
+        """
+        with self._lock:
+            fetched = self._pending.pop(patent_number, None)
+        if fetched is None or (drawings and fetched.drawings is None):
+            fetched = self._start(patent_number, drawings)
+        return fetched
+
+    def prefetch(self, patent_numbers: Iterable[str], drawings: bool = True, current: Optional[str] = None) -> None:
+        """
+        Start fetching the next publications of a batch, up to the prefetch depth.
+
+        Prefetched publications that are no longer upcoming, taken by another
+        worker or served from the stage cache, are dropped.
+
+        Args:
+            patent_numbers (Iterable[str]): Upcoming publication numbers, in processing order.
+            drawings (bool): Whether to fetch the drawings.
+            current (str, optional): Publication being processed, kept if it was prefetched.
+        """
+        upcoming = [patent_number for patent_number in dict.fromkeys(patent_numbers) if patent_number != current][:self.prefetch_depth]
+        with self._lock:
+            for patent_number in list(self._pending):
+                if patent_number != current and patent_number not in upcoming:
+                    self._pending.pop(patent_number).cancel()
+            for patent_number in upcoming:
+                if patent_number not in self._pending:
+                    self._pending[patent_number] = self._start(patent_number, drawings)
+
+    async def fetch_async(self, patent_number: str, drawings: bool = True) -> tuple:
+        """
+        Fetch a publication from asyncio code.
+
+        Args:
+            patent_number (str): Publication number.
+            drawings (bool): Whether to fetch the drawings.
+
+        Returns:
+            tuple: Claims and description result, and the raw drawings (None if not requested).
+        """
+        fetched = self.fetch(patent_number, drawings)
+        futures = [asyncio.wrap_future(fetched.texts)]
+        if fetched.drawings is not None:
+            futures.append(asyncio.wrap_future(fetched.drawings))
+        results = await asyncio.gather(*futures)
+        return results[0], results[1] if len(results) > 1 else None
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+def get_fetcher() -> EPABFetcher:
+    """
+    Get the fetcher of the configured backend, one per process.
+
+    The thread pool of a parent process is not usable in forked workers, so
+    each process creates its own.
+
+    Returns:
+        EPABFetcher: Fetcher.
+    """
+    key = (os.getpid(), fetch_config['epab_mock_dir'] or '', int(fetch_config['epab_fetch_workers']), int(fetch_config['epab_prefetch']))
+    with _fetchers_lock:
+        if key not in _fetchers:
+            _fetchers[key] = EPABFetcher(get_client(key[1]), max_workers=key[2], prefetch=key[3])
+        return _fetchers[key]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetches publications from EPAB or a mock backend, prefetching the next ones.")
+    parser.add_argument("patent_numbers", nargs='+', help="Publication numbers")
+    parser.add_argument("--mock_dir", default='', help="Directory of a mock EPAB backend")
+    parser.add_argument("--mock_latency", type=float, default=0.0, help="Seconds each mock request waits")
+    parser.add_argument("--workers", type=int, default=4, help="Number of requests run at the same time")
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of publications fetched ahead")
+    parser.add_argument("--no_drawings", action='store_true', help="Do not fetch the drawings")
+    args = parser.parse_args()
+
+    client = MockEPABClient(args.mock_dir, args.mock_latency) if args.mock_dir else get_client()
+    fetcher = EPABFetcher(client, max_workers=args.workers, prefetch=args.prefetch)
+    start = time.perf_counter()
+    for idx, patent_number in enumerate(args.patent_numbers):
+        fetched = fetcher.fetch(patent_number, drawings=not args.no_drawings)
+        fetcher.prefetch(args.patent_numbers[idx + 1:], drawings=not args.no_drawings)
+        texts = fetched.claims_description()
+        attachments = fetched.attachments()
+        description = texts[0].get('description', {}).get('text', '') if texts else ''
+        print(f"{patent_number}: {len(description)} description characters, {len(attachments or [])} drawings, {time.perf_counter() - start:.2f} s")
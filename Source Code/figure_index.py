@@ -0,0 +1,180 @@
+# Standard library imports
+import re
+from collections import defaultdict
+
+# "FIG. 3", "Figs. 3 and 4", "Figures 5A-5C", "FIG. 2 to 4"
+FIGURE_MENTION_PATTERN = re.compile(
+    r'\bfig(?:ure)?s?\.?\s*((?:\d+[a-z]?(?:\s*(?:,|and|or|to|-|–)\s*)?)+)',
+    re.IGNORECASE
+)
+FIGURE_ID_PATTERN = re.compile(r'(\d+)([a-z]?)', re.IGNORECASE)
+
+# Reference numerals follow a word ("housing 12", "the arm 14a") and are not quantities
+REFERENCE_NUMERAL_PATTERN = re.compile(
+    r"(?<=[a-z] )(\d{1,4}[a-z]?'?)(?![\d.,]\d)(?!\s*(?:mm|cm|m|µm|nm|%|°|degrees?|kg|g|ml|l|s|v|w|hz|k)\b)",
+    re.IGNORECASE
+)
+
+def _figure_key(figure_id):
+    """
+    Sort key of a figure id such as '5A'.
+
+    Args:
+        figure_id (str): Figure id.
+
+    Returns:
+        tuple: Figure number and letter.
+    """
+    match = FIGURE_ID_PATTERN.fullmatch(figure_id)
+    return (int(match.group(1)), match.group(2)) if match else (0, figure_id)
+
+def extract_figure_ids(text):
+    """
+    Extract the figure ids mentioned in a text, expanding ranges.
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        list: Figure ids (e.g. '3', '5A') in order of appearance, without duplicates.
+    """
+    figure_ids = []
+    for mention in FIGURE_MENTION_PATTERN.finditer(text):
+        group = mention.group(1)
+        ids = [(int(number), letter.upper()) for number, letter in FIGURE_ID_PATTERN.findall(group)]
+        is_range = re.search(r'\d[a-z]?\s*(?:to|-|–)\s*\d', group, re.IGNORECASE)
+        if is_range and len(ids) == 2 and ids[0][0] == ids[1][0] and ids[0][1] and ids[1][1]:
+            # Letter range: 5A-5C
+            expanded = [f'{ids[0][0]}{chr(c)}' for c in range(ord(ids[0][1]), ord(ids[1][1]) + 1)]
+        elif is_range and len(ids) == 2 and ids[0][0] < ids[1][0] and not ids[0][1] and not ids[1][1]:
+            # Number range: 2 to 4
+            expanded = [str(n) for n in range(ids[0][0], ids[1][0] + 1)]
+        else:
+            expanded = [f'{number}{letter}' for number, letter in ids]
+        for figure_id in expanded:
+            if figure_id not in figure_ids:
+                figure_ids.append(figure_id)
+    return figure_ids
+
+def normalize_reference(reference):
+    """
+    Normalize a reference numeral so LLM references and description numerals compare equal.
+
+    Args:
+        reference (str or int): Reference numeral.
+
+    Returns:
+        str: Normalized numeral.
+    """
+    return str(reference).strip().lower().rstrip("'")
+
+def build_reference_index(brief_description_text, detailed_description_text):
+    """
+    Map each reference numeral to the figures showing it.
+
+    Every sentence mentioning figures sets the current figures; the numerals of
+    that sentence and of the following ones are linked to them until another
+    figure is mentioned.
+
+    Args:
+        brief_description_text (str): Brief description of the drawings.
+        detailed_description_text (str): Detailed description of the embodiments.
+
+    Returns:
+        dict: 'numerals' maps a numeral to its sorted figure ids and 'figures' lists every figure id.
+    """
+    text = ' '.join(part for part in [brief_description_text, detailed_description_text] if part)
+    numerals = defaultdict(set)
+    current_figures = []
+
+    # Sentences, also split when the extraction glued paragraphs together ("12.FIG. 3")
+    for sentence in re.split(r'(?<=[.;:])\s*(?=[A-Z])', text):
+        figure_ids = extract_figure_ids(sentence)
+        if figure_ids:
+            current_figures = figure_ids
+        if not current_figures:
+            continue
+        sentence_without_figures = FIGURE_MENTION_PATTERN.sub(' ', sentence)
+        for numeral in REFERENCE_NUMERAL_PATTERN.findall(sentence_without_figures):
+            numerals[normalize_reference(numeral)].update(current_figures)
+
+    # The brief description lists every figure, fall back to all mentions otherwise
+    figures = extract_figure_ids(brief_description_text or '') or extract_figure_ids(text)
+    return {
+        'numerals': {numeral: sorted(figure_ids, key=_figure_key) for numeral, figure_ids in numerals.items()},
+        'figures': sorted(figures, key=_figure_key)
+    }
+
+def map_figures_to_sheets(figure_ids, n_sheets, sheet_labels=None):
+    """
+    Find the drawing sheet of each figure.
+
+    Figures whose caption was read on a sheet (see sheet_labels.py) use that
+    sheet. The others are spread over the sheets in order: one per sheet when
+    the counts match, proportionally otherwise.
+
+    Args:
+        figure_ids (list): Sorted figure ids.
+        n_sheets (int): Number of drawing sheets.
+        sheet_labels (list, optional): Figures and numerals read on each sheet.
+
+    Returns:
+        dict: Sheet index of each figure id.
+    """
+    if n_sheets < 1:
+        return {}
+    figure_to_sheet = {}
+    for sheet, labels in enumerate(sheet_labels or []):
+        for figure_id in labels['figures']:
+            figure_to_sheet.setdefault(figure_id, sheet)
+
+    figure_ids = figure_ids or []
+    for rank, figure_id in enumerate(figure_ids):
+        figure_to_sheet.setdefault(figure_id, min(n_sheets - 1, rank * n_sheets // len(figure_ids)))
+    return figure_to_sheet
+
+def build_sheet_index(sheet_labels):
+    """
+    Build an inverted index from the numerals read on the drawing sheets.
+
+    Args:
+        sheet_labels (list): Figures and numerals read on each sheet.
+
+    Returns:
+        dict: Sheet indices of each numeral.
+    """
+    sheet_index = defaultdict(set)
+    for sheet, labels in enumerate(sheet_labels or []):
+        for numeral in labels['numerals']:
+            sheet_index[normalize_reference(numeral)].add(sheet)
+    return dict(sheet_index)
+
+def sheet_coverage(references, reference_index, figure_to_sheet, sheet_labels=None):
+    """
+    Count the referenced numerals shown on each drawing sheet.
+
+    A numeral is shown on a sheet when it was read on the sheet or when the
+    description links it to a figure of the sheet.
+
+    Args:
+        references (dict or list): References returned by the LLM (numeral -> label) or numerals.
+        reference_index (dict, optional): Index from build_reference_index.
+        figure_to_sheet (dict): Sheet index of each figure id.
+        sheet_labels (list, optional): Figures and numerals read on each sheet.
+
+    Returns:
+        dict: Number of covered numerals per sheet index, only for sheets covering at least one.
+    """
+    sheet_index = build_sheet_index(sheet_labels)
+    numerals_index = reference_index['numerals'] if reference_index else {}
+
+    coverage = defaultdict(set)
+    for reference in references or []:
+        numeral = normalize_reference(reference)
+        for sheet in sheet_index.get(numeral, []):
+            coverage[sheet].add(numeral)
+        for figure_id in numerals_index.get(numeral, []):
+            sheet = figure_to_sheet.get(figure_id)
+            if sheet is not None:
+                coverage[sheet].add(numeral)
+    return {sheet: len(numerals) for sheet, numerals in coverage.items()}
@@ -0,0 +1,233 @@
+# Standard library imports
+import os
+import re
+import math
+import threading
+from collections import Counter, defaultdict
+from typing import List, Optional
+
+# Third-party library imports
+import numpy as np
+from llama_index.core import Document, Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, BaseNode
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tokenize text for the BM25 index. Numbers are kept so reference numerals match exactly.
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        List[str]: Lowercase word and number tokens.
+    """
+    return re.findall(r'\w+', text.lower())
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over a list of texts.
+    """
+
+    def __init__(self, texts: List[str], k1: float = 1.5, b: float = 0.75):
+        """
+        Build the inverted index.
+
+        Args:
+            texts (List[str]): Texts to index.
+            k1 (float): Term frequency saturation parameter.
+            b (float): Length normalization parameter.
+        """
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.doc_lengths = []
+
+        for doc_idx, text in enumerate(texts):
+            term_counts = Counter(tokenize(text))
+            self.doc_lengths.append(sum(term_counts.values()))
+            for term, tf in term_counts.items():
+                self.postings[term].append((doc_idx, tf))
+
+        n_docs = len(texts)
+        self.avg_length = (sum(self.doc_lengths) / n_docs) if n_docs else 0.0
+        self.idf = {
+            term: math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def search(self, query: str, top_k: Optional[int] = None) -> List[tuple]:
+        """
+        Score the indexed texts against a query.
+
+        Args:
+            query (str): Query text.
+            top_k (int, optional): Number of results to return. All matches if None.
+
+        Returns:
+            List[tuple]: (text index, score) pairs sorted by decreasing score.
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_idx, tf in self.postings[term]:
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_idx] / self.avg_length
+                scores[doc_idx] += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k] if top_k is not None else ranked
+
+class HybridNodeWithScore(NodeWithScore):
+    """
+    Node retrieved by a HybridRetriever, with its dense similarity next to the fused score.
+
+    The BM25 part of the fused score is normalized per index, so only the
+    dense similarity compares with the chunks of other indices.
+    """
+    dense_score: Optional[float] = None
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever fusing BM25 and dense similarity scores.
+
+    BM25 pre-filters the candidates and dense scoring only runs on them, so
+    chunk embeddings are computed lazily and only for candidate chunks.
+    """
+
+    def __init__(self, index: 'HybridIndex', similarity_top_k: int = 2, candidate_k: int = 20, alpha: float = 0.5):
+        """
+        Initialize the retriever.
+
+        Args:
+            index (HybridIndex): Index to retrieve from.
+            similarity_top_k (int): Number of nodes to return.
+            candidate_k (int): Number of BM25 candidates scored with the dense model.
+            alpha (float): Weight of the dense score in the fused score.
+        """
+        super().__init__()
+        self.index = index
+        self.similarity_top_k = similarity_top_k
+        self.candidate_k = candidate_k
+        self.alpha = alpha
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Retrieve the nodes with the highest fused score.
+
+        Args:
+            query_bundle (QueryBundle): Query.
+
+        Returns:
+            List[HybridNodeWithScore]: Retrieved nodes with fused and dense scores.
+        """
+        bm25_results = self.index.bm25.search(query_bundle.query_str, top_k=self.candidate_k)
+
+        # Without any lexical match every node is a candidate
+        if not bm25_results:
+            bm25_results = [(idx, 0.0) for idx in range(len(self.index.nodes))]
+        max_bm25 = max(score for _, score in bm25_results) or 1.0
+
+        candidates = [idx for idx, _ in bm25_results]
+        node_embeddings = self.index.get_embeddings(candidates)
+        query_embedding = np.asarray(Settings.embed_model.get_query_embedding(query_bundle.query_str))
+        query_embedding = query_embedding / (np.linalg.norm(query_embedding) or 1.0)
+        dense_scores = node_embeddings @ query_embedding
+
+        results = []
+        for (idx, bm25_score), dense_score in zip(bm25_results, dense_scores):
+            score = self.alpha * float(dense_score) + (1 - self.alpha) * bm25_score / max_bm25
+            results.append(HybridNodeWithScore(node=self.index.nodes[idx], score=score, dense_score=float(dense_score)))
+
+        results.sort(key=lambda result: result.score, reverse=True)
+        return results[:self.similarity_top_k]
+
+class HybridIndex:
+    """
+    Section index combining a BM25 inverted index and lazily computed dense embeddings.
+    """
+
+    def __init__(self, nodes: List[BaseNode]):
+        """
+        Build the BM25 index over the nodes.
+
+        Args:
+            nodes (List[BaseNode]): Chunks of a patent section.
+        """
+        self.nodes = nodes
+        self.bm25 = BM25Index([node.get_content() for node in nodes])
+        self._embeddings = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_documents(cls, documents: List[Document]) -> 'HybridIndex':
+        """
+        Build the index from documents using the global node parser.
+
+        Args:
+            documents (List[Document]): Documents to index.
+
+        Returns:
+            HybridIndex: Built index.
+        """
+        return cls(Settings.node_parser.get_nodes_from_documents(documents))
+
+    def get_embeddings(self, node_indices: List[int]) -> np.ndarray:
+        """
+        Get the normalized embeddings of some nodes, computing the missing ones.
+
+        Args:
+            node_indices (List[int]): Indices of the nodes.
+
+        Returns:
+            np.ndarray: Normalized embeddings, one row per node.
+        """
+        with self._lock:
+            missing = [idx for idx in node_indices if idx not in self._embeddings]
+            if missing:
+                texts = [self.nodes[idx].get_content() for idx in missing]
+                for idx, embedding in zip(missing, Settings.embed_model.get_text_embedding_batch(texts)):
+                    embedding = np.asarray(embedding)
+                    self._embeddings[idx] = embedding / (np.linalg.norm(embedding) or 1.0)
+            return np.stack([self._embeddings[idx] for idx in node_indices])
+
+    def spill(self, path: str) -> int:
+        """
+        Move the computed embeddings to a memory-mapped file, to stay within a memory budget.
+
+        Embeddings computed later are kept in memory until the next spill.
+
+        Args:
+            path (str): Path to the .npy file to write.
+
+        Returns:
+            int: Number of embeddings spilled.
+        """
+        with self._lock:
+            in_memory = [idx for idx, embedding in self._embeddings.items() if not isinstance(embedding, np.memmap)]
+            if not in_memory:
+                return 0
+            np.save(path, np.stack([self._embeddings[idx] for idx in in_memory]))
+            spilled = np.load(path, mmap_mode='r')
+            try:
+                # The mapping stays valid without the file on POSIX, so nothing is left behind
+                os.remove(path)
+            except OSError:
+                pass
+            for row, idx in enumerate(in_memory):
+                self._embeddings[idx] = spilled[row]
+            return len(in_memory)
+
+    def as_retriever(self, similarity_top_k: int = 2, **kwargs) -> HybridRetriever:
+        """
+        Get a retriever over the index, mirroring VectorStoreIndex.as_retriever.
+
+        Args:
+            similarity_top_k (int): Number of nodes to return.
+            **kwargs: Additional HybridRetriever parameters.
+
+        Returns:
+            HybridRetriever: Retriever over the index.
+        """
+        return HybridRetriever(self, similarity_top_k=similarity_top_k, **kwargs)
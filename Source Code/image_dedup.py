@@ -0,0 +1,83 @@
+# Standard library imports
+from typing import List
+
+# Third-party library imports
+import numpy as np
+
+# 16x16 difference hash, 256 bits. Drawing sheets are mostly white, a finer
+# grid than the usual 8x8 keeps different figures apart
+DEFAULT_HASH_SIZE = 16
+
+# Maximum number of differing bits between near-duplicate sheets, e.g. the
+# A1 and B1 scans of the same drawing
+DEFAULT_THRESHOLD = 10
+
+def dhash(image, hash_size: int = DEFAULT_HASH_SIZE) -> int:
+    """
+    Compute the difference hash of an image.
+
+    The image is reduced to a (hash_size + 1) x hash_size grayscale grid and
+    each bit tells whether a pixel is brighter than its right neighbour, so
+    rescans, recompression and small shifts keep most bits.
+
+    Args:
+        image (PIL.Image): Image to hash.
+        hash_size (int): Side of the bit grid.
+
+    Returns:
+        int: Hash of hash_size ** 2 bits.
+    """
+    from PIL import Image
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(a: int, b: int) -> int:
+    """
+    Count the differing bits of two hashes.
+
+    Args:
+        a (int): First hash.
+        b (int): Second hash.
+
+    Returns:
+        int: Number of differing bits.
+    """
+    return bin(a ^ b).count('1')
+
+def group_duplicates(hashes: List[int], threshold: int = DEFAULT_THRESHOLD) -> List[int]:
+    """
+    Group the images whose hashes are within a Hamming distance of each other.
+
+    Each image is compared to the first image of the groups found so far, so
+    the first sheet of a group, in sheet order, represents it.
+
+    Args:
+        hashes (List[int]): Hash of each image, from dhash.
+        threshold (int): Maximum number of differing bits of duplicates, 0 for identical hashes only.
+
+    Returns:
+        List[int]: Index of the representative of each image, the image itself if it is unique.
+    """
+    representatives, groups = [], []
+    for idx, image_hash in enumerate(hashes):
+        for representative in representatives:
+            if hamming_distance(image_hash, hashes[representative]) <= threshold:
+                groups.append(representative)
+                break
+        else:
+            representatives.append(idx)
+            groups.append(idx)
+    return groups
+
+def unique_indices(groups: List[int]) -> List[int]:
+    """
+    Get the representatives of duplicate groups.
+
+    Args:
+        groups (List[int]): Representative of each image, from group_duplicates.
+
+    Returns:
+        List[int]: Representative indices, in sheet order.
+    """
+    return sorted(set(groups))
@@ -1,4 +1,6 @@
 import os
+import re
+import sys
 import subprocess
 import tempfile
 from datetime import datetime
@@ -6,6 +8,28 @@ from llama_index.core.prompts import PromptTemplate
 from llama_index.core import Settings
 import utils
 
+# Maximum number of repairs of the generated code
+MAX_REPAIR_ATTEMPTS = 10
+
+# Seconds a generated script may run
+EXECUTION_TIMEOUT = 60
+
+# Lines of code sent around the failing line when asking the LLM for a fix
+REPAIR_CONTEXT_LINES = 8
+
+# Accumulated repair statistics of every SVG generated by this process
+repair_stats = {
+    'scripts': 0,
+    'executions': 0,
+    'local_fixes': 0,
+    'llm_fixes': 0,
+    'early_aborts': 0,
+    'failures': 0
+}
+
+# Standard library modules the generated scripts commonly use without importing them
+STDLIB_IMPORTS = ['math', 'os', 'random', 'colorsys']
+
 def execute_dynamic_code(code_str: str) -> int:
     """
     Execute dynamically generated Python code.
@@ -21,90 +45,319 @@ def execute_dynamic_code(code_str: str) -> int:
         temp_filename = temp_file.name
         # Write the code to the temporary file
         temp_file.write(code_str)
-    
-    # Execute the temporary Python file
-    result = subprocess.run(['python', temp_filename], capture_output=True, text=True)
-    
-    # Print any errors
-    if result.stderr:
+
+    # Execute the temporary Python file, warnings on stderr are not errors
+    repair_stats['executions'] += 1
+    try:
+        result = subprocess.run([sys.executable, temp_filename], capture_output=True, text=True, timeout=EXECUTION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return f'TimeoutError: the script did not finish within {EXECUTION_TIMEOUT} seconds'
+    finally:
+        # Delete the temporary file
+        os.unlink(temp_filename)
+
+    if result.returncode != 0:
         print("Errors:")
         print(result.stderr)
-        return result.stderr
-    else:
-        print("Code executed successfully. Image written in 'images' folder")
-    
-    # Delete the temporary file
-    os.unlink(temp_filename)  
-    
+        return result.stderr or f'Script exited with code {result.returncode}'
+
+    print("Code executed successfully. Image written in 'images' folder")
     return 0  # Return 0 if execution was successful
 
-def generate_image_from_code(input_text: str, prompt_template: str, output_filename: str, max_tokens_code: int, print_prompt: bool, timestamp: str) -> str:
+def classify_error(error: str) -> str:
+    """
+    Classify the error of a generated script.
+
+    Args:
+        error (str): Traceback or error message.
+
+    Returns:
+        str: 'syntax', 'import', 'name', 'svgwrite', 'attribute', 'file_path', 'missing_output', 'timeout' or 'other'.
+    """
+    last_line = error.strip().splitlines()[-1] if error.strip() else ''
+    if re.match(r'(SyntaxError|IndentationError|TabError)', last_line):
+        return 'syntax'
+    if re.match(r'(ModuleNotFoundError|ImportError)', last_line):
+        return 'import'
+    if last_line.startswith('NameError'):
+        return 'name'
+    if 'svgwrite' in error and re.match(r'(TypeError|ValueError|KeyError)', last_line):
+        # Raised by the svgwrite validator, e.g. "'10mm' is not a valid value for attribute 'x'"
+        return 'svgwrite'
+    if last_line.startswith('AttributeError'):
+        return 'attribute'
+    if re.match(r'(FileNotFoundError|PermissionError|IsADirectoryError|NotADirectoryError)', last_line):
+        return 'file_path'
+    if last_line.startswith('MissingOutputError'):
+        return 'missing_output'
+    if last_line.startswith('TimeoutError'):
+        return 'timeout'
+    return 'other'
+
+def error_signature(error: str) -> str:
+    """
+    Get a signature of an error, equal for repeats of the same error.
+
+    Args:
+        error (str): Traceback or error message.
+
+    Returns:
+        str: Error class and last line of the error, without line numbers and paths.
+    """
+    last_line = error.strip().splitlines()[-1] if error.strip() else ''
+    return classify_error(error) + ':' + re.sub(r'\d+|/\S+', '#', last_line)
+
+def error_line_number(error: str):
+    """
+    Find the line of the generated script the error was raised at.
+
+    Args:
+        error (str): Traceback or error message.
+
+    Returns:
+        int or None: 1-based line number in the script, None if unknown.
+    """
+    line_numbers = re.findall(r'File "[^"]*tmp[^"]*\.py", line (\d+)', error)
+    return int(line_numbers[-1]) if line_numbers else None
+
+def strip_mm_units(code: str) -> str:
+    """
+    Remove millimetre units, the canvas is in pixels.
+
+    Args:
+        code (str): Python code.
+
+    Returns:
+        str: Code without mm units.
+    """
+    code = re.sub(r'\s*\*\s*(?:svgwrite\.)?mm\b', '', code)
+    code = re.sub(r'''(['"])(-?\d+(?:\.\d+)?)\s*mm\1''', r'\1\2\1', code)
+    return re.sub(r'^\s*from svgwrite import mm\s*$', '', code, flags=re.MULTILINE)
+
+def fix_save_path(code: str, output_filename: str) -> str:
+    """
+    Make the script write the SVG to the expected path.
+
+    Args:
+        code (str): Python code.
+        output_filename (str): Expected SVG path.
+
+    Returns:
+        str: Code saving the drawing to output_filename.
+    """
+    code = re.sub(r'''svgwrite\.Drawing\(\s*(?:filename\s*=\s*)?(['"]).*?\1''', lambda m: f'svgwrite.Drawing({output_filename!r}', code, count=1)
+    code = re.sub(r'''\.saveas\(\s*(['"]).*?\1''', lambda m: f'.saveas({output_filename!r}', code)
+
+    # Save the drawing if the script never does
+    drawing = re.search(r'^(\w+)\s*=\s*svgwrite\.Drawing\(', code, re.MULTILINE)
+    if drawing and '.save(' not in code and '.saveas(' not in code:
+        code += f'\n{drawing.group(1)}.save()\n'
+    return code
+
+def disable_validation(code: str) -> str:
+    """
+    Turn off the svgwrite validator, which rejects values browsers render fine.
+
+    Args:
+        code (str): Python code.
+
+    Returns:
+        str: Code creating the drawing with debug=False.
+    """
+    match = re.search(r'svgwrite\.Drawing\(', code)
+    if match is None:
+        return code
+
+    # Find the closing parenthesis of the call
+    depth = 0
+    for position in range(match.end() - 1, len(code)):
+        depth += {'(': 1, ')': -1}.get(code[position], 0)
+        if depth == 0:
+            break
+    else:
+        return code
+    arguments = code[match.end():position]
+    if re.search(r'\bdebug\s*=', arguments):
+        return code
+    separator = ', ' if arguments.strip() else ''
+    return code[:position] + separator + 'debug=False' + code[position:]
+
+def add_missing_import(code: str, error: str) -> str:
+    """
+    Import a module the script uses without importing it.
+
+    Args:
+        code (str): Python code.
+        error (str): NameError traceback.
+
+    Returns:
+        str: Code with the import added, unchanged if the name is not a known module.
+    """
+    match = re.search(r"NameError: name '(\w+)' is not defined", error)
+    if match and match.group(1) in ['svgwrite'] + STDLIB_IMPORTS:
+        return f'import {match.group(1)}\n' + code
+    return code
+
+def apply_local_fixes(code: str, error_class: str, error: str, output_filename: str) -> str:
+    """
+    Apply the deterministic fixes of an error class, without calling the LLM.
+
+    Args:
+        code (str): Python code that failed.
+        error_class (str): Class from classify_error.
+        error (str): Traceback or error message.
+        output_filename (str): Expected SVG path.
+
+    Returns:
+        str: Fixed code, unchanged if no local fix applies.
+    """
+    if error_class == 'name':
+        return add_missing_import(code, error)
+    if error_class == 'svgwrite':
+        fixed = strip_mm_units(code)
+        return fixed if fixed != code else disable_validation(code)
+    if error_class in ('file_path', 'missing_output'):
+        return fix_save_path(code, output_filename)
+    return code
+
+def splice_repair(code: str, error: str, output_filename: str, error_class: str, llm=None) -> str:
+    """
+    Ask the LLM to fix the lines around the error and splice them back into the script.
+
+    Only the failing lines and the last line of the error are sent. Errors
+    without a line in the script (missing output, timeout) send the whole script.
+
+    Args:
+        code (str): Python code that failed.
+        error (str): Traceback or error message.
+        output_filename (str): Expected SVG path.
+        error_class (str): Class from classify_error.
+        llm (LLM, optional): LLM asked for the fix, Settings.llm if None.
+
+    Returns:
+        str: Repaired code.
+    """
+    llm = llm or Settings.llm
+    lines = code.splitlines()
+    line_number = error_line_number(error)
+    last_line = error.strip().splitlines()[-1] if error.strip() else error
+    hint = "Only use svgwrite and the Python standard library. " if error_class == 'import' else ""
+
+    if line_number is None or (error_class == 'syntax' and len(lines) <= 4 * REPAIR_CONTEXT_LINES):
+        prompt = (
+            "You are an expert Python developer specializing in SVG image generation with svgwrite. "
+            f"The following script fails with: {last_line}\n{hint}"
+            f"Return the complete corrected script in a ```python block. Do not use mm as position. Name the image {output_filename}\n"
+            f"```python\n{code}\n```"
+        )
+        return utils.get_code_from_text(llm.complete(prompt).text) or code
+
+    start = max(0, line_number - 1 - REPAIR_CONTEXT_LINES)
+    end = min(len(lines), line_number + REPAIR_CONTEXT_LINES)
+    snippet = "\n".join(lines[start:end])
+    prompt = (
+        "You are an expert Python developer specializing in SVG image generation with svgwrite. "
+        f"Line {line_number - start} of the following excerpt of a script fails with: {last_line}\n{hint}"
+        "Return only the corrected excerpt, with the same indentation and the same number of lines where possible, "
+        "in a ```python block. Do not use mm as position.\n"
+        f"```python\n{snippet}\n```"
+    )
+    fixed_snippet = utils.get_code_from_text(llm.complete(prompt).text)
+    if not fixed_snippet:
+        return code
+    return "\n".join(lines[:start] + fixed_snippet.splitlines() + lines[end:])
+
+def run_and_check(code: str, output_filename: str):
+    """
+    Execute a script and check that it wrote the SVG.
+
+    Args:
+        code (str): Python code.
+        output_filename (str): Expected SVG path.
+
+    Returns:
+        int or str: 0 if the SVG was written, error message otherwise.
+    """
+    if os.path.exists(output_filename):
+        os.remove(output_filename)
+    execution_result = execute_dynamic_code(code)
+    if execution_result == 0 and not os.path.exists(output_filename):
+        return f'MissingOutputError: the script ran but did not write {output_filename}'
+    return execution_result
+
+def generate_image_from_code(input_text: str, prompt_template: str, output_filename: str, max_tokens_code: int, print_prompt: bool, timestamp: str,
+                             max_attempts: int = MAX_REPAIR_ATTEMPTS, llm=None) -> str:
     """
     Generate an SVG image from a text description using an LLM.
 
+    Failing scripts are repaired locally for the known error classes and by
+    the LLM otherwise, with only the failing lines as context. The repair
+    stops early when an error repeats after an LLM fix.
+
     Args:
         input_text (str): Text description of the image to generate.
         prompt_template (str): Template for the LLM prompt.
         output_filename (str): Desired output filename for the SVG.
         max_tokens_code (int): Maximum number of tokens for the LLM response.
         print_prompt (bool): Whether to print the generated prompt.
+        max_attempts (int): Maximum number of repairs.
+        llm (LLM, optional): LLM writing and repairing the code, created with max_tokens_code as its token limit.
+            Settings.llm is used if None, with its token limit set to max_tokens_code.
 
     Returns:
-        str: The filename of the generated SVG image.
+        str or None: The filename of the generated SVG image, None if the code could not be repaired.
     """
-    Settings.llm.max_tokens = max_tokens_code
+    if llm is None:
+        llm = Settings.llm
+        llm.max_tokens = max_tokens_code
     input_prompt = PromptTemplate(prompt_template)
-    
+
     file_format = output_filename[output_filename.rfind('.')+1:]
     output_filename = output_filename.replace('.'+file_format, f'_{timestamp}.{file_format}')
-    
+
     # Create output directory
-    os.makedirs('./images', exist_ok=True)
-    
+    os.makedirs(os.path.dirname(output_filename) or './images', exist_ok=True)
+
     if print_prompt:
         print(input_prompt.format(output_filename=output_filename, information=input_text))
-    
-    # Generate initial code
-    summary = Settings.llm.complete(input_prompt.format(output_filename=output_filename, information=input_text))
-    result = utils.get_code_from_text(summary.text)
-    
+
+    # Generate initial code, with the fixes every script needs applied upfront
+    summary = llm.complete(input_prompt.format(output_filename=output_filename, information=input_text))
+    code = fix_save_path(strip_mm_units(utils.get_code_from_text(summary.text)), output_filename)
+    repair_stats['scripts'] += 1
+
     # Execute code
-    execution_result = execute_dynamic_code(result)
+    execution_result = run_and_check(code, output_filename)
 
     # If the execution failed try to fix the code
     attempts = 1
-    while execution_result != 0 and attempts <= 10:
-        print(f'Found an error in the code: attempting to fix it. Attempt: {attempts}')
-        input_text_correction = """
-        You are an expert Python developer specializing in SVG image generation. You have provided the following script {code}. 
-        Your code is incorrect and shows the following error : {error}
-        Please correct the code and keep in mind the following points: 
-        - Use the svgwrite library to create the SVG image.
-        - Include the title of the invention.
-        - Use a canvas size of 512x512 pixels
-        - Choose appropriate shapes for each object in the claim.
-        - Use distinct colors for each object or category.
-        - Use arrows to indicate directions when needed.
-        - Include a legend that doesn't overlap with the main image.
-        - Every element needs to have a legend.
-        - Position the legend in the top left corner of the image and make sure it does not fall outside of borders
-        - Use small icons and text to represent each item in the legend
-        - Add appropriate labels or text where necessary to clarify the image.
-        - Ensure the code is well-commented and easy to understand.
-        - Do not use mm as position.
-        - Name the image {output_filename}
-        """
-        
-        # Query the LLM to generate corrected code
-        summary = Settings.llm.complete(input_text_correction.format(
-            output_filename=output_filename,
-            code=result,
-            error=execution_result
-        ))
-        result = utils.get_code_from_text(summary.text)
-        
+    previous_signature = None
+    while execution_result != 0 and attempts <= max_attempts:
+        error_class = classify_error(execution_result)
+        signature = error_signature(execution_result)
+
+        fixed_code = apply_local_fixes(code, error_class, execution_result, output_filename)
+        if fixed_code != code:
+            print(f'Found a {error_class} error in the code: applying a local fix. Attempt: {attempts}')
+            repair_stats['local_fixes'] += 1
+        else:
+            if signature == previous_signature:
+                print(f'The same {error_class} error repeats after a fix, giving up')
+                repair_stats['early_aborts'] += 1
+                break
+            print(f'Found a {error_class} error in the code: attempting to fix it. Attempt: {attempts}')
+            fixed_code = splice_repair(code, execution_result, output_filename, error_class, llm=llm)
+            repair_stats['llm_fixes'] += 1
+            previous_signature = signature
+        code = fixed_code
+
         # Execute corrected code
-        execution_result = execute_dynamic_code(result)
+        execution_result = run_and_check(code, output_filename)
         attempts += 1
-    
-    return output_filename
\ No newline at end of file
+
+    print('SVG repair statistics:', repair_stats)
+    if execution_result != 0:
+        print('Could not generate the image from the code')
+        repair_stats['failures'] += 1
+        return None
+    return output_filename
@@ -1,137 +1,336 @@
 import anthropic
 import utils
-import collections
-from transformers import CLIPProcessor, CLIPModel
-import json 
+import prompt_cache
+import figure_index
+import models
+import devices
+import image_dedup
 
 from PIL import Image
 import torch
 import numpy as np
 
-def run_claude_on_image(input_prompt, client: anthropic.Anthropic, input_images: list, model_llm: str) -> str:
+def run_claude_on_image(input_prompt: dict, client: anthropic.Anthropic, input_images: list, model_llm: str):
     """
     Run Claude AI on an encoded image. This prompt template is dependent on the initial prompt. Do not modify.
 
+    The patent context of the summary stage is reused unchanged as the cached
+    prompt prefix, only the images and instructions are new input tokens.
+
     Args:
+        input_prompt (dict): Cached context and instructions of the summary stage.
         client (anthropic.Anthropic): Anthropic client instance.
-        image_encoded (str): Base64 encoded image data.
-
-    Returns:
-        str: Return an enhanced summary with the information of the images.
-    """
-    user_input = input_prompt.replace('Return the information as a JSON using the following template with fields:', ' The attached retrieved images are the most informative for the claim use them as additional information\n Return the information as a JSON using the following template with fields:')
-
-    content = []
-
-    # Add each image to the content
-    for image in input_images:
-        content.append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/jpeg",
-                "data": image,
-            },
-        })
-    
-    # Add the text input
-    content.append({
-        "type": "text",
-        "text": user_input
-    })
+        input_images (list): List of base64 encoded image data.
+        model_llm (str): Name of the language model to use.
 
+    Yields:
+        str: Text deltas of an enhanced summary with the information of the images.
+    """
+    user_input = input_prompt['instructions'].replace('Return the information as a JSON using the following template with fields:', ' The attached retrieved images are the most informative for the claim use them as additional information\n Return the information as a JSON using the following template with fields:')
 
-    # Send the request
-    response = client.messages.create(
+    yield from prompt_cache.stream_cached_completion(
+        client,
         model=model_llm,
-        max_tokens=1024,
-        messages=[
-            {
-                "role": "user",
-                "content": content,
-            }
-        ],
+        context=input_prompt['context'],
+        instructions=user_input,
+        images=input_images,
+        max_tokens=1024
     )
-    
-    
-    return response.content[0].text
 
-def run_summary_with_retrieved_images(input_prompt: str, images: list, model_llm: str) -> dict:
+def run_summary_with_retrieved_images(input_prompt: dict, images: list, model_llm: str, on_partial=None) -> dict:
     """
     Generates a summary of the claim based on a previous prompt and top retrieved images.
 
     Args:
+        input_prompt (dict): Cached context and instructions of the summary stage.
         images (list): List of base64 encoded image data.
         model_llm (str): Name of the language model to use.
+        on_partial (callable, optional): Called with the partial summary text while streaming.
 
     Returns:
         dict: Dictionary containing extracted figure numbers for each image.
     """
-    client = anthropic.Anthropic()
-    dict_numbers = collections.defaultdict(dict)
-    
-    output_text = run_claude_on_image(input_prompt, client, images, model_llm)
+    client = prompt_cache.get_client()
     
-    # Extract and parse JSON from the response
-    json_start = output_text.index('{')
-    json_end = output_text.rindex('}') + 1
-    json_str = output_text[json_start:json_end]
-    data_dict = json.loads(json_str)
+    # Stream the response and parse the JSON as soon as it is complete
+    data_dict = utils.stream_json_completion(
+        lambda: run_claude_on_image(input_prompt, client, images, model_llm),
+        partial_key='summary',
+        on_partial=on_partial
+    )
     
     return data_dict['summary'], data_dict['reference']
 
 
-def retrieve_similar_images(query_text: str, image_data: list, top_k: int = 1) -> list:
+def get_clip_device() -> str:
     """
-    Retrieve similar images based on a text query using CLIP model.
+    Select the device for the CLIP model.
+
+    Returns:
+        str: 'cuda' if the GPU has enough free memory, 'cpu' otherwise.
+    """
+    device = devices.get_device(min_memory=5)
+    print(f"Using device: {device}")
+    return device
+
+def embed_images(image_data: list, device: str = None) -> torch.Tensor:
+    """
+    Compute the normalized CLIP embeddings of a list of images.
+
+    The embeddings only depend on the images, so they can be computed once per
+    patent and reused for every query.
 
     Args:
-        query_text (str): Text query to match against images.
         image_data (list): List of image data (PIL Images or file paths).
-        top_k (int): Number of top similar images to retrieve.
+        device (str, optional): Device to run the model on.
 
     Returns:
-        list: Indices of top similar images.
+        torch.Tensor: Normalized image embeddings.
     """
-    n_image = len(image_data)
-    print(f"Number of images: {n_image}")
-    
-    # Ensure top_k doesn't exceed the number of available images
-    top_k = min(top_k, n_image)
-    
-    # Check for GPU availability
-    device = 'cuda' if utils.check_gpu_is_free(min_memory=5) else 'cpu'
-    print(f"Using device: {device}")
-    
-    # Load pre-trained CLIP model and processor
-    model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14").to(device)
-    processor = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-    
-    # Process the text input
-    text_inputs = processor(text=[query_text], return_tensors="pt", padding=True, truncation=True)
-    text_inputs = {k: v.to(device) for k, v in text_inputs.items()}
-    
+    device = device or get_clip_device()
+    model, processor = models.load_clip_model(device)
+
     # Process the images
     image_inputs = processor(images=image_data, return_tensors="pt", padding=True)
     image_inputs = {k: v.to(device) for k, v in image_inputs.items()}
-    
-    # Generate embeddings
+
     with torch.no_grad():
-        text_features = model.get_text_features(**text_inputs)
         image_features = model.get_image_features(**image_inputs)
-    
-    # Normalize features
+
+    return image_features / image_features.norm(dim=-1, keepdim=True)
+
+def embed_unique_images(image_data: list, duplicates: list = None, device: str = None) -> torch.Tensor:
+    """
+    Compute the CLIP embeddings of a list of images, embedding each group of duplicates once.
+
+    Args:
+        image_data (list): List of image data (PIL Images or file paths).
+        duplicates (list, optional): Representative of each image (see image_dedup.group_duplicates).
+        device (str, optional): Device to run the model on.
+
+    Returns:
+        torch.Tensor: Normalized embedding of every image, duplicates share the embedding of their representative.
+    """
+    if duplicates is None:
+        return embed_images(image_data, device)
+
+    unique = image_dedup.unique_indices(duplicates)
+    if len(unique) < len(image_data):
+        print(f"Embedding {len(unique)} unique images out of {len(image_data)}")
+    unique_features = embed_images([image_data[idx] for idx in unique], device)
+    position = {idx: pos for pos, idx in enumerate(unique)}
+    return unique_features[[position[representative] for representative in duplicates]]
+
+def score_images(query_text: str, image_features: torch.Tensor) -> torch.Tensor:
+    """
+    Compute the similarity of precomputed image embeddings to a text query.
+
+    Args:
+        query_text (str): Text query to match against images.
+        image_features (torch.Tensor): Normalized image embeddings from embed_images.
+
+    Returns:
+        torch.Tensor: Similarity score of each image.
+    """
+    device = image_features.device
+    model, processor = models.load_clip_model(device.type)
+
+    # Process the text input
+    text_inputs = processor(text=[query_text], return_tensors="pt", padding=True, truncation=True)
+    text_inputs = {k: v.to(device) for k, v in text_inputs.items()}
+
+    with torch.no_grad():
+        text_features = model.get_text_features(**text_inputs)
     text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-    
+
     # Compute similarity scores
-    similarity_scores = (text_features @ image_features.T).squeeze(0)
-    
+    return (text_features @ image_features.T).squeeze(0)
+
+def mmr_select(scores: torch.Tensor, image_features: torch.Tensor, candidates: list, top_k: int, mmr_lambda: float = 1.0, selected: list = None) -> list:
+    """
+    Select images by maximal marginal relevance.
+
+    Each step takes the candidate maximizing
+    mmr_lambda * score - (1 - mmr_lambda) * (highest similarity to the images already selected),
+    so near-identical images are not selected together.
+
+    Args:
+        scores (torch.Tensor): Similarity of each image to the query.
+        image_features (torch.Tensor): Normalized image embeddings.
+        candidates (list): Indices of the images to select from.
+        top_k (int): Number of images to select.
+        mmr_lambda (float): Weight of the relevance, 1.0 for plain top-k.
+        selected (list, optional): Indices of images already selected, counted in the redundancy but not returned.
+
+    Returns:
+        list: Indices of the newly selected images, in selection order.
+    """
+    if not candidates or top_k <= 0:
+        return []
+    if mmr_lambda >= 1.0:
+        order = torch.argsort(scores[candidates], descending=True).tolist()
+        return [candidates[pos] for pos in order[:top_k]]
+
+    chosen, remaining = list(selected or []), list(candidates)
+    new = []
+    while remaining and len(new) < top_k:
+        relevance = scores[remaining]
+        if chosen:
+            redundancy = (image_features[remaining] @ image_features[chosen].T).max(dim=1).values
+        else:
+            redundancy = torch.zeros_like(relevance)
+        best = remaining.pop(int(torch.argmax(mmr_lambda * relevance - (1 - mmr_lambda) * redundancy)))
+        chosen.append(best)
+        new.append(best)
+    return new
+
+def rank_images(query_text: str, image_features: torch.Tensor, top_k: int = 1, candidates: list = None, mmr_lambda: float = 1.0) -> list:
+    """
+    Rank precomputed image embeddings against a text query.
+
+    Args:
+        query_text (str): Text query to match against images.
+        image_features (torch.Tensor): Normalized image embeddings from embed_images.
+        top_k (int): Number of top similar images to retrieve.
+        candidates (list, optional): Indices of the images to rank, all images if None.
+        mmr_lambda (float): Weight of the relevance in the MMR selection, 1.0 for plain top-k.
+
+    Returns:
+        list: Indices of top similar images.
+    """
+    candidates = list(range(image_features.shape[0])) if candidates is None else list(candidates)
+    # Ensure top_k doesn't exceed the number of available images
+    top_k = min(top_k, len(candidates))
+
+    similarity_scores = score_images(query_text, image_features)
+
     # Get top k results
-    top_results = torch.topk(similarity_scores, k=top_k)
-    
+    top_indices = mmr_select(similarity_scores, image_features, candidates, top_k, mmr_lambda)
+
     # Print results
-    for idx, score in zip(top_results.indices.tolist(), top_results.values.tolist()):
-        print(f"Image index: {idx}, Similarity Score: {score:.4f}")
-    
-    return top_results.indices.tolist()
+    for idx in top_indices:
+        print(f"Image index: {idx}, Similarity Score: {similarity_scores[idx].item():.4f}")
+
+    return top_indices
+
+def retrieve_images_by_references(query_text: str, image_data: list, coverage: dict, top_k: int = 1, image_features: torch.Tensor = None,
+                                  duplicates: list = None, mmr_lambda: float = 1.0) -> list:
+    """
+    Retrieve images by reference numeral coverage, using CLIP only to re-rank.
+
+    Sheets covering the most referenced numerals are selected first. CLIP only
+    breaks the ties at the top-k boundary and fills the remaining slots when
+    fewer sheets cover any numeral, so only those sheets are embedded. Both
+    use the MMR selection, so a near-duplicate of a selected sheet is passed over.
+
+    Args:
+        query_text (str): Text query to match against images.
+        image_data (list): List of image data (PIL Images or file paths).
+        coverage (dict): Number of covered numerals per image index (see figure_index.sheet_coverage).
+        top_k (int): Number of top images to retrieve.
+        image_features (torch.Tensor, optional): Precomputed embeddings of all images.
+        duplicates (list, optional): Representative of each image, only representatives are selected.
+        mmr_lambda (float): Weight of the relevance in the MMR selection, 1.0 for plain top-k.
+
+    Returns:
+        list: Indices of top images.
+    """
+    candidates = image_dedup.unique_indices(duplicates) if duplicates is not None else list(range(len(image_data)))
+    top_k = min(top_k, len(candidates))
+    ranked = sorted(coverage, key=lambda idx: coverage[idx], reverse=True)
+
+    def clip_select(indices, k, selected):
+        # The selected sheets are only embedded when the MMR needs their similarity
+        embedded = indices + (selected if mmr_lambda < 1.0 else [])
+        if image_features is not None:
+            features = image_features[embedded]
+        else:
+            features = embed_images([image_data[idx] for idx in embedded])
+        scores = score_images(query_text, features)
+        positions = mmr_select(scores, features, list(range(len(indices))), k, mmr_lambda,
+                               selected=list(range(len(indices), len(embedded))))
+        return [indices[position] for position in positions]
+
+    if len(ranked) >= top_k:
+        # Re-rank the sheets tied with the k-th one
+        boundary = coverage[ranked[top_k - 1]]
+        top_indices = [idx for idx in ranked if coverage[idx] > boundary]
+        tied = [idx for idx in ranked if coverage[idx] == boundary]
+        if len(top_indices) + len(tied) > top_k:
+            top_indices += clip_select(tied, top_k - len(top_indices), top_indices)
+        else:
+            top_indices += tied
+    else:
+        # Fill the remaining slots with the best CLIP matches
+        others = [idx for idx in candidates if idx not in coverage]
+        top_indices = ranked + clip_select(others, top_k - len(ranked), ranked) if others else ranked
+
+    for idx in top_indices:
+        print(f"Image index: {idx}, Covered references: {coverage.get(idx, 0)}")
+
+    return top_indices
+
+def retrieve_similar_images(query_text: str, image_data: list, top_k: int = 1, image_features: torch.Tensor = None, duplicates: list = None, mmr_lambda: float = 1.0) -> list:
+    """
+    Retrieve similar images based on a text query using CLIP model.
+
+    Args:
+        query_text (str): Text query to match against images.
+        image_data (list): List of image data (PIL Images or file paths).
+        top_k (int): Number of top similar images to retrieve.
+        image_features (torch.Tensor, optional): Precomputed embeddings from embed_images.
+        duplicates (list, optional): Representative of each image, only representatives are embedded and selected.
+        mmr_lambda (float): Weight of the relevance in the MMR selection, 1.0 for plain top-k.
+
+    Returns:
+        list: Indices of top similar images.
+    """
+    n_image = len(image_data)
+    print(f"Number of images: {n_image}")
+
+    if image_features is None:
+        image_features = embed_unique_images(image_data, duplicates)
+
+    candidates = image_dedup.unique_indices(duplicates) if duplicates is not None else None
+    return rank_images(query_text, image_features, top_k=top_k, candidates=candidates, mmr_lambda=mmr_lambda)
+
+
+def select_images(query_text: str, image_data: list, top_k: int = 1, references: dict = None, reference_index: dict = None, image_features: torch.Tensor = None, sheet_labels: list = None, duplicates: list = None, mmr_lambda: float = 1.0) -> list:
+    """
+    Select the most informative images for a claim.
+
+    The reference numerals of the claim are looked up in the reference index
+    and in the labels read on the sheets first; CLIP over every image is only
+    used when no sheet covers them.
+
+    Args:
+        query_text (str): Text query to match against images.
+        image_data (list): List of image data (PIL Images or file paths).
+        top_k (int): Number of top images to retrieve.
+        references (dict, optional): References returned by the LLM (numeral -> label).
+        reference_index (dict, optional): Index from figure_index.build_reference_index.
+        image_features (torch.Tensor, optional): Precomputed embeddings of all images.
+        sheet_labels (list, optional): Figures and numerals read on each sheet (see sheet_labels.py).
+        duplicates (list, optional): Representative of each image (see PatentImages.duplicate_groups),
+            a repeated sheet is never selected twice.
+        mmr_lambda (float): Weight of the relevance in the MMR selection over the CLIP scores, for both the
+            coverage ties and the CLIP fallback. 1.0 for plain top-k.
+
+    Returns:
+        list: Indices of top images.
+    """
+    if references and (reference_index or sheet_labels):
+        figure_ids = reference_index['figures'] if reference_index else []
+        figure_to_sheet = figure_index.map_figures_to_sheets(figure_ids, len(image_data), sheet_labels)
+        coverage = figure_index.sheet_coverage(references, reference_index, figure_to_sheet, sheet_labels)
+        if coverage and duplicates is not None:
+            # A group of duplicates covers what any of its sheets covers
+            collapsed = {}
+            for idx, covered in coverage.items():
+                collapsed[duplicates[idx]] = max(collapsed.get(duplicates[idx], 0), covered)
+            coverage = collapsed
+        if coverage:
+            return retrieve_images_by_references(query_text, image_data, coverage, top_k=top_k, image_features=image_features,
+                                                 duplicates=duplicates, mmr_lambda=mmr_lambda)
+
+    return retrieve_similar_images(query_text, image_data, top_k=top_k, image_features=image_features, duplicates=duplicates, mmr_lambda=mmr_lambda)
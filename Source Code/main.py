@@ -1,20 +1,25 @@
 import os
 import sys
 import json
+import time
 import argparse
 import warnings
 from pprint import pprint
+from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# Custom module imports
-from RAG_pipeline import *
-import utils
-import utilsEPO
-from image_generation_pipeline import *
-import image_retrieval_pipeline
+# Custom module imports. The pipelines pull in llama_index, torch and
+# transformers, they are imported by the stages that need them.
+import prompt_cache
+import models
+import memory_budget
+import epab_fetch
+from results import ClaimResult, PatentResult, get_sink, to_jsonable, as_bytes
+from stage_cache import StageCache
+from patent_data import PatentData
+from svg_postprocess import postprocess_svg, SVGValidationError
 from login_claude import *
-import validation
-from transformers.utils.logging import disable_progress_bar
-disable_progress_bar()
 # Suppress FutureWarnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -41,19 +46,101 @@ def load_config(file_path):
         print(f"Error: Could not read file {file_path}")
         sys.exit(1)
 
-def main(args):
+class PipelineCancelled(Exception):
+    """
+    Raised by the progress callbacks to stop a run at the next stage or streamed token.
+    """
+
+def report_stage(on_stage, stage, **data):
+    """
+    Report a finished pipeline stage.
+
+    Args:
+        on_stage (callable or None): Called with the stage name and its results.
+        stage (str): Name of the finished stage.
+        **data: Results of the stage.
+    """
+    if on_stage is not None:
+        on_stage(stage, data)
+
+def time_stages(on_stage, timings: dict):
+    """
+    Wrap a stage callback to record the seconds spent in each stage.
+
+    Under a memory budget the intermediate structures of each stage are also
+    released before the next stage starts.
+
+    Args:
+        on_stage (callable or None): Stage callback to wrap.
+        timings (dict): Filled with the duration of each stage, keyed by stage name.
+
+    Returns:
+        callable: Stage callback recording the timings.
+    """
+    last = time.perf_counter()
+
+    def timed_on_stage(stage, data):
+        nonlocal last
+        now = time.perf_counter()
+        timings[stage] = round(now - last, 3)
+        memory_budget.end_stage(stage)
+        last = time.perf_counter()
+        if on_stage is not None:
+            on_stage(stage, data)
+
+    return timed_on_stage
+
+def model_ids(args) -> dict:
+    """
+    Get the models a result was produced with.
+
+    Args:
+        args (dict): Configuration parameters, after models.configure.
+
+    Returns:
+        dict: LLM, embedding and CLIP model names and the quantization.
+    """
+    return {
+        'model_llm': args['model_llm'],
+        'embed_model': models.model_config['embed_model'],
+        'clip_model': models.model_config['clip_model'],
+        'model_quantization': models.model_config['model_quantization']
+    }
+
+def main(args, on_partial_summary=None, on_stage=None):
     """
     Main function to process patent data and generate images.
 
     Args:
         args (dict): Configuration parameters.
+        on_partial_summary (callable, optional): Called with the partial summary text while the LLM streams.
+        on_stage (callable, optional): Called with the stage name ('claims', 'summary', 'images',
+            'image_summary', 'svg', 'metrics') and its results when a stage finishes. In multi-claim
+            mode the results of each claim are listed under 'claims'.
 
     Returns:
-        tuple: Summary, output filename, patent data, and top images.
+        ClaimResult: Summary, references, claims, retrieved images, SVG, metrics and stage timings of the claim.
+        In multi-claim mode the PatentResult of main_multi_claim is returned instead.
     """
+    if is_multi_claim(args['claim_number']):
+        return main_multi_claim(args, on_stage=on_stage)
+
+    models.configure(args)
+    memory_budget.configure(args)
+    epab_fetch.configure(args)
+    timings = {}
+    on_stage = time_stages(on_stage, timings)
+    usage = prompt_cache.usage_snapshot()
+
+    import utilsEPO
+    from llama_index.llms.anthropic import Anthropic
+    from RAG_pipeline import run_RAG_pipeline
+
     # Initialize the appropriate LLM based on the model name
     model_llm = args['model_llm']
     llm = Anthropic(model=model_llm, temperature=int(args['temperature']), max_tokens=int(args['max_tokens']))
+    # The SVG code is written by its own LLM instance, so the stages never share a token limit through Settings.llm
+    code_llm = Anthropic(model=model_llm, temperature=int(args['temperature']), max_tokens=int(args['max_tokens_code']))
 
     
     # Prepare arguments for get_data_from_patent
@@ -67,80 +154,600 @@ def main(args):
         'summary_of_the_invention': args['summary_of_the_invention'],
         'brief_description_of_the_drawings': args['brief_description_of_the_drawings'],
         'detailed_description_of_the_embodiments': args['detailed_description_of_the_embodiments'],
-        'retrieve_patent_images': args['retrieve_patent_images']
+        'retrieve_patent_images': args['retrieve_patent_images'],
+        'figure_label_extraction': args.get('figure_label_extraction', True)
     }
     
+    # Stages whose inputs did not change since a previous run are reused
+    stage_cache = StageCache(enabled=args.get('stage_cache', True))
+
     print('Obtaining Claim data')
-    data_patent = utilsEPO.get_data_from_patent(**dict_args)
+    data_patent = stage_cache.run(
+        'claims', args,
+        lambda: utilsEPO.get_data_from_patent(**dict_args),
+        encode=lambda data: data.to_msgpack(),
+        decode=PatentData.from_msgpack
+    )
+    report_stage(on_stage, 'claims', claim_text=data_patent.claim_text, dependent_claims_text=data_patent.dependent_claims_text)
 
     print('Summarizing claim...')
-    summary, references, input_prompt = run_RAG_pipeline(
+    summary, references, input_prompt = stage_cache.run(
+        'summary', args,
+        lambda: run_RAG_pipeline(
             llm=llm,
             retrieved_images=None,
             data_patent=data_patent,
             prompt_template=args['prompt_template'],
-            print_prompt=args['print_prompt']
-        )
+            print_prompt=args['print_prompt'],
+            on_partial=on_partial_summary,
+            token_budget=get_context_token_budget(args),
+            hybrid=args.get('hybrid_retrieval', True),
+            store=get_portfolio_store(args),
+            similar_patents=args.get('portfolio_similar_patents', False),
+            **get_chunking(args)
+        ),
+        depends_on=('claims',)
+    )
+    report_stage(on_stage, 'summary', summary=summary, references=references)
+    summary_stage = 'summary'
     
-    top_images = None
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    result = ClaimResult(
+        patent_number=args['patent_number'],
+        claim_number=parse_claim_numbers(args['claim_number']),
+        timestamp=timestamp,
+        claim_text=data_patent.claim_text,
+        dependent_claims_text=data_patent.dependent_claims_text,
+        timings=timings,
+        models=model_ids(args),
+        stages=stage_cache.status
+    )
 
-    if args['retrieve_patent_images'] and data_patent['pil_image'] and data_patent['encoded_image']:
-        os.makedirs('./retrieved_images', exist_ok=True)
+    if args['retrieve_patent_images'] and data_patent.images:
+        import image_retrieval_pipeline
 
         print('Retrieving most informative images...')
-        top_indices = image_retrieval_pipeline.retrieve_similar_images(
-            summary, 
-            data_patent['pil_image'], 
-            top_k=int(args['retrieve_top_k_images'])
+        top_indices = stage_cache.run(
+            'images', args,
+            lambda: [int(idx) for idx in image_retrieval_pipeline.select_images(
+                summary, 
+                data_patent.images.pil_images, 
+                top_k=int(args['retrieve_top_k_images']),
+                references=references if args.get('reference_image_selection', True) else None,
+                reference_index=data_patent.reference_index,
+                sheet_labels=data_patent.sheet_labels,
+                **get_image_selection(args, data_patent.images)
+            )],
+            depends_on=('claims', 'summary')
         )
-        top_images = [data_patent['encoded_image'][idx] for idx in top_indices]
-        top_images_pil = [data_patent['pil_image'][idx] for idx in top_indices]
-
-        # Loop through the images and save them as .png files
-        for i, img in enumerate(top_images_pil):
-            img.save('./retrieved_images/'+args['patent_number']+'_'+timestamp+'_top'+str(i)+'.png', format='PNG')
+        top_images = [data_patent.images.encoded(idx) for idx in top_indices]
+        result.top_images = [data_patent.images.jpeg(idx) for idx in top_indices]
+        report_stage(on_stage, 'images', top_images=result.top_images)
         
         print('Summarizing claim based on most informative images...')
-        summary, references = image_retrieval_pipeline.run_summary_with_retrieved_images(input_prompt, top_images, model_llm)
+        summary, references = stage_cache.run(
+            'image_summary', args,
+            lambda: image_retrieval_pipeline.run_summary_with_retrieved_images(input_prompt, top_images, model_llm, on_partial=on_partial_summary),
+            depends_on=('summary', 'images')
+        )
+        report_stage(on_stage, 'image_summary', summary=summary, references=references)
+        summary_stage = 'image_summary'
+    result.summary, result.references = summary, references
 
     print('Generating image from summary...')
-    output_filename = generate_image_from_code(
-        summary, 
-        prompt_template=args['prompt_template_image'],
-        output_filename=args['output_filename'],
-        max_tokens_code=int(args['max_tokens_code']),
-        print_prompt=args['print_prompt'],
-        timestamp = timestamp
+    from image_generation_pipeline import generate_image_from_code
+    svg_output = stage_cache.run(
+        'svg', args,
+        lambda: generate_svg_output(generate_image_from_code(
+            summary, 
+            prompt_template=args['prompt_template_image'],
+            output_filename=args['output_filename'],
+            max_tokens_code=int(args['max_tokens_code']),
+            print_prompt=args['print_prompt'],
+            timestamp = timestamp,
+            llm=code_llm
+        ), args),
+        depends_on=(summary_stage,),
+        encode=lambda output: json.dumps(to_jsonable(output)).encode('utf-8'),
+        decode=restore_svg_output,
+        cache_if=lambda output: output['svg'] is not None
     )
-    
-    os.makedirs('./summary', exist_ok=True)
-
+    result.output_filename, result.svg, result.thumbnail = svg_output['output_filename'], svg_output['svg'], svg_output['thumbnail']
+    report_stage(on_stage, 'svg', output_filename=result.output_filename, svg=result.svg)
 
     print("Patent Claim Summary Evaluation Results:")
-    metrics = validation.evaluate_patent_claim_summary(data_patent, summary)
-    pprint(metrics, width=100, sort_dicts=False)
+    import validation
+    result.metrics = stage_cache.run(
+        'metrics', args,
+        lambda: validation.evaluate_patent_claim_summary(data_patent, summary, **get_chunking(args)),
+        depends_on=('claims', summary_stage)
+    )
+    pprint(result.metrics, width=100, sort_dicts=False)
+    report_stage(on_stage, 'metrics', metrics=result.metrics)
+    if stage_cache.reused():
+        print("Reused stages:", ", ".join(stage_cache.reused()))
+    result.usage = prompt_cache.usage_since(usage)
+    print("Prompt cache usage:", result.usage)
 
-    # Write the results in a json
-    
-    combined_data = {
-        'summary': summary,
-        'metrics': metrics
-    }
-    
-    # Specify the filename
-    filename = './summary/'+args['patent_number']+'_'+timestamp+'.json'
-    
-    # Write the combined data to a JSON file
-    with open(filename, 'w') as file:
-        json.dump(combined_data, file, indent=4)
+    # Write the retrieved images and the summary with its metrics in the background
+    if args.get('persist_results', True):
+        get_sink().submit(result, columnar=args.get('results_store', True))
         
-    return summary, output_filename, data_patent, top_images, metrics
+    return result
     
+def read_svg(output_filename):
+    """
+    Read the SVG written by the generated code.
+
+    Args:
+        output_filename (str): Path to the SVG.
+
+    Returns:
+        bytes or None: SVG content, None if the code did not write it.
+    """
+    if not output_filename or not os.path.exists(output_filename):
+        return None
+    with open(output_filename, 'rb') as f:
+        return f.read()
+
+def generate_svg_output(output_filename, args):
+    """
+    Post-process the SVG written by the generated code and bundle it with its path, as cached by the svg stage.
+
+    The SVG is validated, minified and checked against the size limits of
+    the configuration. The minified SVG replaces the written file and the
+    thumbnail is written next to it.
+
+    Args:
+        output_filename (str): Path to the SVG.
+        args (dict): Configuration parameters.
+
+    Returns:
+        dict: 'output_filename', 'svg' bytes and 'thumbnail' PNG bytes. 'svg' is None if the SVG is missing or rejected.
+    """
+    output = {'output_filename': output_filename, 'svg': read_svg(output_filename), 'thumbnail': None}
+    if output['svg'] is None:
+        return output
+
+    try:
+        processed = postprocess_svg(
+            output['svg'],
+            minify=args.get('svg_minify', True),
+            decimals=int(args.get('svg_decimals', 1)),
+            max_elements=int(args.get('svg_max_elements') or 0),
+            max_bytes=int(args.get('svg_max_bytes') or 0),
+            thumbnail_size=int(args.get('svg_thumbnail_size') or 0)
+        )
+    except SVGValidationError as e:
+        print(f'Rejected the generated SVG: {e}')
+        output['svg'] = None
+        return output
+
+    print(f"SVG post-processed: {processed['stats']['original_bytes']} -> {processed['stats']['bytes']} bytes, {processed['stats']['elements']} elements")
+    output['svg'], output['thumbnail'] = processed['svg'], processed['thumbnail']
+    with open(output_filename, 'wb') as f:
+        f.write(output['svg'])
+    if output['thumbnail'] is not None:
+        with open(os.path.splitext(output_filename)[0] + '.png', 'wb') as f:
+            f.write(output['thumbnail'])
+    return output
+
+def restore_svg_output(payload):
+    """
+    Decode a cached svg stage output, writing the SVG back if its file was removed.
+
+    Args:
+        payload (bytes): Cached output of the svg stage.
+
+    Returns:
+        dict: 'output_filename', 'svg' bytes and 'thumbnail' PNG bytes.
+    """
+    output = json.loads(payload)
+    output['svg'] = as_bytes(output['svg'])
+    output['thumbnail'] = as_bytes(output.get('thumbnail'))
+    if output['svg'] is not None and not os.path.exists(output['output_filename']):
+        os.makedirs(os.path.dirname(output['output_filename']) or '.', exist_ok=True)
+        with open(output['output_filename'], 'wb') as f:
+            f.write(output['svg'])
+    return output
+
+def get_context_token_budget(args):
+    """
+    Get the token budget of the patent context from the configuration.
+
+    Args:
+        args (dict): Configuration parameters.
+
+    Returns:
+        int or None: Token budget, None if not set or not positive.
+    """
+    token_budget = int(args.get('context_token_budget') or 0)
+    return token_budget if token_budget > 0 else None
+
+def get_chunking(args):
+    """
+    Get the chunking parameters of the patent sections from the configuration.
+
+    Args:
+        args (dict): Configuration parameters.
+
+    Returns:
+        dict: 'chunk_size' and 'chunk_overlap' in tokens, shared by retrieval and validation.
+    """
+    from patent_chunking import DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+    return {
+        'chunk_size': int(args.get('chunk_size') or DEFAULT_CHUNK_SIZE),
+        'chunk_overlap': int(args.get('chunk_overlap', DEFAULT_CHUNK_OVERLAP))
+    }
+
+def get_image_selection(args, images):
+    """
+    Get the duplicate sheets and the diversity of the image selection from the configuration.
+
+    Args:
+        args (dict): Configuration parameters.
+        images (PatentImages): Drawing sheets of the patent.
+
+    Returns:
+        dict: 'duplicates' (representative of each sheet, None without deduplication) and 'mmr_lambda'.
+    """
+    duplicates = None
+    if args.get('image_dedup', True):
+        threshold = args.get('image_dedup_threshold')
+        duplicates = images.duplicate_groups(int(threshold) if threshold is not None else None)
+        n_duplicates = len(duplicates) - len(set(duplicates))
+        if n_duplicates:
+            print(f'Collapsed {n_duplicates} duplicate sheets')
+    return {
+        'duplicates': duplicates,
+        'mmr_lambda': float(args.get('image_mmr_lambda', 1.0))
+    }
+
+def get_portfolio_store(args):
+    """
+    Open the portfolio store configured in portfolio_store.
+
+    The store records the embedding model and chunking of its chunks and
+    refuses to open with other ones, whose vectors and chunks would not match.
+
+    Args:
+        args (dict): Configuration parameters.
+
+    Returns:
+        PortfolioStore or None: Opened store, None if no path is configured.
+    """
+    if not args.get('portfolio_store'):
+        return None
+    from portfolio_store import PortfolioStore
+    signature = {'embed_model': args.get('embed_model') or models.model_config['embed_model'], **get_chunking(args)}
+    return PortfolioStore(args['portfolio_store'], signature=signature)
+
+def parse_claim_numbers(claim_number):
+    """
+    Parse the claim_number configuration field.
+
+    Args:
+        claim_number (int, str or list): A claim number, a list of claim numbers,
+            a comma separated string or 'all independent'.
+
+    Returns:
+        int, list or str: A single claim number, a list of claim numbers or 'all independent'.
+
+    Raises:
+        ValueError: If no claim number is given.
+    """
+    if isinstance(claim_number, list):
+        numbers = [int(n) for n in claim_number]
+    elif isinstance(claim_number, str):
+        if claim_number.strip().lower() == 'all independent':
+            return 'all independent'
+        numbers = [int(n) for n in claim_number.strip().strip('[]').split(',') if n.strip()]
+    else:
+        return int(claim_number)
+    if not numbers:
+        raise ValueError(f'No claim number given in claim_number: {claim_number!r}')
+    return numbers if len(numbers) > 1 or isinstance(claim_number, list) else numbers[0]
+
+def is_multi_claim(claim_number):
+    """
+    Check whether the claim_number configuration field selects several claims.
+
+    Args:
+        claim_number (int, str or list): Value of the claim_number field.
+
+    Returns:
+        bool: True for a list of claims or 'all independent'.
+    """
+    return not isinstance(parse_claim_numbers(claim_number), int)
+
+def claim_output_filename(output_filename, claim_number):
+    """
+    Add the claim number to an output filename.
+
+    Args:
+        output_filename (str): Configured output filename.
+        claim_number (int): The number of the claim.
+
+    Returns:
+        str: Output filename for the claim.
+    """
+    root, ext = os.path.splitext(output_filename)
+    return f'{root}_claim{claim_number}{ext}'
+
+def claim_summaries(results):
+    """
+    Get the summaries reported for each claim of a multi-claim run.
+
+    Args:
+        results (dict): Intermediate results of main_multi_claim, keyed by claim number.
+
+    Returns:
+        list: 'claim_number', 'summary' and 'references' of each claim.
+    """
+    return [
+        {'claim_number': claim_number, 'summary': result['summary'], 'references': result['reference']}
+        for claim_number, result in results.items()
+    ]
+
+def main_multi_claim(args, on_stage=None):
+    """
+    Summarize several claims of a patent in one pass.
+
+    Fetching, parsing, the section indices and the drawing embeddings are done
+    once per patent. Only the claim specific retrieval, LLM summaries and SVG
+    generation run per claim, concurrently. Each claim goes through the stage
+    cache with the keys of a single claim run of that claim.
+
+    Args:
+        args (dict): Configuration parameters. claim_number is a list or 'all independent'.
+        on_stage (callable, optional): Called with the stage name and, under 'claims', the results of
+            each claim (a dict with its 'claim_number') when a stage finishes.
+
+    Returns:
+        PatentResult: Results of every claim.
+    """
+    model_llm = args['model_llm']
+    max_workers = int(args.get('max_workers', 4))
+    models.configure(args)
+    memory_budget.configure(args)
+    epab_fetch.configure(args)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Timings of the whole patent, each claim gets the time spent in its own stages from its stage cache
+    timings = {}
+    on_stage = time_stages(on_stage, timings)
+    usage = prompt_cache.usage_snapshot()
+
+    import utilsEPO
+    from llama_index.llms.anthropic import Anthropic
+    from RAG_pipeline import run_RAG_pipeline, setup_embed_model, setup_node_parser, build_section_indices
+    from image_generation_pipeline import generate_image_from_code
+    import validation
+
+    llm = Anthropic(model=model_llm, temperature=int(args['temperature']), max_tokens=int(args['max_tokens']))
+    # The SVG code is written by its own LLM instance, so the stages never share a token limit through Settings.llm
+    code_llm = Anthropic(model=model_llm, temperature=int(args['temperature']), max_tokens=int(args['max_tokens_code']))
+
+    print('Obtaining patent data')
+    patent = utilsEPO.fetch_patent(args['patent_number'], args['retrieve_patent_images'], args.get('figure_label_extraction', True))
+
+    claim_numbers = parse_claim_numbers(args['claim_number'])
+    if claim_numbers == 'all independent':
+        claim_numbers = utilsEPO.get_independent_claims(patent)
+    # Tree by tree: each independent claim before the claims depending on it
+    claim_numbers = patent['claim_graph'].order(claim_numbers)
+    print('Summarizing claims:', claim_numbers)
+
+    # Each claim runs its stages through its own cache, keyed like a single claim run of that claim,
+    # so re-running a list of claims only executes the stages whose inputs changed
+    claims_args = {
+        claim_number: dict(args, claim_number=claim_number, output_filename=claim_output_filename(args['output_filename'], claim_number))
+        for claim_number in claim_numbers
+    }
+    stage_caches = {claim_number: StageCache(enabled=args.get('stage_cache', True)) for claim_number in claim_numbers}
+
+    def get_claim_data(claim_number):
+        return stage_caches[claim_number].run(
+            'claims', claims_args[claim_number],
+            lambda: utilsEPO.get_claim_data(
+                patent,
+                claim_number,
+                dependent_claims=args['dependent_claims'],
+                field_of_invention=args['field_of_invention'],
+                background_of_the_invention=args['background_of_the_invention'],
+                summary_of_the_invention=args['summary_of_the_invention'],
+                brief_description_of_the_drawings=args['brief_description_of_the_drawings'],
+                detailed_description_of_the_embodiments=args['detailed_description_of_the_embodiments']
+            ),
+            encode=lambda data: data.to_msgpack(),
+            decode=PatentData.from_msgpack
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        print('Obtaining claim data')
+        claims_data = list(executor.map(get_claim_data, claim_numbers))
+        report_stage(on_stage, 'claims', claims=[
+            {'claim_number': claim_number, 'claim_text': data_patent.claim_text, 'dependent_claims_text': data_patent.dependent_claims_text}
+            for claim_number, data_patent in zip(claim_numbers, claims_data)
+        ])
+
+        retrieve_images = args['retrieve_patent_images'] and patent['images']
+        if retrieve_images:
+            import image_retrieval_pipeline
+            image_selection = get_image_selection(args, patent['images'])
+
+        # The section indices and the drawing embeddings are shared by every claim, they are
+        # only computed once a claim misses the cache
+        shared = {}
+        shared_lock = threading.Lock()
+
+        def start_image_features():
+            with shared_lock:
+                if 'image_features' not in shared:
+                    shared['image_features'] = executor.submit(image_retrieval_pipeline.embed_unique_images, patent['images'].pil_images, image_selection['duplicates'])
+                return shared['image_features']
+
+        def get_additional_indices():
+            with shared_lock:
+                if 'additional_indices' not in shared:
+                    setup_embed_model()
+                    setup_node_parser(**get_chunking(args))
+                    shared['additional_indices'] = build_section_indices(
+                        llm,
+                        claims_data[0],
+                        hybrid=args.get('hybrid_retrieval', True),
+                        store=get_portfolio_store(args),
+                        similar_patents=args.get('portfolio_similar_patents', False),
+                        **get_chunking(args)
+                    )
+                return shared['additional_indices']
+
+        # The drawings are embedded with CLIP while the section indices are built
+        if retrieve_images and not all(stage_caches[claim_number].cached('summary', claims_args[claim_number], depends_on=('claims',)) for claim_number in claim_numbers):
+            start_image_features()
+
+        print('Summarizing claims...')
+        summaries = list(executor.map(
+            lambda claim_number, data_patent: stage_caches[claim_number].run(
+                'summary', claims_args[claim_number],
+                lambda: run_RAG_pipeline(
+                    llm=llm,
+                    retrieved_images=None,
+                    data_patent=data_patent,
+                    prompt_template=args['prompt_template'],
+                    print_prompt=args['print_prompt'],
+                    additional_indices=get_additional_indices(),
+                    token_budget=get_context_token_budget(args),
+                    **get_chunking(args)
+                ),
+                depends_on=('claims',)
+            ),
+            claim_numbers, claims_data
+        ))
+        results = {
+            claim_number: {'summary': summary, 'reference': references, 'input_prompt': input_prompt}
+            for claim_number, (summary, references, input_prompt) in zip(claim_numbers, summaries)
+        }
+        report_stage(on_stage, 'summary', claims=claim_summaries(results))
+        summary_stage = 'summary'
+
+        if retrieve_images:
+            # The drawings are embedded once and ranked for every claim
+            print('Retrieving most informative images...')
+            for claim_number, result in results.items():
+                top_indices = stage_caches[claim_number].run(
+                    'images', claims_args[claim_number],
+                    lambda: [int(idx) for idx in image_retrieval_pipeline.select_images(
+                        result['summary'],
+                        patent['images'].pil_images,
+                        top_k=int(args['retrieve_top_k_images']),
+                        references=result['reference'] if args.get('reference_image_selection', True) else None,
+                        reference_index=patent['reference_index'],
+                        image_features=start_image_features().result(),
+                        sheet_labels=patent['sheet_labels'],
+                        **image_selection
+                    )],
+                    depends_on=('claims', 'summary')
+                )
+                result['top_images'] = [patent['images'].encoded(idx) for idx in top_indices]
+                result['top_image_bytes'] = [patent['images'].jpeg(idx) for idx in top_indices]
+            report_stage(on_stage, 'images', claims=[
+                {'claim_number': claim_number, 'top_images': result['top_image_bytes']} for claim_number, result in results.items()
+            ])
+
+            print('Summarizing claims based on most informative images...')
+            image_summaries = list(executor.map(
+                lambda claim_number: stage_caches[claim_number].run(
+                    'image_summary', claims_args[claim_number],
+                    lambda: image_retrieval_pipeline.run_summary_with_retrieved_images(results[claim_number]['input_prompt'], results[claim_number]['top_images'], model_llm),
+                    depends_on=('summary', 'images')
+                ),
+                claim_numbers
+            ))
+            for result, (summary, references) in zip(results.values(), image_summaries):
+                result['summary'], result['reference'] = summary, references
+            report_stage(on_stage, 'image_summary', claims=claim_summaries(results))
+            summary_stage = 'image_summary'
+
+        print('Generating images from summaries...')
+        svg_outputs = list(executor.map(
+            lambda claim_number: stage_caches[claim_number].run(
+                'svg', claims_args[claim_number],
+                lambda: generate_svg_output(generate_image_from_code(
+                    results[claim_number]['summary'],
+                    prompt_template=args['prompt_template_image'],
+                    output_filename=claims_args[claim_number]['output_filename'],
+                    max_tokens_code=int(args['max_tokens_code']),
+                    print_prompt=args['print_prompt'],
+                    timestamp=timestamp,
+                    llm=code_llm
+                ), args),
+                depends_on=(summary_stage,),
+                encode=lambda output: json.dumps(to_jsonable(output)).encode('utf-8'),
+                decode=restore_svg_output,
+                cache_if=lambda output: output['svg'] is not None
+            ),
+            claim_numbers
+        ))
+        report_stage(on_stage, 'svg', claims=[
+            {'claim_number': claim_number, 'output_filename': svg_output['output_filename'], 'svg': svg_output['svg']}
+            for claim_number, svg_output in zip(claim_numbers, svg_outputs)
+        ])
+
+    print("Patent Claim Summary Evaluation Results:")
+    patent_result = PatentResult(patent_number=args['patent_number'], timestamp=timestamp)
+    for (claim_number, result), data_patent, svg_output in zip(results.items(), claims_data, svg_outputs):
+        metrics = stage_caches[claim_number].run(
+            'metrics', claims_args[claim_number],
+            lambda: validation.evaluate_patent_claim_summary(data_patent, result['summary'], **get_chunking(args)),
+            depends_on=('claims', summary_stage)
+        )
+        print(f'Claim {claim_number}:')
+        pprint(metrics, width=100, sort_dicts=False)
+        if stage_caches[claim_number].reused():
+            print("Reused stages:", ", ".join(stage_caches[claim_number].reused()))
+        patent_result.claims[claim_number] = ClaimResult(
+            patent_number=args['patent_number'],
+            claim_number=claim_number,
+            timestamp=timestamp,
+            summary=result['summary'],
+            references=result['reference'],
+            claim_text=data_patent.claim_text,
+            dependent_claims_text=data_patent.dependent_claims_text,
+            top_images=result.get('top_image_bytes', []),
+            svg=svg_output['svg'],
+            thumbnail=svg_output['thumbnail'],
+            output_filename=svg_output['output_filename'],
+            metrics=metrics,
+            timings=dict(stage_caches[claim_number].timings),
+            models=model_ids(args),
+            stages=stage_caches[claim_number].status
+        )
+    report_stage(on_stage, 'metrics', claims=[
+        {'claim_number': claim_number, 'metrics': result.metrics} for claim_number, result in patent_result.claims.items()
+    ])
+    patent_result.usage = prompt_cache.usage_since(usage)
+    print("Prompt cache usage:", patent_result.usage)
+
+    # Write one combined JSON for the patent in the background
+    if args.get('persist_results', True):
+        get_sink().submit(patent_result, columnar=args.get('results_store', True))
+
+    return patent_result
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Runs claude with an input config JSON file.")
     parser.add_argument("-i", "--input_json", required=True, help="Path to the JSON config file")
+    parser.add_argument("--server", default=None, help="URL of a running service.py to run the job on, e.g. http://127.0.0.1:8765")
     args = parser.parse_args()
     config = load_config(args.input_json)
     
-    main(config)
\ No newline at end of file
+    if args.server:
+        from service import ServiceClient
+        status = ServiceClient(args.server).run(config, on_stage=lambda stage, data: print(f'Finished stage: {stage}'))
+        if status['status'] != 'done':
+            print(f"Job {status['status']}: {status['error']}")
+            sys.exit(1)
+        result = status['result']
+        pprint({key: value for key, value in result.items() if key not in ('top_images', 'svg', 'thumbnail')}, width=100, sort_dicts=False)
+    else:
+        main(config)
\ No newline at end of file
@@ -0,0 +1,190 @@
+# Standard library imports
+import os
+import gc
+import sys
+import time
+import ctypes
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+SPILL_DIR = './cache/spill'
+
+# Peak memory budget of the process, overridden by configure()
+budget_config = {
+    'memory_budget_mb': 0,
+    'spill_dir': SPILL_DIR
+}
+
+# Functions clearing the process-wide caches of other modules, see register_cache
+_cache_clears: List[Callable[[], None]] = []
+
+def rss_mb() -> float:
+    """
+    Get the current resident set size of the process.
+
+    Returns:
+        float: RSS in MB, the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+def peak_rss_mb() -> float:
+    """
+    Get the peak resident set size of the process since it started.
+
+    Returns:
+        float: Peak RSS in MB, 0.0 where the resource module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def release() -> None:
+    """
+    Collect the unreachable objects and give the freed heap back to the OS where glibc allows it.
+    """
+    gc.collect()
+    if sys.platform.startswith('linux'):
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            # musl or another libc without malloc_trim
+            pass
+
+def configure(args: dict) -> dict:
+    """
+    Set the memory budget from the configuration.
+
+    Args:
+        args (dict): Configuration parameters. Missing keys keep their defaults.
+
+    Returns:
+        dict: Budget configuration in use.
+    """
+    budget_config['memory_budget_mb'] = float(args.get('memory_budget_mb') or 0)
+    return budget_config
+
+def enabled() -> bool:
+    """
+    Whether a memory budget is set. Without a budget the pipeline keeps its intermediate structures.
+
+    Returns:
+        bool: True if memory_budget_mb is positive.
+    """
+    return budget_config['memory_budget_mb'] > 0
+
+def exceeded() -> bool:
+    """
+    Whether the process is over its memory budget.
+
+    Returns:
+        bool: True if a budget is set and the current RSS exceeds it.
+    """
+    return enabled() and rss_mb() > budget_config['memory_budget_mb']
+
+def register_cache(clear: Callable[[], None]) -> None:
+    """
+    Register a process-wide cache to clear at the end of each stage when a budget is set.
+
+    Args:
+        clear (Callable[[], None]): Function emptying the cache, e.g. the cache_clear of an lru_cache.
+    """
+    _cache_clears.append(clear)
+
+def end_stage(stage: str) -> None:
+    """
+    Release the intermediate structures and the registered caches of a finished stage when a budget is set.
+
+    Args:
+        stage (str): Name of the finished stage.
+    """
+    if not enabled():
+        return
+    for clear in _cache_clears:
+        clear()
+    release()
+    if exceeded():
+        print(f"Memory budget exceeded after the {stage} stage: {rss_mb():.0f} MB > {budget_config['memory_budget_mb']:.0f} MB")
+
+def spill_path(name: str) -> str:
+    """
+    Get a new file in the spill directory.
+
+    Args:
+        name (str): Name of the spilled structure.
+
+    Returns:
+        str: Path to the .npy file, unique per process and thread.
+    """
+    os.makedirs(budget_config['spill_dir'], exist_ok=True)
+    return os.path.join(budget_config['spill_dir'], f'{name}-{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.npy')
+
+class PeakRSSSampler:
+    """
+    Peak resident set size of each stage, sampled by a background thread.
+
+    ru_maxrss only grows over the life of the process, so the peak of a
+    stage that follows a larger one is sampled instead.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        Args:
+            interval (float): Seconds between two samples.
+        """
+        self.interval = interval
+        self.peaks = {}
+        self._stage: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self._record()
+            time.sleep(self.interval)
+
+    def _record(self) -> None:
+        with self._lock:
+            if self._stage is not None:
+                self.peaks[self._stage] = max(self.peaks.get(self._stage, 0.0), rss_mb())
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Sample the RSS while a stage runs.
+
+        Args:
+            name (str): Stage name.
+        """
+        if not self._thread.is_alive():
+            self._thread.start()
+        with self._lock:
+            self._stage = name
+        self._record()
+        try:
+            yield
+        finally:
+            self._record()
+            with self._lock:
+                self._stage = None
+
+    def close(self) -> dict:
+        """
+        Stop sampling.
+
+        Returns:
+            dict: Peak RSS in MB of each stage.
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        return {name: round(peak, 1) for name, peak in self.peaks.items()}
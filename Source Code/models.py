@@ -0,0 +1,115 @@
+# Standard library imports
+from functools import lru_cache
+
+# Custom imports
+import devices
+
+# torch, transformers and the Hugging Face embeddings are imported when a model is first loaded
+
+# Models used by the local stages, overridden by configure()
+model_config = {
+    'embed_model': 'BAAI/bge-m3',
+    'clip_model': 'openai/clip-vit-large-patch14',
+    'model_quantization': 'none',
+    'torch_threads': 0,
+    'torch_interop_threads': 0
+}
+
+def configure(args: dict) -> dict:
+    """
+    Set the local models and the torch thread pools from the configuration.
+
+    Args:
+        args (dict): Configuration parameters. Missing keys keep their defaults.
+
+    Returns:
+        dict: Model configuration in use.
+    """
+    for key in model_config:
+        if args.get(key) not in (None, ''):
+            model_config[key] = args[key]
+
+    if model_config['model_quantization'] not in ('none', 'int8'):
+        raise ValueError(f"Unknown model_quantization: {model_config['model_quantization']}. Use 'none' or 'int8'")
+
+    return model_config
+
+def configure_threads() -> None:
+    """
+    Set the torch thread pools from the model configuration, before the first model runs.
+    """
+    from transformers.utils.logging import disable_progress_bar
+    disable_progress_bar()
+    devices.configure_threads(
+        num_threads=model_config['torch_threads'],
+        interop_threads=model_config['torch_interop_threads']
+    )
+
+def quantize(model: 'torch.nn.Module', device: str, quantization: str) -> 'torch.nn.Module':
+    """
+    Apply dynamic quantization to the linear layers of a model.
+
+    Args:
+        model (torch.nn.Module): Model to quantize.
+        device (str): Device the model runs on. Dynamic quantization is only available on CPU.
+        quantization (str): 'none' or 'int8'.
+
+    Returns:
+        torch.nn.Module: Quantized (or unchanged) model.
+    """
+    if quantization == 'none':
+        return model
+    if device != 'cpu':
+        print(f'Quantization {quantization} is only available on CPU, using fp32 on {device}')
+        return model
+    import torch
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_embed_model(device: str, model_name: str = None, quantization: str = None) -> 'HuggingFaceEmbedding':
+    """
+    Load the text embedding model once per process and configuration.
+
+    The configured model and quantization are resolved before the cached
+    load, so a configuration change in a running process loads the new model.
+
+    Args:
+        device (str): Device to run the model on.
+        model_name (str, optional): Hugging Face model name. Defaults to the configured one.
+        quantization (str, optional): 'none' or 'int8'. Defaults to the configured one.
+
+    Returns:
+        HuggingFaceEmbedding: Loaded embedding model.
+    """
+    return _load_embed_model(device, model_name or model_config['embed_model'], quantization or model_config['model_quantization'])
+
+@lru_cache(maxsize=4)
+def _load_embed_model(device: str, model_name: str, quantization: str) -> 'HuggingFaceEmbedding':
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    configure_threads()
+    embed_model = HuggingFaceEmbedding(model_name=model_name, device=device)
+    embed_model._model = quantize(embed_model._model, device, quantization)
+    return embed_model
+
+def load_clip_model(device: str, model_name: str = None, quantization: str = None) -> tuple:
+    """
+    Load the CLIP model and processor once per process and configuration.
+
+    Args:
+        device (str): Device to run the model on.
+        model_name (str, optional): Hugging Face model name. Defaults to the configured one.
+        quantization (str, optional): 'none' or 'int8'. Defaults to the configured one.
+
+    Returns:
+        tuple: CLIP model and processor.
+    """
+    return _load_clip_model(device, model_name or model_config['clip_model'], quantization or model_config['model_quantization'])
+
+@lru_cache(maxsize=4)
+def _load_clip_model(device: str, model_name: str, quantization: str) -> tuple:
+    from transformers import CLIPProcessor, CLIPModel
+
+    configure_threads()
+    model = CLIPModel.from_pretrained(model_name).to(device).eval()
+    processor = CLIPProcessor.from_pretrained(model_name)
+    return quantize(model, device, quantization), processor
@@ -0,0 +1,251 @@
+# Standard library imports
+import re
+from functools import lru_cache
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+# Third-party library imports
+from llama_index.core import Settings
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.schema import BaseNode, NodeRelationship, TextNode
+from llama_index.core.utils import get_tqdm_iterable
+
+# Custom imports
+import memory_budget
+
+DEFAULT_CHUNK_SIZE = 1024
+DEFAULT_CHUNK_OVERLAP = 128
+
+# Paragraph number written at the start of a paragraph, e.g. "[0012] The housing 10 ..."
+PARAGRAPH_NUMBER_PATTERN = re.compile(r'^\[(\d{1,5})\]\s*')
+
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.;:!?])\s+')
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text with the global llama-index tokenizer.
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        int: Number of tokens.
+    """
+    return len(Settings.tokenizer(text))
+
+def split_paragraphs(text: str, numbers: Optional[Sequence[Optional[str]]] = None) -> List[Tuple[Optional[str], str]]:
+    """
+    Split a section into its paragraphs, separated by blank lines.
+
+    Args:
+        text (str): Section text.
+        numbers (Sequence[str], optional): Paragraph numbers of the section, aligned with its paragraphs.
+            Ignored if they do not match the paragraphs, numbers written as "[0012]" are used instead.
+
+    Returns:
+        List[Tuple[str, str]]: (paragraph number or None, paragraph text) pairs.
+    """
+    paragraphs = [paragraph.strip() for paragraph in re.split(r'\n\s*\n', text or '') if paragraph.strip()]
+    if numbers is not None and len(numbers) == len(paragraphs):
+        return list(zip(numbers, paragraphs))
+
+    numbered = []
+    for paragraph in paragraphs:
+        match = PARAGRAPH_NUMBER_PATTERN.match(paragraph)
+        if match:
+            numbered.append((match.group(1), paragraph[match.end():]))
+        else:
+            numbered.append((None, paragraph))
+    return numbered
+
+def _split_long_paragraph(text: str, chunk_size: int, count: Callable[[str], int]) -> List[str]:
+    """
+    Split a paragraph longer than a chunk on sentence boundaries, and on words for overlong sentences.
+
+    Args:
+        text (str): Paragraph text.
+        chunk_size (int): Maximum number of tokens of a piece.
+        count (Callable[[str], int]): Token count of a text.
+
+    Returns:
+        List[str]: Pieces of the paragraph.
+    """
+    sentences = []
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        if count(sentence) <= chunk_size:
+            sentences.append(sentence)
+            continue
+        words, window = sentence.split(), []
+        for word in words:
+            if window and count(' '.join(window + [word])) > chunk_size:
+                sentences.append(' '.join(window))
+                window = []
+            window.append(word)
+        if window:
+            sentences.append(' '.join(window))
+
+    pieces, current = [], []
+    for sentence in sentences:
+        if current and count(' '.join(current + [sentence])) > chunk_size:
+            pieces.append(' '.join(current))
+            current = []
+        current.append(sentence)
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+def chunk_paragraphs(paragraphs: List[Tuple[Optional[str], str]], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                     chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, count: Callable[[str], int] = count_tokens) -> List[dict]:
+    """
+    Pack paragraphs into chunks without cutting them.
+
+    Consecutive paragraphs are added to a chunk while it fits in chunk_size
+    tokens. A new chunk starts with the last paragraphs of the previous one
+    that fit in chunk_overlap tokens. Only paragraphs longer than a chunk are
+    split, on sentence boundaries.
+
+    Args:
+        paragraphs (List[Tuple[str, str]]): (paragraph number, paragraph text) pairs from split_paragraphs.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+        count (Callable[[str], int]): Token count of a text.
+
+    Returns:
+        List[dict]: Chunks with their 'text' and the numbers of their 'paragraphs'.
+    """
+    pieces = []
+    for number, text in paragraphs:
+        n_tokens = count(text)
+        if n_tokens <= chunk_size:
+            pieces.append((number, text, n_tokens))
+        else:
+            pieces.extend((number, piece, count(piece)) for piece in _split_long_paragraph(text, chunk_size, count))
+
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        if current and current_tokens + piece[2] > chunk_size:
+            chunks.append(current)
+            # Carry over the trailing pieces that fit in the overlap, leaving room for the new piece
+            overlap, overlap_tokens = [], 0
+            for previous in reversed(current):
+                if overlap_tokens + previous[2] > min(chunk_overlap, chunk_size - piece[2]):
+                    break
+                overlap.insert(0, previous)
+                overlap_tokens += previous[2]
+            current, current_tokens = overlap, overlap_tokens
+        current.append(piece)
+        current_tokens += piece[2]
+    if current:
+        chunks.append(current)
+
+    return [
+        {
+            'text': '\n\n'.join(text for _, text, _ in chunk),
+            'paragraphs': list(dict.fromkeys(number for number, _, _ in chunk if number is not None))
+        }
+        for chunk in chunks
+    ]
+
+@lru_cache(maxsize=64)
+def chunk_text(text: str, numbers: Optional[Tuple[Optional[str], ...]] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+               chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> Tuple[dict, ...]:
+    """
+    Chunk a section on its paragraph boundaries, once per text and parameters.
+
+    The claims of a patent share their section strings, so retrieval and
+    validation of every claim get the same chunks without chunking again.
+
+    Args:
+        text (str): Section text.
+        numbers (Tuple[str, ...], optional): Paragraph numbers of the section.
+        chunk_size (int): Maximum number of tokens of a chunk.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+
+    Returns:
+        Tuple[dict, ...]: Chunks from chunk_paragraphs. Do not modify them, they are shared.
+    """
+    return tuple(chunk_paragraphs(split_paragraphs(text, numbers), chunk_size, chunk_overlap))
+
+# The cached sections are released between stages when a memory budget is set
+memory_budget.register_cache(chunk_text.cache_clear)
+
+def format_paragraphs(numbers: List[str]) -> str:
+    """
+    Format the paragraph numbers of a chunk, e.g. "[0012]-[0015]".
+
+    Args:
+        numbers (List[str]): Paragraph numbers, in order.
+
+    Returns:
+        str: First and last paragraph, empty without numbers.
+    """
+    if not numbers:
+        return ''
+    if len(numbers) == 1:
+        return f'[{numbers[0]}]'
+    return f'[{numbers[0]}]-[{numbers[-1]}]'
+
+def nodes_from_chunks(chunks: Sequence[dict], metadata: Optional[dict] = None) -> List[TextNode]:
+    """
+    Build the nodes of a section from its chunks.
+
+    The paragraph numbers are kept in the metadata, excluded from the embedded text.
+
+    Args:
+        chunks (Sequence[dict]): Chunks from chunk_text.
+        metadata (dict, optional): Metadata shared by every node.
+
+    Returns:
+        List[TextNode]: Nodes linked to their previous and next nodes.
+    """
+    nodes = []
+    for chunk in chunks:
+        node_metadata = dict(metadata or {})
+        node_metadata['paragraphs'] = format_paragraphs(chunk['paragraphs'])
+        nodes.append(TextNode(
+            text=chunk['text'],
+            metadata=node_metadata,
+            excluded_embed_metadata_keys=list(node_metadata),
+            excluded_llm_metadata_keys=[key for key in node_metadata if key != 'paragraphs']
+        ))
+    for previous, node in zip(nodes, nodes[1:]):
+        previous.relationships[NodeRelationship.NEXT] = node.as_related_node_info()
+        node.relationships[NodeRelationship.PREVIOUS] = previous.as_related_node_info()
+    return nodes
+
+class PatentNodeParser(NodeParser):
+    """
+    Node parser chunking patent text on paragraph boundaries.
+
+    Paragraphs are separated by blank lines, as written by
+    utilsEPO.get_patent_info_from_description. Their numbers are kept in the
+    'paragraphs' metadata of the nodes.
+    """
+    chunk_size: int = Field(default=DEFAULT_CHUNK_SIZE, gt=0, description="Maximum number of tokens of a chunk.")
+    chunk_overlap: int = Field(default=DEFAULT_CHUNK_OVERLAP, ge=0, description="Maximum number of tokens repeated from the previous chunk.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PatentNodeParser"
+
+    def _parse_nodes(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> List[BaseNode]:
+        """
+        Chunk every node, keeping the metadata and the source document of the node.
+
+        Args:
+            nodes (Sequence[BaseNode]): Documents or nodes to chunk.
+            show_progress (bool): Whether to show a progress bar.
+
+        Returns:
+            List[BaseNode]: Chunks.
+        """
+        all_nodes = []
+        for node in get_tqdm_iterable(nodes, show_progress, "Chunking patent text"):
+            chunks = chunk_text(node.get_content(), None, self.chunk_size, self.chunk_overlap)
+            chunk_nodes = nodes_from_chunks(chunks, node.metadata)
+            for chunk_node in chunk_nodes:
+                chunk_node.excluded_embed_metadata_keys = list(set(node.excluded_embed_metadata_keys) | {'paragraphs'})
+                chunk_node.excluded_llm_metadata_keys = list(node.excluded_llm_metadata_keys)
+                chunk_node.relationships[NodeRelationship.SOURCE] = node.as_related_node_info()
+            all_nodes.extend(chunk_nodes)
+        return all_nodes
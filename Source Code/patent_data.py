@@ -0,0 +1,313 @@
+# Standard library imports
+import io
+import sys
+import threading
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Optional
+
+# Description sections of a claim, in the order they are given to the LLM
+SECTIONS = (
+    'field_of_invention_text',
+    'background_of_the_invention_text',
+    'summary_of_the_invention_text',
+    'brief_description_of_the_drawings_text',
+    'detailed_description_of_the_embodiments_text'
+)
+
+def _intern(text: Optional[str]) -> Optional[str]:
+    """
+    Intern a text so the copies decoded from the cache share one string.
+
+    Args:
+        text (str, optional): Text to intern.
+
+    Returns:
+        str or None: Interned text.
+    """
+    return sys.intern(text) if text else text
+
+class PatentImages:
+    """
+    Drawing sheets of a patent, decoded and encoded only when first used.
+
+    The raw attachments are kept as fetched. PIL images, JPEG bytes and their
+    base64 encoding are materialized per sheet on first access, so stages
+    that only need the top images do not encode every sheet. The perceptual
+    hashes of the sheets are computed once, to collapse repeated sheets.
+    """
+    __slots__ = ('raw', '_pil', '_jpeg', '_encoded', '_hashes', '_lock')
+
+    def __init__(self, raw: List[bytes]):
+        """
+        Args:
+            raw (List[bytes]): Attachments as fetched from EPAB.
+        """
+        self.raw = raw
+        self._pil = [None] * len(raw)
+        self._jpeg = [None] * len(raw)
+        self._encoded = [None] * len(raw)
+        self._hashes = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def pil(self, idx: int):
+        """
+        Get a sheet as a PIL image.
+
+        Args:
+            idx (int): Sheet index.
+
+        Returns:
+            PIL.Image: Decoded sheet.
+        """
+        with self._lock:
+            if self._pil[idx] is None:
+                from PIL import Image as PILImage
+                self._pil[idx] = PILImage.open(io.BytesIO(self.raw[idx]))
+            return self._pil[idx]
+
+    def jpeg(self, idx: int) -> bytes:
+        """
+        Get a sheet as JPEG bytes.
+
+        Args:
+            idx (int): Sheet index.
+
+        Returns:
+            bytes: JPEG encoded sheet.
+        """
+        if self._jpeg[idx] is None:
+            import utils
+            image = self.pil(idx)
+            with self._lock:
+                self._jpeg[idx] = utils.encode_image_bytes(image)
+        return self._jpeg[idx]
+
+    def encoded(self, idx: int) -> str:
+        """
+        Get a sheet as base64 encoded JPEG, as sent to the LLM.
+
+        Args:
+            idx (int): Sheet index.
+
+        Returns:
+            str: Base64 encoded sheet.
+        """
+        if self._encoded[idx] is None:
+            import utils
+            self._encoded[idx] = utils.encode_image_array(None, self.jpeg(idx))
+        return self._encoded[idx]
+
+    @property
+    def pil_images(self) -> list:
+        """
+        list: Every sheet as a PIL image.
+        """
+        return [self.pil(idx) for idx in range(len(self))]
+
+    def perceptual_hashes(self) -> List[int]:
+        """
+        Get the difference hash of every sheet.
+
+        Returns:
+            List[int]: Hash of each sheet, see image_dedup.dhash.
+        """
+        if self._hashes is None:
+            import image_dedup
+            self._hashes = [image_dedup.dhash(self.pil(idx)) for idx in range(len(self))]
+        return self._hashes
+
+    def duplicate_groups(self, threshold: Optional[int] = None) -> List[int]:
+        """
+        Group the repeated and near-identical sheets.
+
+        Args:
+            threshold (int, optional): Maximum number of differing hash bits, image_dedup.DEFAULT_THRESHOLD if None.
+
+        Returns:
+            List[int]: Index of the sheet representing each sheet.
+        """
+        import image_dedup
+        return image_dedup.group_duplicates(self.perceptual_hashes(), image_dedup.DEFAULT_THRESHOLD if threshold is None else threshold)
+
+@dataclass(slots=True, eq=False)
+class PatentData:
+    """
+    Data of one claim of a patent: the claim, its dependent claims, the
+    requested description sections and the drawings.
+
+    Section texts are interned and the drawings are shared with the other
+    claims of the patent. The concatenated view of the patent information and
+    the offsets of each part in it are computed once.
+    """
+    patent_number: str
+    claim_number: int
+    claim_text: str = ''
+    dependent_claims_text: List[str] = field(default_factory=list)
+    field_of_invention_text: Optional[str] = None
+    background_of_the_invention_text: Optional[str] = None
+    summary_of_the_invention_text: Optional[str] = None
+    brief_description_of_the_drawings_text: Optional[str] = None
+    detailed_description_of_the_embodiments_text: Optional[str] = None
+    reference_index: Optional[dict] = None
+    sheet_labels: Optional[list] = None
+    paragraph_numbers: Optional[Dict[str, list]] = None
+    images: Optional[PatentImages] = None
+    _info_text: Optional[str] = field(default=None, repr=False)
+    _char_offsets: Optional[Dict[str, tuple]] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        self.claim_text = _intern(self.claim_text)
+        self.dependent_claims_text = [_intern(text) for text in self.dependent_claims_text or []]
+        for section in SECTIONS:
+            setattr(self, section, _intern(getattr(self, section)))
+
+    def sections(self) -> Dict[str, str]:
+        """
+        Get the description sections that were requested and found.
+
+        Returns:
+            Dict[str, str]: Section texts keyed by section name, in SECTIONS order.
+        """
+        return {section: getattr(self, section) for section in SECTIONS if getattr(self, section)}
+
+    @property
+    def has_patent_info(self) -> bool:
+        """
+        bool: Whether any dependent claim or description section is present.
+        """
+        return bool(self.dependent_claims_text) or bool(self.sections())
+
+    def _build_info_text(self) -> None:
+        """
+        Concatenate the dependent claims and the sections, recording the character offsets of each part.
+        """
+        parts = []
+        if self.dependent_claims_text:
+            parts.append(('dependent_claims_text', ' '.join(self.dependent_claims_text)))
+        parts.extend(self.sections().items())
+
+        offsets, start = {}, 0
+        for name, text in parts:
+            offsets[name] = (start, start + len(text))
+            start += len(text) + 1
+        self._info_text = ' '.join(text for _, text in parts)
+        self._char_offsets = offsets
+
+    @property
+    def info_text(self) -> str:
+        """
+        str: Dependent claims and description sections joined by spaces, computed once.
+        """
+        if self._info_text is None:
+            self._build_info_text()
+        return self._info_text
+
+    @property
+    def char_offsets(self) -> Dict[str, tuple]:
+        """
+        Dict[str, tuple]: (start, end) character offsets of the dependent claims and of each section in info_text.
+        """
+        if self._char_offsets is None:
+            self._build_info_text()
+        return self._char_offsets
+
+    def part_text(self, name: str) -> Optional[str]:
+        """
+        Get the text of the dependent claims or of a section as it appears in info_text.
+
+        Args:
+            name (str): 'dependent_claims_text' or a section name.
+
+        Returns:
+            str or None: Text of the part, None if absent.
+        """
+        if name in SECTIONS:
+            # The section string itself, without copying it out of info_text
+            return getattr(self, name)
+        offsets = self.char_offsets.get(name)
+        return self.info_text[offsets[0]:offsets[1]] if offsets else None
+
+    def chunks(self, section: str, chunk_size: int, chunk_overlap: int) -> tuple:
+        """
+        Get the paragraph-aligned chunks of a section, shared by retrieval and validation.
+
+        The chunks are cached per section text, so the claims of a patent share them.
+
+        Args:
+            section (str): Section name.
+            chunk_size (int): Maximum number of tokens of a chunk.
+            chunk_overlap (int): Maximum number of tokens repeated from the previous chunk.
+
+        Returns:
+            tuple: Chunks with their 'text' and 'paragraphs' numbers, empty if the section is absent.
+        """
+        text = getattr(self, section)
+        if not text:
+            return ()
+        from patent_chunking import chunk_text
+        numbers = (self.paragraph_numbers or {}).get(section)
+        return chunk_text(text, tuple(numbers) if numbers else None, chunk_size, chunk_overlap)
+
+    def to_dict(self, include_images: bool = True) -> dict:
+        """
+        Convert to a dict of plain values for serialization.
+
+        Args:
+            include_images (bool): Whether to include the raw drawings.
+
+        Returns:
+            dict: Plain values, with the memoized offsets.
+        """
+        data = {f.name: getattr(self, f.name) for f in fields(self) if not f.name.startswith('_') and f.name != 'images'}
+        data['images'] = self.images.raw if include_images and self.images is not None else None
+        data['char_offsets'] = self.char_offsets
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PatentData':
+        """
+        Rebuild from to_dict output.
+
+        Args:
+            data (dict): Output of to_dict.
+
+        Returns:
+            PatentData: Rebuilt data.
+        """
+        data = dict(data)
+        images = data.pop('images', None)
+        char_offsets = data.pop('char_offsets', None)
+        patent_data = cls(images=PatentImages(list(images)) if images else None, **data)
+        if char_offsets is not None:
+            patent_data._char_offsets = {name: tuple(offsets) for name, offsets in char_offsets.items()}
+        return patent_data
+
+    def to_msgpack(self, include_images: bool = True) -> bytes:
+        """
+        Serialize to msgpack, with the drawings as raw binary.
+
+        Args:
+            include_images (bool): Whether to include the raw drawings.
+
+        Returns:
+            bytes: Serialized data.
+        """
+        import msgpack
+        return msgpack.packb(self.to_dict(include_images), use_bin_type=True)
+
+    @classmethod
+    def from_msgpack(cls, payload: bytes) -> 'PatentData':
+        """
+        Deserialize from to_msgpack output.
+
+        Args:
+            payload (bytes): Serialized data.
+
+        Returns:
+            PatentData: Deserialized data.
+        """
+        import msgpack
+        return cls.from_dict(msgpack.unpackb(payload, raw=False, strict_map_key=False))
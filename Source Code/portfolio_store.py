@@ -0,0 +1,446 @@
+# Standard library imports
+import os
+import json
+import sqlite3
+from contextlib import closing
+from typing import List, Optional
+
+# Third-party library imports
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+class PortfolioStore:
+    """
+    Persistent vector store over the section chunks of every processed patent.
+
+    Vectors are appended to a memory-mapped float16 file and the chunk
+    metadata lives in SQLite, so searches only read the rows they score. An
+    inverted file (IVF) of k-means centroids restricts cross-patent searches
+    to the closest clusters. Deleted rows are tombstoned until compact().
+    The embedding model and chunking the chunks were built with are recorded,
+    so a store is never searched with vectors of another model.
+    """
+
+    def __init__(self, path: str, n_lists: int = 256, n_probe: int = 8, signature: Optional[dict] = None):
+        """
+        Open or create a store.
+
+        Args:
+            path (str): Directory of the store.
+            n_lists (int): Number of IVF clusters.
+            n_probe (int): Number of clusters searched per query.
+            signature (dict, optional): Embedding model and chunking parameters of the chunks, checked
+                against the ones recorded in the store. Not checked if None.
+
+        Raises:
+            ValueError: If the store was built with another signature.
+        """
+        self.path = path
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, 'vectors.f16')
+        self.centroids_path = os.path.join(path, 'centroids.npy')
+        self.db_path = os.path.join(path, 'chunks.sqlite')
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, patent_number TEXT, section TEXT, text TEXT, cluster INTEGER, deleted INTEGER DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS chunks_patent ON chunks (patent_number, section)')
+            conn.execute('CREATE INDEX IF NOT EXISTS chunks_cluster ON chunks (cluster)')
+            conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+
+        if signature is not None:
+            self._check_signature(signature)
+
+        self.centroids = None
+        self._centroids_mtime = None
+        self._refresh_centroids()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the metadata database. One connection is used per call so the store can be shared between threads.
+
+        Returns:
+            sqlite3.Connection: Database connection.
+        """
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _check_signature(self, signature: dict) -> None:
+        """
+        Record the signature of a new store, or check it against the recorded one.
+
+        Args:
+            signature (dict): Embedding model and chunking parameters.
+
+        Raises:
+            ValueError: If the store was built with another signature, or before signatures were recorded.
+        """
+        value = json.dumps(signature, sort_keys=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT value FROM info WHERE key = 'signature'").fetchone()
+            if row is None:
+                if conn.execute('SELECT 1 FROM chunks LIMIT 1').fetchone() is not None:
+                    raise ValueError(f'The portfolio store {self.path} does not record the embedding model and chunking of its chunks. Use a new directory')
+                conn.execute("INSERT INTO info (key, value) VALUES ('signature', ?)", (value,))
+            elif row[0] != value:
+                raise ValueError(f'The portfolio store {self.path} was built with {row[0]}, not {value}. Use another directory for this configuration')
+
+    def _refresh_centroids(self) -> None:
+        """
+        Load the IVF centroids when centroids.npy appeared or changed, e.g. trained by another process sharing the store.
+        """
+        try:
+            mtime = os.stat(self.centroids_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._centroids_mtime:
+            self.centroids = np.load(self.centroids_path)
+            self._centroids_mtime = mtime
+
+    @property
+    def dim(self) -> Optional[int]:
+        """
+        Dimension of the stored vectors, None for an empty store.
+        """
+        with closing(self._connect()) as conn:
+            return self._dim(conn)
+
+    def _dim(self, conn: sqlite3.Connection) -> Optional[int]:
+        """
+        Read the dimension of the stored vectors with a connection, inside its transaction.
+
+        Args:
+            conn (sqlite3.Connection): Database connection.
+
+        Returns:
+            int or None: Dimension, None for an empty store.
+        """
+        row = conn.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def _vectors(self, conn: Optional[sqlite3.Connection] = None) -> np.ndarray:
+        """
+        Memory-map the vectors file read-only.
+
+        Args:
+            conn (sqlite3.Connection, optional): Connection whose transaction holds a lock on the store.
+
+        Returns:
+            np.ndarray: Memory-mapped (n_rows, dim) float16 array.
+        """
+        dim = self._dim(conn) if conn is not None else self.dim
+        if dim is None or not os.path.exists(self.vectors_path) or os.path.getsize(self.vectors_path) == 0:
+            return np.zeros((0, dim or 0), dtype=np.float16)
+        return np.memmap(self.vectors_path, dtype=np.float16, mode='r').reshape(-1, dim)
+
+    def _assign_clusters(self, embeddings: np.ndarray) -> List[Optional[int]]:
+        """
+        Assign embeddings to their nearest IVF centroid.
+
+        Args:
+            embeddings (np.ndarray): Normalized embeddings.
+
+        Returns:
+            List[Optional[int]]: Cluster of each embedding, None if the store is not trained.
+        """
+        if self.centroids is None:
+            return [None] * len(embeddings)
+        return np.argmax(embeddings @ self.centroids.T, axis=1).tolist()
+
+    def _assign_unclustered(self, conn: sqlite3.Connection) -> None:
+        """
+        Assign the rows inserted before the centroids were trained, e.g. by a process that opened the store earlier.
+
+        Args:
+            conn (sqlite3.Connection): Connection holding the write lock.
+        """
+        rows = [row[0] for row in conn.execute('SELECT row FROM chunks WHERE cluster IS NULL AND deleted = 0 ORDER BY row')]
+        if not rows:
+            return
+        vectors = self._vectors(conn)
+        for start in range(0, len(rows), 65536):
+            block_rows = rows[start:start + 65536]
+            clusters = self._assign_clusters(np.asarray(vectors[block_rows], dtype=np.float32))
+            conn.executemany('UPDATE chunks SET cluster = ? WHERE row = ?', list(zip(clusters, block_rows)))
+
+    def has(self, patent_number: str, section: Optional[str] = None) -> bool:
+        """
+        Check whether a patent (or one of its sections) is stored.
+
+        Args:
+            patent_number (str): Publication number of the patent.
+            section (str, optional): Section name.
+
+        Returns:
+            bool: True if at least one chunk is stored.
+        """
+        query = 'SELECT 1 FROM chunks WHERE deleted = 0 AND patent_number = ?'
+        params = [patent_number]
+        if section is not None:
+            query += ' AND section = ?'
+            params.append(section)
+        with closing(self._connect()) as conn:
+            return conn.execute(query + ' LIMIT 1', params).fetchone() is not None
+
+    def add(self, patent_number: str, section: str, texts: List[str], embeddings) -> None:
+        """
+        Insert the chunks of a patent section, replacing the ones already stored.
+
+        Args:
+            patent_number (str): Publication number of the patent.
+            section (str): Section name.
+            texts (List[str]): Chunk texts.
+            embeddings: Chunk embeddings, one row per text.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        with closing(self._connect()) as conn, conn:
+            # Lock the store while the vectors file is appended, the old chunks are replaced in the same transaction
+            conn.execute('BEGIN IMMEDIATE')
+            self._delete(conn, patent_number, section)
+            self._refresh_centroids()
+            dim = self._dim(conn)
+            if dim is None:
+                conn.execute("INSERT INTO info (key, value) VALUES ('dim', ?)", (str(embeddings.shape[1]),))
+            elif dim != embeddings.shape[1]:
+                raise ValueError(f'Embedding dimension {embeddings.shape[1]} does not match the store dimension {dim}')
+
+            first_row = os.path.getsize(self.vectors_path) // (2 * embeddings.shape[1]) if os.path.exists(self.vectors_path) else 0
+            with open(self.vectors_path, 'ab') as f:
+                f.write(embeddings.astype(np.float16).tobytes())
+
+            clusters = self._assign_clusters(embeddings)
+            conn.executemany(
+                'INSERT INTO chunks (row, patent_number, section, text, cluster) VALUES (?, ?, ?, ?, ?)',
+                [(first_row + i, patent_number, section, text, cluster) for i, (text, cluster) in enumerate(zip(texts, clusters))]
+            )
+            if self.centroids is not None:
+                self._assign_unclustered(conn)
+
+        # Train the IVF once the store is large enough for brute force to become slow
+        if self.centroids is None:
+            with closing(self._connect()) as conn:
+                n_rows = conn.execute('SELECT COUNT(*) FROM chunks WHERE deleted = 0').fetchone()[0]
+            if n_rows >= 40 * self.n_lists:
+                self.train()
+
+    def delete(self, patent_number: str, section: Optional[str] = None) -> None:
+        """
+        Delete the chunks of a patent (or of one of its sections).
+
+        Args:
+            patent_number (str): Publication number of the patent.
+            section (str, optional): Section name. All sections if None.
+        """
+        with closing(self._connect()) as conn, conn:
+            self._delete(conn, patent_number, section)
+
+    def _delete(self, conn: sqlite3.Connection, patent_number: str, section: Optional[str] = None) -> None:
+        """
+        Tombstone the chunks of a patent (or of one of its sections) in the transaction of a connection.
+
+        Args:
+            conn (sqlite3.Connection): Connection of the transaction.
+            patent_number (str): Publication number of the patent.
+            section (str, optional): Section name. All sections if None.
+        """
+        query = 'UPDATE chunks SET deleted = 1 WHERE patent_number = ?'
+        params = [patent_number]
+        if section is not None:
+            query += ' AND section = ?'
+            params.append(section)
+        conn.execute(query, params)
+
+    def train(self, sample_size: int = 50000, n_iter: int = 20, seed: int = 0) -> None:
+        """
+        Train the IVF centroids with k-means on a sample of the stored vectors and assign every chunk to a cluster.
+
+        Args:
+            sample_size (int): Maximum number of vectors used for training.
+            n_iter (int): Number of k-means iterations.
+            seed (int): Random seed.
+        """
+        vectors = self._vectors()
+        if len(vectors) < self.n_lists:
+            print(f'Not enough vectors to train {self.n_lists} clusters: {len(vectors)}')
+            return
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+        data = np.asarray(vectors[sample], dtype=np.float32)
+        centroids = data[rng.choice(len(data), size=self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignment = np.argmax(data @ centroids.T, axis=1)
+            for cluster in range(self.n_lists):
+                members = data[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        # Write then rename, so other processes never load a partial file
+        tmp_path = self.centroids_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, centroids)
+        os.replace(tmp_path, self.centroids_path)
+        self.centroids = centroids
+        self._centroids_mtime = os.stat(self.centroids_path).st_mtime_ns
+
+        # Assign every row in blocks to bound memory, locked so no compaction renumbers the rows meanwhile
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            vectors = self._vectors(conn)
+            for start in range(0, len(vectors), 65536):
+                block = np.asarray(vectors[start:start + 65536], dtype=np.float32)
+                clusters = self._assign_clusters(block)
+                conn.executemany('UPDATE chunks SET cluster = ? WHERE row = ?', [(cluster, start + i) for i, cluster in enumerate(clusters)])
+
+    def search(self, query_embedding, top_k: int = 4, patent_numbers: Optional[List[str]] = None, sections: Optional[List[str]] = None, exclude_patents: Optional[List[str]] = None) -> List[dict]:
+        """
+        Search the closest chunks to a query embedding.
+
+        Searches scoped to patents read only their rows. Cross-patent searches
+        only read the rows of the n_probe closest clusters once trained, plus
+        the rows inserted before the centroids were known, which have no cluster.
+
+        Args:
+            query_embedding: Query embedding.
+            top_k (int): Number of chunks to return.
+            patent_numbers (List[str], optional): Only search these patents.
+            sections (List[str], optional): Only search these sections.
+            exclude_patents (List[str], optional): Patents to exclude.
+
+        Returns:
+            List[dict]: Chunks with 'text', 'patent_number', 'section' and 'score', by decreasing score.
+        """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+
+        query = 'SELECT row, patent_number, section, text FROM chunks WHERE deleted = 0'
+        params = []
+        for column, values, operator in [('patent_number', patent_numbers, 'IN'), ('section', sections, 'IN'), ('patent_number', exclude_patents, 'NOT IN')]:
+            if values:
+                query += f" AND {column} {operator} ({', '.join('?' * len(values))})"
+                params.extend(values)
+        self._refresh_centroids()
+        if not patent_numbers and self.centroids is not None:
+            probes = np.argsort(-(self.centroids @ query_embedding))[:self.n_probe].tolist()
+            query += f" AND (cluster IN ({', '.join('?' * len(probes))}) OR cluster IS NULL)"
+            params.extend(probes)
+
+        with closing(self._connect()) as conn:
+            # Map the vectors in the same read transaction, so a compaction cannot renumber the rows in between
+            conn.execute('BEGIN')
+            rows = conn.execute(query + ' ORDER BY row', params).fetchall()
+            vectors = self._vectors(conn) if rows else None
+            conn.commit()
+        if not rows:
+            return []
+
+        scores = np.empty(len(rows), dtype=np.float32)
+        # Score in blocks so only the selected rows are read from disk
+        for start in range(0, len(rows), 65536):
+            block_rows = [row[0] for row in rows[start:start + 65536]]
+            scores[start:start + len(block_rows)] = np.asarray(vectors[block_rows], dtype=np.float32) @ query_embedding
+
+        best = np.argsort(-scores)[:top_k]
+        return [
+            {'text': rows[i][3], 'patent_number': rows[i][1], 'section': rows[i][2], 'score': float(scores[i])}
+            for i in best
+        ]
+
+    def compact(self) -> None:
+        """
+        Rewrite the store without the deleted chunks.
+
+        The store is locked exclusively for the whole compaction: writers
+        would append to the file being replaced and readers would map the new
+        file with the old row numbers.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute('BEGIN EXCLUSIVE')
+            vectors = self._vectors(conn)
+            rows = conn.execute('SELECT row, patent_number, section, text, cluster FROM chunks WHERE deleted = 0 ORDER BY row').fetchall()
+            tmp_path = self.vectors_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for start in range(0, len(rows), 65536):
+                    block_rows = [row[0] for row in rows[start:start + 65536]]
+                    f.write(np.asarray(vectors[block_rows], dtype=np.float16).tobytes())
+            del vectors
+
+            conn.execute('DELETE FROM chunks')
+            conn.executemany(
+                'INSERT INTO chunks (row, patent_number, section, text, cluster) VALUES (?, ?, ?, ?, ?)',
+                [(new_row, *row[1:]) for new_row, row in enumerate(rows)]
+            )
+            os.replace(tmp_path, self.vectors_path)
+
+class PortfolioRetriever(BaseRetriever):
+    """
+    Retriever over a PortfolioStore, usable as a HierarchicalQueryEngine index.
+    """
+
+    def __init__(self, store: PortfolioStore, similarity_top_k: int = 2, patent_numbers: Optional[List[str]] = None, sections: Optional[List[str]] = None, exclude_patents: Optional[List[str]] = None):
+        """
+        Initialize the retriever.
+
+        Args:
+            store (PortfolioStore): Store to search.
+            similarity_top_k (int): Number of nodes to return.
+            patent_numbers, sections, exclude_patents (List[str], optional): Metadata filters of PortfolioStore.search.
+        """
+        super().__init__()
+        self.store = store
+        self.similarity_top_k = similarity_top_k
+        self.filters = {'patent_numbers': patent_numbers, 'sections': sections, 'exclude_patents': exclude_patents}
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Retrieve the closest chunks of the store.
+
+        Args:
+            query_bundle (QueryBundle): Query.
+
+        Returns:
+            List[NodeWithScore]: Retrieved chunks.
+        """
+        query_embedding = Settings.embed_model.get_query_embedding(query_bundle.query_str)
+        results = self.store.search(query_embedding, top_k=self.similarity_top_k, **self.filters)
+        return [
+            NodeWithScore(
+                node=TextNode(text=result['text'], metadata={'patent_number': result['patent_number'], 'section': result['section']}),
+                score=result['score']
+            )
+            for result in results
+        ]
+
+class PortfolioIndex:
+    """
+    View of a PortfolioStore mirroring VectorStoreIndex.as_retriever.
+    """
+
+    def __init__(self, store: PortfolioStore, **filters):
+        """
+        Initialize the view.
+
+        Args:
+            store (PortfolioStore): Store to search.
+            **filters: Metadata filters of PortfolioStore.search.
+        """
+        self.store = store
+        self.filters = filters
+
+    def as_retriever(self, similarity_top_k: int = 2, **kwargs) -> PortfolioRetriever:
+        """
+        Get a retriever over the filtered store.
+
+        Args:
+            similarity_top_k (int): Number of nodes to return.
+
+        Returns:
+            PortfolioRetriever: Retriever over the store.
+        """
+        return PortfolioRetriever(self.store, similarity_top_k=similarity_top_k, **self.filters)
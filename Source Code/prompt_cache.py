@@ -0,0 +1,310 @@
+# Standard library imports
+import json
+import hashlib
+import threading
+from types import SimpleNamespace
+
+# Beta header enabling provider-side prompt caching
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+# Sentences replacing {information} in the templates once the context is moved to the cached prefix,
+# without and with the description sections
+CONTEXT_REFERENCE = 'The claim is given under "Claims Information" in the system prompt.'
+CONTEXT_REFERENCE_WITH_SECTIONS = (
+    'The claim is given under "Claims Information" in the system prompt. '
+    'You can use the other patent information given there to improve your answer.'
+)
+
+# Accumulated token usage of every request sent through this module
+cache_stats = {
+    'requests': 0,
+    'input_tokens': 0,
+    'cache_creation_input_tokens': 0,
+    'cache_read_input_tokens': 0,
+    'output_tokens': 0
+}
+
+_stats_lock = threading.Lock()
+
+_client = None
+
+def get_client():
+    """
+    Get the Anthropic client shared by every LLM stage.
+
+    Returns:
+        anthropic.Anthropic: Shared client instance (or the client set with set_client).
+    """
+    global _client
+    if _client is None:
+        import anthropic
+        _client = anthropic.Anthropic()
+    return _client
+
+def set_client(client):
+    """
+    Replace the shared client, e.g. with a MockAnthropic instance for local runs.
+
+    Args:
+        client: Object implementing the messages.stream interface of anthropic.Anthropic.
+    """
+    global _client
+    _client = client
+
+def record_usage(usage, requests: int = 1):
+    """
+    Add the token usage of a response to cache_stats.
+
+    Args:
+        usage: Usage object of an Anthropic message.
+        requests (int): Number of requests the usage belongs to, 0 for the final usage of a streamed message.
+    """
+    if usage is None:
+        return
+    with _stats_lock:
+        cache_stats['requests'] += requests
+        for key in ['input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens', 'output_tokens']:
+            cache_stats[key] += getattr(usage, key, None) or 0
+
+def usage_snapshot() -> dict:
+    """
+    Copy the accumulated usage, to measure the usage of a single run with usage_since.
+
+    Returns:
+        dict: Copy of cache_stats.
+    """
+    with _stats_lock:
+        return dict(cache_stats)
+
+def usage_since(snapshot: dict) -> dict:
+    """
+    Get the usage accumulated since a snapshot.
+
+    Args:
+        snapshot (dict): Output of usage_snapshot.
+
+    Returns:
+        dict: Requests and token counts since the snapshot.
+    """
+    current = usage_snapshot()
+    return {key: current[key] - snapshot.get(key, 0) for key in current}
+
+def build_system_context(context) -> list:
+    """
+    Build the system blocks holding the shared patent context, marked as cacheable.
+
+    Each part of the context ends with a cache breakpoint, so a request sharing
+    only the first parts still reads them from the cache.
+
+    Args:
+        context (str or list): Patent context, or its parts from the most to the least shared.
+            Empty parts are skipped.
+
+    Returns:
+        list: System content blocks with a cache breakpoint after each part.
+    """
+    parts = [context] if isinstance(context, str) else [part for part in context if part]
+    return [{
+        "type": "text",
+        "text": ("Patent information:\n" if idx == 0 else "") + part,
+        "cache_control": {"type": "ephemeral"}
+    } for idx, part in enumerate(parts)]
+
+def stream_cached_completion(client, model: str, context: str, instructions: str, images: list = None, max_tokens: int = 1024, temperature: float = 0.0):
+    """
+    Stream a completion whose stable prefix is the cached patent context.
+
+    The context is sent in the system prompt so every stage and every request
+    on the same context shares an identical cacheable prefix. Only the stage
+    specific images and instructions follow it.
+
+    Args:
+        client: Anthropic client instance.
+        model (str): Name of the language model to use.
+        context (str or list): Patent context shared between stages, or its parts (see build_system_context).
+        instructions (str): Stage specific instructions.
+        images (list, optional): List of base64 encoded images.
+        max_tokens (int): Maximum number of tokens for the response.
+        temperature (float): Sampling temperature.
+
+    Yields:
+        str: Text deltas of the completion.
+    """
+    content = []
+
+    # Add each image to the content
+    for image in images or []:
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": "image/jpeg",
+                "data": image,
+            },
+        })
+
+    # Add the text input
+    content.append({
+        "type": "text",
+        "text": instructions
+    })
+
+    # Closing the generator closes the connection
+    with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system=build_system_context(context),
+        messages=[
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+        extra_headers=PROMPT_CACHING_HEADERS,
+    ) as stream:
+        output_tokens = 0
+        for event in stream:
+            if event.type == 'message_start':
+                record_usage(event.message.usage)
+                output_tokens = getattr(event.message.usage, 'output_tokens', None) or 0
+            elif event.type == 'message_delta' and getattr(event, 'usage', None) is not None:
+                # The final output token count is only sent with message_delta, it is cumulative
+                final_output_tokens = getattr(event.usage, 'output_tokens', None) or 0
+                record_usage(SimpleNamespace(output_tokens=final_output_tokens - output_tokens), requests=0)
+                output_tokens = final_output_tokens
+            elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                yield event.delta.text
+
+def _count_tokens(block) -> int:
+    """
+    Roughly estimate the number of tokens of a content block.
+
+    Args:
+        block (dict or str): Content block.
+
+    Returns:
+        int: Estimated number of tokens.
+    """
+    if isinstance(block, str):
+        return max(1, len(block) // 4)
+    if block.get('type') == 'image':
+        return 1600
+    return max(1, len(block.get('text', '')) // 4)
+
+class MockAnthropic:
+    """
+    Local stand-in for anthropic.Anthropic with prompt cache accounting.
+
+    The prefix up to each cache_control breakpoint is hashed. The longest
+    repeated prefix is reported as cache_read_input_tokens and the rest of the
+    prefix up to the last breakpoint as cache_creation_input_tokens, mirroring
+    the provider usage fields.
+    """
+
+    def __init__(self, responses=None, min_cacheable_tokens: int = 1024):
+        """
+        Initialize the mock client.
+
+        Args:
+            responses (list, optional): Texts returned in order. The last one is repeated.
+            min_cacheable_tokens (int): Minimum prefix length that can be cached.
+        """
+        self.responses = list(responses or ['{"summary": "", "reference": {}}'])
+        self.min_cacheable_tokens = min_cacheable_tokens
+        self.cached_prefixes = set()
+        self.requests = []
+        self.messages = SimpleNamespace(create=self.create, stream=self.stream)
+
+    def _usage(self, system, messages) -> SimpleNamespace:
+        """
+        Compute the token usage of a request and update the cache.
+
+        Args:
+            system (list or str): System prompt.
+            messages (list): Request messages.
+
+        Returns:
+            SimpleNamespace: Usage with input and cache token counts.
+        """
+        blocks = [system] if isinstance(system, str) else list(system or [])
+        for message in messages:
+            content = message['content']
+            blocks.extend([content] if isinstance(content, str) else content)
+
+        # Prefixes ending at a cache breakpoint that are long enough to be cached
+        prefixes = []
+        for idx, block in enumerate(blocks):
+            if isinstance(block, dict) and block.get('cache_control'):
+                prefix_tokens = sum(_count_tokens(block) for block in blocks[:idx + 1])
+                if prefix_tokens >= self.min_cacheable_tokens:
+                    key = hashlib.sha256(json.dumps(blocks[:idx + 1], sort_keys=True).encode('utf-8')).hexdigest()
+                    prefixes.append((key, prefix_tokens))
+
+        total_tokens = sum(_count_tokens(block) for block in blocks)
+        usage = SimpleNamespace(input_tokens=total_tokens, cache_creation_input_tokens=0, cache_read_input_tokens=0, output_tokens=0)
+
+        if prefixes:
+            usage.cache_read_input_tokens = max([tokens for key, tokens in prefixes if key in self.cached_prefixes], default=0)
+            usage.cache_creation_input_tokens = prefixes[-1][1] - usage.cache_read_input_tokens
+            usage.input_tokens = total_tokens - prefixes[-1][1]
+            self.cached_prefixes.update(key for key, _ in prefixes)
+        return usage
+
+    def _next_response(self) -> str:
+        """
+        Get the next canned response.
+
+        Returns:
+            str: Response text.
+        """
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+    def create(self, model, max_tokens, messages, system=None, **kwargs):
+        """
+        Mock of messages.create.
+
+        Returns:
+            SimpleNamespace: Message with content and usage.
+        """
+        usage = self._usage(system, messages)
+        text = self._next_response()
+        usage.output_tokens = _count_tokens(text)
+        self.requests.append({'model': model, 'system': system, 'messages': messages, 'usage': usage})
+        return SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], usage=usage)
+
+    def stream(self, model, max_tokens, messages, system=None, **kwargs):
+        """
+        Mock of messages.stream.
+
+        Returns:
+            _MockStream: Context manager iterating over stream events.
+        """
+        message = self.create(model, max_tokens, messages, system=system, **kwargs)
+        return _MockStream(message)
+
+class _MockStream:
+    """
+    Context manager emitting the events of a mocked streamed message.
+    """
+
+    def __init__(self, message, chunk_size: int = 16):
+        self.message = message
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        # As with the provider, message_start only counts the first output token and message_delta the final count
+        start_usage = SimpleNamespace(**{**vars(self.message.usage), 'output_tokens': 1})
+        yield SimpleNamespace(type='message_start', message=SimpleNamespace(content=[], usage=start_usage))
+        text = self.message.content[0].text
+        for i in range(0, len(text), self.chunk_size):
+            delta = SimpleNamespace(type='text_delta', text=text[i:i + self.chunk_size])
+            yield SimpleNamespace(type='content_block_delta', delta=delta)
+        yield SimpleNamespace(type='message_delta', delta=SimpleNamespace(stop_reason='end_turn'), usage=SimpleNamespace(output_tokens=self.message.usage.output_tokens))
+        yield SimpleNamespace(type='message_stop')
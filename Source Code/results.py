@@ -0,0 +1,274 @@
+# Standard library imports
+import io
+import os
+import json
+import base64
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Third-party library imports
+from PIL import Image as PILImage
+
+def to_jsonable(value):
+    """
+    Convert a value holding bytes into a JSON serializable value, with bytes base64 encoded.
+
+    Args:
+        value: Value to convert (dict, list, bytes or JSON value).
+
+    Returns:
+        JSON serializable value.
+    """
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('utf-8')
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(item) for item in value]
+    return value
+
+def as_bytes(value) -> Optional[bytes]:
+    """
+    Get raw bytes from bytes or from their base64 encoding (results received as JSON).
+
+    Args:
+        value (bytes or str): Raw or base64 encoded bytes.
+
+    Returns:
+        bytes or None: Raw bytes.
+    """
+    if value is None or isinstance(value, bytes):
+        return value
+    return base64.b64decode(value)
+
+@dataclass
+class ClaimResult:
+    """
+    Result of the pipeline for one claim, kept in memory.
+
+    Images and the SVG are raw bytes, so the interactive path does not
+    encode, decode or read back files.
+    """
+    patent_number: str
+    claim_number: int
+    timestamp: str
+    summary: str = ''
+    references: dict = field(default_factory=dict)
+    claim_text: str = ''
+    dependent_claims_text: List[str] = field(default_factory=list)
+    top_images: List[bytes] = field(default_factory=list)
+    svg: Optional[bytes] = None
+    thumbnail: Optional[bytes] = None
+    output_filename: Optional[str] = None
+    metrics: dict = field(default_factory=dict)
+    timings: dict = field(default_factory=dict)
+    models: dict = field(default_factory=dict)
+    stages: dict = field(default_factory=dict)
+    usage: dict = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        """
+        Convert the result to a JSON serializable dict, with the images and SVG base64 encoded.
+
+        Returns:
+            dict: JSON serializable result.
+        """
+        return to_jsonable(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ClaimResult':
+        """
+        Rebuild a result from to_dict output.
+
+        Args:
+            data (dict): Result from to_dict.
+
+        Returns:
+            ClaimResult: Result with raw bytes.
+        """
+        data = dict(data)
+        data['top_images'] = [as_bytes(image) for image in data.get('top_images') or []]
+        data['svg'] = as_bytes(data.get('svg'))
+        data['thumbnail'] = as_bytes(data.get('thumbnail'))
+        return cls(**data)
+
+@dataclass
+class PatentResult:
+    """
+    Results of several claims of the same patent (multi-claim mode).
+    """
+    patent_number: str
+    timestamp: str
+    claims: Dict[int, ClaimResult] = field(default_factory=dict)
+    usage: dict = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        """
+        Convert the results to a JSON serializable dict.
+
+        Returns:
+            dict: JSON serializable results, claims keyed by claim number.
+        """
+        return {
+            'patent_number': self.patent_number,
+            'timestamp': self.timestamp,
+            'claims': {str(claim_number): result.to_dict() for claim_number, result in self.claims.items()},
+            'usage': self.usage
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PatentResult':
+        """
+        Rebuild results from to_dict output.
+
+        Args:
+            data (dict): Results from to_dict.
+
+        Returns:
+            PatentResult: Results with raw bytes.
+        """
+        claims = {int(claim_number): ClaimResult.from_dict(result) for claim_number, result in data['claims'].items()}
+        return cls(patent_number=data['patent_number'], timestamp=data['timestamp'], claims=claims, usage=data.get('usage') or {})
+
+def result_from_dict(data: dict):
+    """
+    Rebuild a ClaimResult or PatentResult from its to_dict output.
+
+    Args:
+        data (dict): Result from to_dict.
+
+    Returns:
+        ClaimResult or PatentResult: Rebuilt result.
+    """
+    return PatentResult.from_dict(data) if 'claims' in data else ClaimResult.from_dict(data)
+
+class ResultSink:
+    """
+    Optional disk persistence of the results, written in a background thread.
+
+    The retrieved images go to ./retrieved_images and the summary with its
+    metrics to ./summary, as the pipeline used to write them. The results can
+    also be appended to the columnar results store (results_store.py).
+    """
+
+    def __init__(self, summary_dir: str = './summary', images_dir: str = './retrieved_images', store_dir: str = './results_store'):
+        """
+        Initialize the sink.
+
+        Args:
+            summary_dir (str): Directory of the summary JSON files.
+            images_dir (str): Directory of the retrieved images.
+            store_dir (str): Directory of the columnar results store.
+        """
+        self.summary_dir = summary_dir
+        self.images_dir = images_dir
+        self.store_dir = store_dir
+        self._store = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.failures = []
+
+    def _write_images(self, result: ClaimResult, suffix: str) -> None:
+        """
+        Write the retrieved images of a claim as PNG files.
+
+        Args:
+            result (ClaimResult): Claim result.
+            suffix (str): Suffix of the file names before the image rank.
+        """
+        os.makedirs(self.images_dir, exist_ok=True)
+        for i, image in enumerate(result.top_images):
+            path = os.path.join(self.images_dir, f'{result.patent_number}_{result.timestamp}{suffix}_top{i}.png')
+            PILImage.open(io.BytesIO(image)).save(path, format='PNG')
+
+    def _append_to_store(self, result) -> None:
+        """
+        Append a result to the columnar results store, opened on first use.
+
+        Args:
+            result (ClaimResult or PatentResult): Result to append.
+        """
+        if self._store is None:
+            from results_store import ResultsStore
+            self._store = ResultsStore(self.store_dir)
+        self._store.append(result)
+
+    def _write(self, result, columnar: bool = False) -> str:
+        """
+        Write a result to disk.
+
+        Args:
+            result (ClaimResult or PatentResult): Result to write.
+            columnar (bool): Whether to also append it to the columnar results store.
+
+        Returns:
+            str: Path to the summary JSON file.
+        """
+        if columnar:
+            self._append_to_store(result)
+
+        os.makedirs(self.summary_dir, exist_ok=True)
+        if isinstance(result, PatentResult):
+            combined_data = {'patent_number': result.patent_number, 'claims': {}}
+            for claim_number, claim_result in result.claims.items():
+                self._write_images(claim_result, f'_claim{claim_number}')
+                combined_data['claims'][str(claim_number)] = {
+                    'summary': claim_result.summary,
+                    'reference': claim_result.references,
+                    'output_filename': claim_result.output_filename,
+                    'metrics': claim_result.metrics
+                }
+        else:
+            self._write_images(result, '')
+            combined_data = {'summary': result.summary, 'metrics': result.metrics}
+
+        filename = os.path.join(self.summary_dir, f'{result.patent_number}_{result.timestamp}.json')
+        with open(filename, 'w') as file:
+            json.dump(combined_data, file, indent=4)
+        return filename
+
+    def submit(self, result, columnar: bool = False) -> Future:
+        """
+        Write a result to disk in the background.
+
+        Args:
+            result (ClaimResult or PatentResult): Result to write.
+            columnar (bool): Whether to also append it to the columnar results store.
+
+        Returns:
+            Future: Future of the summary JSON path. A failed write is also logged and kept in failures.
+        """
+        future = self._executor.submit(self._write, result, columnar)
+
+        def log_failure(done: Future) -> None:
+            error = done.exception()
+            if error is not None:
+                print(f'Could not write the result of {result.patent_number} ({result.timestamp}): {error!r}')
+                self.failures.append((result.patent_number, result.timestamp, error))
+
+        future.add_done_callback(log_failure)
+        return future
+
+    def close(self) -> list:
+        """
+        Wait for the pending writes.
+
+        Returns:
+            list: (patent number, timestamp, exception) of every write that failed.
+        """
+        self._executor.shutdown(wait=True)
+        return self.failures
+
+_sink = None
+
+def get_sink() -> ResultSink:
+    """
+    Get the result sink shared by every run of the process.
+
+    Returns:
+        ResultSink: Shared sink.
+    """
+    global _sink
+    if _sink is None:
+        _sink = ResultSink()
+    return _sink
@@ -0,0 +1,290 @@
+# Standard library imports
+import os
+import re
+import json
+import uuid
+import argparse
+from datetime import datetime
+from typing import List, Optional
+
+# Third-party library imports
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+
+RESULTS_STORE_DIR = './results_store'
+
+# Metric groups and names of validation.evaluate_patent_claim_summary, one column each
+METRIC_GROUPS = [
+    'overall_metrics',
+    'dependent_claims_text',
+    'field_of_invention_text',
+    'background_of_the_invention_text',
+    'summary_of_the_invention_text',
+    'brief_description_of_the_drawings_text',
+    'detailed_description_of_the_embodiments_text'
+]
+METRIC_NAMES = ['cosine_similarity', 'ratio_summary_terms']
+
+# Stages reported by main.main, one timing column each
+STAGES = ['claims', 'summary', 'images', 'image_summary', 'svg', 'metrics']
+
+def metric_column(group: str, name: str) -> str:
+    """
+    Get the column of a validation metric.
+
+    "Ratio summary terms" and "Ratio of summary terms" map to the same column.
+
+    Args:
+        group (str): Metric group, 'overall_metrics' or a patent information section.
+        name (str): Metric name as reported by validation.
+
+    Returns:
+        str: Column name.
+    """
+    name = re.sub(r'\W+', '_', name.lower().replace(' of ', ' ')).strip('_')
+    return f'{group}__{name}'
+
+# Schema of the data files. The date is the partition key, it is not stored in the files.
+SCHEMA = pa.schema(
+    [
+        ('timestamp', pa.string()),
+        ('patent_number', pa.string()),
+        ('claim_number', pa.int32()),
+        ('summary', pa.string()),
+        ('references', pa.string()),
+        ('output_filename', pa.string()),
+        ('model_llm', pa.string()),
+        ('embed_model', pa.string()),
+        ('clip_model', pa.string()),
+        ('model_quantization', pa.string()),
+        ('tokenizer', pa.string()),
+        ('stop_words', pa.string())
+    ]
+    + [(metric_column(group, name), pa.float64()) for group in METRIC_GROUPS for name in METRIC_NAMES]
+    + [(f'{stage}_s', pa.float64()) for stage in STAGES]
+    + [('metrics_json', pa.string())]
+)
+PARTITIONING = ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+
+def result_rows(result) -> List[dict]:
+    """
+    Flatten a pipeline result into rows of the store, one per claim.
+
+    Args:
+        result (ClaimResult or PatentResult): Pipeline result.
+
+    Returns:
+        List[dict]: Rows following SCHEMA.
+    """
+    claim_results = list(result.claims.values()) if hasattr(result, 'claims') else [result]
+    rows = []
+    for claim_result in claim_results:
+        row = {
+            'timestamp': claim_result.timestamp,
+            'patent_number': claim_result.patent_number,
+            'claim_number': int(claim_result.claim_number),
+            'summary': claim_result.summary,
+            'references': json.dumps(claim_result.references),
+            'output_filename': claim_result.output_filename,
+            'metrics_json': json.dumps(claim_result.metrics)
+        }
+        for key in ['model_llm', 'embed_model', 'clip_model', 'model_quantization']:
+            row[key] = claim_result.models.get(key)
+        text_processing = (claim_result.metrics or {}).get('text_processing', {})
+        row['tokenizer'] = text_processing.get('Tokenizer')
+        row['stop_words'] = text_processing.get('Stop words')
+        for group, values in (claim_result.metrics or {}).items():
+            if group not in METRIC_GROUPS:
+                continue
+            for name, value in values.items():
+                column = metric_column(group, name)
+                if SCHEMA.get_field_index(column) >= 0:
+                    row[column] = float(value)
+        for stage, seconds in (claim_result.timings or {}).items():
+            if SCHEMA.get_field_index(f'{stage}_s') >= 0:
+                row[f'{stage}_s'] = float(seconds)
+        rows.append(row)
+    return rows
+
+class ResultsStore:
+    """
+    Append-only columnar store of the pipeline results, in Parquet files partitioned by date.
+
+    Every append writes a new file in the partition of its date
+    (<root>/date=YYYY-MM-DD/part-*.parquet), so several processes can append
+    at the same time. compact() merges the files of a partition.
+    """
+
+    def __init__(self, root: str = RESULTS_STORE_DIR):
+        """
+        Initialize the store.
+
+        Args:
+            root (str): Directory of the store.
+        """
+        self.root = root
+
+    def _partition_dir(self, date: str) -> str:
+        """
+        Get the directory of a date partition.
+
+        Args:
+            date (str): Date as YYYY-MM-DD.
+
+        Returns:
+            str: Partition directory.
+        """
+        return os.path.join(self.root, f'date={date}')
+
+    def _write(self, table: pa.Table, date: str, prefix: str) -> str:
+        """
+        Write a table to a new file of a partition. The file is renamed into place once complete.
+
+        Args:
+            table (pa.Table): Table following SCHEMA.
+            date (str): Date of the partition.
+            prefix (str): File name prefix, 'part' or 'compacted'.
+
+        Returns:
+            str: Path to the file.
+        """
+        directory = self._partition_dir(date)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{prefix}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet")
+        tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.tmp')
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        return path
+
+    def append(self, result) -> Optional[str]:
+        """
+        Append a pipeline result.
+
+        Args:
+            result (ClaimResult or PatentResult): Pipeline result.
+
+        Returns:
+            str or None: Path to the written file, None if the result has no claims.
+        """
+        rows = result_rows(result)
+        if not rows:
+            return None
+        date = datetime.strptime(result.timestamp, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d')
+        return self._write(pa.Table.from_pylist(rows, schema=SCHEMA), date, 'part')
+
+    def dates(self) -> List[str]:
+        """
+        List the date partitions of the store.
+
+        Returns:
+            List[str]: Dates as YYYY-MM-DD, sorted.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[len('date='):] for name in os.listdir(self.root) if name.startswith('date='))
+
+    def compact(self, dates: Optional[List[str]] = None, min_files: int = 2) -> dict:
+        """
+        Merge the files of date partitions into one file sorted by timestamp.
+
+        Only the files present when the compaction starts are merged, so
+        appends can continue meanwhile.
+
+        Args:
+            dates (List[str], optional): Partitions to compact, all if None.
+            min_files (int): Minimum number of files for a partition to be compacted.
+
+        Returns:
+            dict: Number of files merged per compacted date.
+        """
+        compacted = {}
+        for date in dates or self.dates():
+            directory = self._partition_dir(date)
+            files = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.parquet'))
+            if len(files) < min_files:
+                continue
+            table = pa.concat_tables([pq.read_table(path, schema=SCHEMA) for path in files])
+            self._write(table.sort_by('timestamp'), date, 'compacted')
+            for path in files:
+                os.remove(path)
+            compacted[date] = len(files)
+        return compacted
+
+    def dataset(self) -> ds.Dataset:
+        """
+        Open the store as a dataset. Temporary files of writes in progress start with a dot and are ignored.
+
+        Returns:
+            ds.Dataset: Dataset of every partition, with the 'date' column.
+        """
+        return ds.dataset(self.root, format='parquet', schema=SCHEMA.append(pa.field('date', pa.string())), partitioning=PARTITIONING)
+
+    def query(self, columns: Optional[List[str]] = None, start_date: Optional[str] = None, end_date: Optional[str] = None,
+              patent_numbers: Optional[List[str]] = None, model_llm: Optional[str] = None) -> pa.Table:
+        """
+        Read rows of the store. Only the partitions and columns needed are read.
+
+        Args:
+            columns (List[str], optional): Columns to read, all if None.
+            start_date (str, optional): First date (YYYY-MM-DD) to include.
+            end_date (str, optional): Last date (YYYY-MM-DD) to include.
+            patent_numbers (List[str], optional): Patents to include.
+            model_llm (str, optional): LLM to include.
+
+        Returns:
+            pa.Table: Matching rows.
+        """
+        if not os.path.isdir(self.root):
+            return SCHEMA.empty_table()
+        conditions = []
+        if start_date:
+            conditions.append(ds.field('date') >= start_date)
+        if end_date:
+            conditions.append(ds.field('date') <= end_date)
+        if patent_numbers:
+            conditions.append(ds.field('patent_number').isin(patent_numbers))
+        if model_llm:
+            conditions.append(ds.field('model_llm') == model_llm)
+        condition = None
+        for expression in conditions:
+            condition = expression if condition is None else condition & expression
+        return self.dataset().to_table(columns=columns, filter=condition)
+
+    def metric_summary(self, start_date: Optional[str] = None, end_date: Optional[str] = None) -> pa.Table:
+        """
+        Aggregate the validation metrics and stage timings per date and LLM.
+
+        Args:
+            start_date (str, optional): First date (YYYY-MM-DD) to include.
+            end_date (str, optional): Last date (YYYY-MM-DD) to include.
+
+        Returns:
+            pa.Table: Row count and mean of every metric and timing column per date and LLM.
+        """
+        value_columns = [name for name in SCHEMA.names if SCHEMA.field(name).type == pa.float64()]
+        table = self.query(['date', 'model_llm'] + value_columns, start_date=start_date, end_date=end_date)
+        aggregations = [([], 'count_all')] + [(column, 'mean') for column in value_columns]
+        return table.group_by(['date', 'model_llm']).aggregate(aggregations)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compacts and queries the columnar results store.")
+    parser.add_argument("command", choices=['compact', 'query', 'summary'], help="compact the partitions, print rows or print the metric summary")
+    parser.add_argument("--root", default=RESULTS_STORE_DIR, help="Directory of the store")
+    parser.add_argument("--dates", nargs='*', default=None, help="Partitions to compact (compact)")
+    parser.add_argument("--columns", nargs='*', default=['date', 'patent_number', 'claim_number', 'model_llm', 'overall_metrics__cosine_similarity'], help="Columns to print (query)")
+    parser.add_argument("--start_date", default=None, help="First date, YYYY-MM-DD")
+    parser.add_argument("--end_date", default=None, help="Last date, YYYY-MM-DD")
+    parser.add_argument("--patent_numbers", nargs='*', default=None, help="Patents to include (query)")
+    parser.add_argument("--limit", type=int, default=20, help="Rows to print (query)")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.root)
+    if args.command == 'compact':
+        print(json.dumps(store.compact(args.dates), indent=4))
+    elif args.command == 'query':
+        table = store.query(args.columns, start_date=args.start_date, end_date=args.end_date, patent_numbers=args.patent_numbers)
+        print(f'{table.num_rows} rows')
+        print(table.slice(0, args.limit).to_pandas().to_string())
+    else:
+        print(store.metric_summary(args.start_date, args.end_date).to_pandas().to_string())
@@ -0,0 +1,536 @@
+# Standard library imports
+import os
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+import urllib.request
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Custom imports
+import main as pipeline
+import models
+import prompt_cache
+from results import to_jsonable
+
+QUEUE_PATH = './cache/jobs.sqlite'
+
+class JobQueue:
+    """
+    Persistent job queue in SQLite.
+
+    Jobs survive restarts of the service: jobs that were running when the
+    service stopped are queued again when it starts.
+    """
+
+    def __init__(self, path: str = QUEUE_PATH):
+        """
+        Open or create the queue.
+
+        Args:
+            path (str): Path to the SQLite database.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, config TEXT, stages TEXT, result TEXT, error TEXT, created REAL, updated REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+            conn.execute("UPDATE jobs SET status = 'queued', stages = '[]' WHERE status = 'running'")
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the queue. One connection is used per call so the queue can be shared between threads.
+
+        Returns:
+            sqlite3.Connection: Database connection.
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, config: dict) -> str:
+        """
+        Add a job to the queue.
+
+        Args:
+            config (dict): Configuration parameters of the job.
+
+        Returns:
+            str: Job id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO jobs VALUES (?, 'queued', ?, '[]', NULL, NULL, ?, ?)",
+                (job_id, json.dumps(config), now, now)
+            )
+        return job_id
+
+    def claim(self) -> dict:
+        """
+        Take the oldest queued job and mark it as running.
+
+        Returns:
+            dict or None: Job id and config, None if the queue is empty.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT id, config FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (time.time(), row['id']))
+            conn.commit()
+        return {'id': row['id'], 'config': json.loads(row['config'])}
+
+    def add_stage(self, job_id: str, stage: str, data: dict = None) -> None:
+        """
+        Record a finished stage of a running job.
+
+        Args:
+            job_id (str): Job id.
+            stage (str): Name of the finished stage.
+            data (dict, optional): JSON serializable results of the stage.
+        """
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute('SELECT stages FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            stages = json.loads(row['stages']) + [{'stage': stage, 'time': time.time(), 'data': data or {}}]
+            conn.execute('UPDATE jobs SET stages = ?, updated = ? WHERE id = ?', (json.dumps(stages), time.time(), job_id))
+
+    def finish(self, job_id: str, status: str, result=None, error: str = None) -> None:
+        """
+        Mark a job as finished.
+
+        Args:
+            job_id (str): Job id.
+            status (str): 'done', 'failed' or 'cancelled'.
+            result (optional): JSON serializable result of the job.
+            error (str, optional): Error message of a failed job.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? WHERE id = ?',
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued job. Running jobs are stopped by PipelineService.cancel.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            bool: True if the job was queued and is now cancelled.
+        """
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        return cursor.rowcount > 0
+
+    def get(self, job_id: str) -> dict:
+        """
+        Get the status of a job.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            dict or None: Status, finished stages, result and error of the job, None if unknown.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'stages': json.loads(row['stages']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created': row['created'],
+            'updated': row['updated']
+        }
+
+    def list(self, limit: int = 50) -> list:
+        """
+        List the most recent jobs.
+
+        Args:
+            limit (int): Maximum number of jobs.
+
+        Returns:
+            list: Id, status and timestamps of the jobs, most recent first.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT id, status, created, updated FROM jobs ORDER BY created DESC LIMIT ?', (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+class PipelineService:
+    """
+    Resident pipeline process running the jobs of a JobQueue one at a time.
+
+    Models, clients and caches are loaded once when the service starts and
+    stay warm for every job. The pipeline configures process-wide state per
+    job (llama-index Settings, the model, memory budget and EPAB
+    configurations, the prompt cache usage), so jobs are not run
+    concurrently. Use batch.py to run many jobs in parallel processes.
+    """
+
+    def __init__(self, default_config: dict, queue: JobQueue, workers: int = 1):
+        """
+        Initialize the service.
+
+        Args:
+            default_config (dict): Configuration the job configs are merged onto.
+            queue (JobQueue): Persistent job queue.
+            workers (int): Number of jobs run at the same time, only 1 is supported.
+
+        Raises:
+            ValueError: If workers is not 1.
+        """
+        if workers != 1:
+            raise ValueError(f'The service runs one job at a time, got workers={workers}. Use batch.py to run jobs in parallel processes')
+        self.default_config = default_config
+        self.queue = queue
+        self.workers = workers
+        self.partial_summaries = {}
+        self.running = set()
+        self._cancel_requested = set()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def warm_up(self) -> None:
+        """
+        Load the models and clients used by every job.
+        """
+        print('Warming up models and clients...')
+        models.configure(self.default_config)
+        prompt_cache.get_client()
+
+        import utilsEPO
+        import epab_fetch
+        from RAG_pipeline import setup_embed_model
+        epab_fetch.configure(self.default_config)
+        utilsEPO.get_epab_client()
+        setup_embed_model()
+
+        if self.default_config.get('retrieve_patent_images'):
+            import image_retrieval_pipeline
+            models.load_clip_model(image_retrieval_pipeline.get_clip_device())
+
+        import validation
+        validation.load_nltk()
+        print('Service ready')
+
+    def submit(self, config: dict) -> str:
+        """
+        Queue a job.
+
+        Args:
+            config (dict): Configuration parameters overriding the default configuration.
+
+        Returns:
+            str: Job id.
+        """
+        job_id = self.queue.submit({**self.default_config, **config})
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_id: str) -> dict:
+        """
+        Get the status of a job, with the partial summary of a running job.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            dict or None: Job status, None if unknown.
+        """
+        status = self.queue.get(job_id)
+        if status is not None and job_id in self.partial_summaries:
+            status['partial_summary'] = self.partial_summaries[job_id]
+        return status
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued job, or stop a running job at its next stage or streamed token.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            bool: True if the job was queued or running.
+        """
+        if self.queue.cancel(job_id):
+            return True
+        if job_id in self.running:
+            self._cancel_requested.add(job_id)
+            return True
+        return False
+
+    def run_job(self, job: dict) -> None:
+        """
+        Run a job and record its progress and result in the queue.
+
+        Args:
+            job (dict): Job id and config from JobQueue.claim.
+        """
+        job_id = job['id']
+        print(f'Running job {job_id}')
+
+        def check_cancelled():
+            if job_id in self._cancel_requested:
+                raise pipeline.PipelineCancelled(f'Job {job_id} cancelled')
+
+        def on_partial_summary(text):
+            check_cancelled()
+            self.partial_summaries[job_id] = text
+
+        def on_stage(stage, data):
+            self.queue.add_stage(job_id, stage, to_jsonable(data))
+            check_cancelled()
+
+        self.running.add(job_id)
+        try:
+            result = pipeline.main(job['config'], on_partial_summary=on_partial_summary, on_stage=on_stage)
+            self.queue.finish(job_id, 'done', result=result.to_dict())
+        except pipeline.PipelineCancelled:
+            print(f'Job {job_id} cancelled')
+            self.queue.finish(job_id, 'cancelled')
+        except Exception as e:
+            print(f'Job {job_id} failed: {e}')
+            self.queue.finish(job_id, 'failed', error=str(e))
+        finally:
+            self.running.discard(job_id)
+            self._cancel_requested.discard(job_id)
+            self.partial_summaries.pop(job_id, None)
+
+    def _worker(self) -> None:
+        """
+        Run queued jobs until the service stops.
+        """
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(timeout=1.0)
+                self._wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def start(self) -> None:
+        """
+        Start the worker threads.
+        """
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """
+        Stop the worker threads once their current job is finished.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+def make_handler(service: PipelineService):
+    """
+    Create the HTTP request handler of a service.
+
+    Routes:
+        GET  /health                 Service status.
+        GET  /jobs                   Most recent jobs.
+        POST /jobs                   Queue a job, the body is a (partial) JSON config.
+        GET  /jobs/<id>              Status, finished stages and result of a job.
+        POST /jobs/<id>/cancel       Cancel a queued or running job.
+
+    Args:
+        service (PipelineService): Service handling the requests.
+
+    Returns:
+        type: BaseHTTPRequestHandler subclass.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['health']:
+                self._send(200, {'status': 'ok', 'workers': service.workers})
+            elif parts == ['jobs']:
+                self._send(200, service.queue.list())
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                status = service.status(parts[1])
+                if status is None:
+                    self._send(404, {'error': 'Unknown job'})
+                else:
+                    self._send(200, status)
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['jobs']:
+                try:
+                    config = self._read_json()
+                except json.JSONDecodeError as e:
+                    self._send(400, {'error': f'Invalid JSON: {e}'})
+                    return
+                self._send(202, {'id': service.submit(config)})
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+                self._send(200, {'cancelled': service.cancel(parts[1])})
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+class ServiceClient:
+    """
+    Thin client of a running PipelineService.
+    """
+
+    def __init__(self, url: str = 'http://127.0.0.1:8765'):
+        """
+        Initialize the client.
+
+        Args:
+            url (str): Base URL of the service.
+        """
+        self.url = url.rstrip('/')
+
+    def _request(self, method: str, path: str, body: dict = None) -> dict:
+        """
+        Send a JSON request to the service.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Request path.
+            body (dict, optional): JSON body.
+
+        Returns:
+            dict: JSON response.
+        """
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def submit(self, config: dict) -> str:
+        """
+        Queue a job.
+
+        Args:
+            config (dict): Configuration parameters overriding the service defaults.
+
+        Returns:
+            str: Job id.
+        """
+        return self._request('POST', '/jobs', config)['id']
+
+    def status(self, job_id: str) -> dict:
+        """
+        Get the status of a job.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            dict: Job status.
+        """
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued or running job.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            bool: True if the job was cancelled.
+        """
+        return self._request('POST', f'/jobs/{job_id}/cancel', {})['cancelled']
+
+    def wait(self, job_id: str, on_stage=None, on_partial_summary=None, poll_interval: float = 0.5) -> dict:
+        """
+        Wait for a job to finish, reporting its progress.
+
+        Args:
+            job_id (str): Job id.
+            on_stage (callable, optional): Called with the name and results of each finished stage.
+            on_partial_summary (callable, optional): Called with the partial summary text of the running job.
+            poll_interval (float): Seconds between status requests.
+
+        Returns:
+            dict: Final job status.
+        """
+        reported = 0
+        partial_summary = None
+        while True:
+            status = self.status(job_id)
+            for stage in status['stages'][reported:]:
+                if on_stage is not None:
+                    on_stage(stage['stage'], stage.get('data', {}))
+            reported = len(status['stages'])
+            if on_partial_summary is not None and status.get('partial_summary') not in (None, partial_summary):
+                partial_summary = status['partial_summary']
+                on_partial_summary(partial_summary)
+            if status['status'] in ('done', 'failed', 'cancelled'):
+                return status
+            time.sleep(poll_interval)
+
+    def run(self, config: dict, **kwargs) -> dict:
+        """
+        Queue a job and wait for it to finish.
+
+        Args:
+            config (dict): Configuration parameters overriding the service defaults.
+            **kwargs: Progress callbacks of wait.
+
+        Returns:
+            dict: Final job status.
+        """
+        return self.wait(self.submit(config), **kwargs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the patent pipeline as a resident local HTTP service.")
+    parser.add_argument("-i", "--input_json", default='./default_config.json', help="Path to the default JSON config file")
+    parser.add_argument("--host", default='127.0.0.1', help="Host to bind to")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=1, help="Number of jobs run at the same time, only 1 is supported (use batch.py for parallel runs)")
+    parser.add_argument("--queue", default=QUEUE_PATH, help="Path to the persistent job queue")
+    args = parser.parse_args()
+
+    service = PipelineService(pipeline.load_config(args.input_json), JobQueue(args.queue), workers=args.workers)
+    service.warm_up()
+    service.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f'Listening on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping service')
+    finally:
+        server.server_close()
+        service.stop()
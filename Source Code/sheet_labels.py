@@ -0,0 +1,237 @@
+# Standard library imports
+import os
+import re
+import json
+import hashlib
+from functools import lru_cache
+
+# Third-party library imports
+import numpy as np
+from scipy import ndimage
+from PIL import Image, ImageFont, ImageDraw
+
+CACHE_DIR = './cache/sheet_labels'
+
+# Characters of figure captions ("FIG. 3A") and reference numerals ("14a")
+CHARSET = '0123456789FIGABCabc'
+TEMPLATE_SIZE = (16, 24)
+FONTS = ['DejaVuSans.ttf', 'DejaVuSans-Bold.ttf', 'DejaVuSerif.ttf', 'LiberationSans-Regular.ttf', 'arial.ttf', 'Arial.ttf']
+
+def _normalize_glyph(mask: np.ndarray) -> np.ndarray:
+    """
+    Resize a binary glyph to the template size and standardize it for correlation.
+
+    Args:
+        mask (np.ndarray): Binary glyph cropped to its bounding box.
+
+    Returns:
+        np.ndarray: Zero mean, unit norm flattened glyph.
+    """
+    glyph = Image.fromarray((mask * 255).astype(np.uint8)).resize(TEMPLATE_SIZE, Image.BILINEAR)
+    vector = np.asarray(glyph, dtype=np.float32).ravel()
+    vector -= vector.mean()
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+@lru_cache(maxsize=1)
+def load_templates() -> tuple:
+    """
+    Render the glyph templates of CHARSET with the available fonts.
+
+    Returns:
+        tuple: Characters and a (n_templates, n_pixels) template matrix.
+    """
+    fonts = []
+    for name in FONTS:
+        try:
+            fonts.append(ImageFont.truetype(name, 48))
+        except OSError:
+            continue
+    if not fonts:
+        fonts.append(ImageFont.load_default())
+
+    chars, templates = [], []
+    for font in fonts:
+        for char in CHARSET:
+            canvas = Image.new('L', (96, 96), 0)
+            ImageDraw.Draw(canvas).text((16, 16), char, fill=255, font=font)
+            mask = np.asarray(canvas) > 127
+            if not mask.any():
+                continue
+            rows, cols = np.where(mask)
+            chars.append(char)
+            templates.append(_normalize_glyph(mask[rows.min():rows.max() + 1, cols.min():cols.max() + 1]))
+    return chars, np.stack(templates)
+
+def _find_characters(binary: np.ndarray) -> list:
+    """
+    Find the connected components that look like characters.
+
+    Args:
+        binary (np.ndarray): Binary page, True for ink.
+
+    Returns:
+        list: Characters as dicts with bounding box and recognized char.
+    """
+    chars, templates = load_templates()
+    labels, _ = ndimage.label(binary)
+    page_height = binary.shape[0]
+
+    characters = []
+    for label, box in enumerate(ndimage.find_objects(labels), start=1):
+        if box is None:
+            continue
+        height = box[0].stop - box[0].start
+        width = box[1].stop - box[1].start
+        if not (0.006 * page_height <= height <= 0.05 * page_height) or width > 1.2 * height:
+            continue
+        mask = labels[box] == label
+        fill = mask.mean()
+        # Solid glyphs are only allowed for narrow strokes such as '1' and 'I'
+        if fill < 0.08 or (fill > 0.9 and width > 0.35 * height):
+            continue
+
+        if fill > 0.9:
+            # A solid bar has no shape to correlate, it reads as 'I' (or '1' within numbers)
+            char = 'I'
+        else:
+            scores = templates @ _normalize_glyph(mask)
+            best = int(np.argmax(scores))
+            if scores[best] < 0.6:
+                continue
+            char = chars[best]
+        characters.append({
+            'char': char,
+            'top': box[0].start, 'bottom': box[0].stop,
+            'left': box[1].start, 'right': box[1].stop
+        })
+    return characters
+
+def _group_words(characters: list) -> list:
+    """
+    Group characters into words on the same line.
+
+    Args:
+        characters (list): Characters from _find_characters.
+
+    Returns:
+        list: Words as dicts with 'text', 'left', 'right', 'top', 'bottom' in reading order.
+    """
+    words = []
+    for char in sorted(characters, key=lambda c: c['left']):
+        height = char['bottom'] - char['top']
+        for word in words:
+            word_height = word['bottom'] - word['top']
+            overlap = min(word['bottom'], char['bottom']) - max(word['top'], char['top'])
+            gap = char['left'] - word['right']
+            if overlap > 0.5 * min(height, word_height) and -0.2 * height <= gap <= 0.3 * max(height, word_height):
+                word['text'] += char['char']
+                word['right'] = char['right']
+                word['top'] = min(word['top'], char['top'])
+                word['bottom'] = max(word['bottom'], char['bottom'])
+                break
+        else:
+            words.append(dict(char, text=char['char']))
+    return sorted(words, key=lambda w: (w['top'], w['left']))
+
+def extract_sheet_labels(image: Image.Image, max_height: int = 2000) -> dict:
+    """
+    Extract the figure ids and reference numerals printed on a drawing sheet.
+
+    Args:
+        image (PIL.Image): Drawing sheet.
+        max_height (int): Pages are downscaled to this height before analysis.
+
+    Returns:
+        dict: 'figures' and 'numerals' found on the sheet.
+    """
+    gray = image.convert('L')
+    if gray.height > max_height:
+        gray = gray.resize((int(gray.width * max_height / gray.height), max_height), Image.BILINEAR)
+    binary = np.asarray(gray) < 128
+
+    words = _group_words(_find_characters(binary))
+
+    # 'I' and '1' are the same stroke in sans fonts
+    for word in words:
+        if re.search(r'\d', word['text']):
+            word['text'] = word['text'].replace('I', '1')
+
+    figures, numerals = [], []
+    for idx, word in enumerate(words):
+        if re.fullmatch(r'F[I1]G', word['text'].upper()):
+            # The figure number follows on the same line, after the dot
+            height = word['bottom'] - word['top']
+            for next_word in words[idx + 1:]:
+                same_line = min(word['bottom'], next_word['bottom']) - max(word['top'], next_word['top']) > 0.5 * height
+                if same_line and 0 <= next_word['left'] - word['right'] <= 3 * height and re.fullmatch(r'\d{1,3}[A-C]?', next_word['text']):
+                    figures.append(next_word['text'].upper())
+                    next_word['text'] = ''
+                    break
+        elif re.fullmatch(r'\d{1,4}[a-c]?', word['text']):
+            numerals.append(word['text'].lower())
+
+    return {
+        'figures': list(dict.fromkeys(figures)),
+        'numerals': list(dict.fromkeys(numerals))
+    }
+
+def image_hash(image: Image.Image) -> str:
+    """
+    Hash the pixels of an image.
+
+    Args:
+        image (PIL.Image): Input image.
+
+    Returns:
+        str: SHA-1 hex digest of the image mode, size and pixels.
+    """
+    digest = hashlib.sha1(f'{image.mode}{image.size}'.encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def raw_hash(data: bytes) -> str:
+    """
+    Hash an encoded image as fetched.
+
+    Args:
+        data (bytes): Encoded image.
+
+    Returns:
+        str: SHA-1 hex digest of the bytes.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+def get_sheet_labels(images, cache_dir: str = CACHE_DIR) -> list:
+    """
+    Get the labels of drawing sheets, analysing each sheet only once.
+
+    Sheets of a PatentImages are keyed by their raw attachment bytes and only
+    decoded when they are not cached yet.
+
+    Args:
+        images (PatentImages or list): Drawing sheets, or a list of PIL Images keyed by their pixels.
+        cache_dir (str): Directory of the cache, keyed by image hash.
+
+    Returns:
+        list: Labels of each sheet (see extract_sheet_labels).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    sheet_labels = []
+    for idx in range(len(images)):
+        if isinstance(images, list):
+            key, load = image_hash(images[idx]), lambda: images[idx]
+        else:
+            key, load = raw_hash(images.raw[idx]), lambda: images.pil(idx)
+        cache_path = os.path.join(cache_dir, key + '.json')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                labels = json.load(f)
+        else:
+            labels = extract_sheet_labels(load())
+            # Written aside and renamed, so a concurrent run never reads a partial file
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(labels, f)
+            os.replace(tmp_path, cache_path)
+        sheet_labels.append(labels)
+    return sheet_labels
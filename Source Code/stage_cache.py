@@ -0,0 +1,196 @@
+# Standard library imports
+import os
+import json
+import time
+import hashlib
+from functools import lru_cache
+from typing import Callable
+
+STAGE_CACHE_DIR = './cache/stages'
+
+# Bump to invalidate every cached stage output
+STAGE_CACHE_VERSION = 1
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Configuration fields each stage depends on
+STAGE_FIELDS = {
+    'claims': [
+        'patent_number', 'claim_number', 'dependent_claims', 'field_of_invention',
+        'background_of_the_invention', 'summary_of_the_invention', 'brief_description_of_the_drawings',
+        'detailed_description_of_the_embodiments', 'retrieve_patent_images', 'figure_label_extraction', 'epab_mock_dir'
+    ],
+    'summary': [
+        'prompt_template', 'model_llm', 'temperature', 'max_tokens', 'context_token_budget', 'chunk_size', 'chunk_overlap', 'hybrid_retrieval',
+        'portfolio_store', 'portfolio_similar_patents', 'embed_model', 'model_quantization'
+    ],
+    'images': ['retrieve_top_k_images', 'reference_image_selection', 'image_dedup', 'image_dedup_threshold', 'image_mmr_lambda', 'clip_model', 'model_quantization'],
+    'image_summary': ['model_llm', 'max_tokens'],
+    'svg': [
+        'prompt_template_image', 'max_tokens_code', 'output_filename', 'model_llm', 'temperature',
+        'svg_minify', 'svg_decimals', 'svg_max_elements', 'svg_max_bytes', 'svg_thumbnail_size'
+    ],
+    'metrics': ['chunk_size', 'chunk_overlap']
+}
+
+# Modules implementing each stage, their source (and the prompts they hold) is part of the key
+STAGE_MODULES = {
+    'claims': ['utilsEPO.py', 'epab_fetch.py', 'patent_data.py', 'claim_graph.py', 'figure_index.py', 'sheet_labels.py'],
+    'summary': ['RAG_pipeline.py', 'patent_chunking.py', 'hybrid_retrieval.py', 'prompt_cache.py'],
+    'images': ['image_retrieval_pipeline.py', 'image_dedup.py', 'figure_index.py'],
+    'image_summary': ['image_retrieval_pipeline.py', 'prompt_cache.py'],
+    'svg': ['image_generation_pipeline.py', 'svg_postprocess.py'],
+    'metrics': ['validation.py', 'patent_chunking.py']
+}
+
+@lru_cache(maxsize=None)
+def module_hash(filename: str) -> str:
+    """
+    Hash the source of a module once per process.
+
+    Args:
+        filename (str): File name of the module in the source directory.
+
+    Returns:
+        str: SHA-256 hex digest of the source, empty if the file is missing.
+    """
+    path = os.path.join(SOURCE_DIR, filename)
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def encode_json(value) -> bytes:
+    """
+    Default encoder of the stage outputs.
+
+    Args:
+        value: JSON serializable output.
+
+    Returns:
+        bytes: UTF-8 JSON.
+    """
+    return json.dumps(value).encode('utf-8')
+
+def decode_json(payload: bytes):
+    """
+    Default decoder of the stage outputs.
+
+    Args:
+        payload (bytes): UTF-8 JSON.
+
+    Returns:
+        Decoded output.
+    """
+    return json.loads(payload)
+
+class StageCache:
+    """
+    Outputs of the pipeline stages, keyed by a hash of their inputs.
+
+    The key of a stage covers its configuration fields, the source of the
+    modules implementing it and the keys of the stages it depends on, so a
+    change invalidates the stage and everything downstream of it, like a
+    build system. Stages whose key is already cached are not executed again.
+    """
+
+    def __init__(self, cache_dir: str = STAGE_CACHE_DIR, enabled: bool = True):
+        """
+        Initialize the cache.
+
+        Args:
+            cache_dir (str): Directory of the cached outputs.
+            enabled (bool): Whether to reuse cached outputs. Outputs are still written when disabled.
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.keys = {}
+        self.status = {}
+        self.timings = {}
+
+    def key(self, stage: str, args: dict, depends_on: tuple = ()) -> str:
+        """
+        Compute the key of a stage.
+
+        Args:
+            stage (str): Stage name.
+            args (dict): Configuration parameters.
+            depends_on (tuple): Upstream stages, already run through this cache.
+
+        Returns:
+            str: SHA-256 hex digest of the stage inputs.
+        """
+        inputs = {
+            'stage': stage,
+            'version': STAGE_CACHE_VERSION,
+            'config': {field: args.get(field) for field in STAGE_FIELDS[stage]},
+            'modules': {filename: module_hash(filename) for filename in STAGE_MODULES[stage]},
+            'depends_on': {upstream: self.keys[upstream] for upstream in depends_on}
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def cached(self, stage: str, args: dict, depends_on: tuple = ()) -> bool:
+        """
+        Check whether the output of a stage would be reused from the cache.
+
+        Args:
+            stage (str): Stage name.
+            args (dict): Configuration parameters.
+            depends_on (tuple): Upstream stages, already run through this cache.
+
+        Returns:
+            bool: True if the cache is enabled and holds the output.
+        """
+        key = self.key(stage, args, depends_on)
+        return self.enabled and os.path.exists(os.path.join(self.cache_dir, stage, f'{key}.bin'))
+
+    def run(self, stage: str, args: dict, compute: Callable, depends_on: tuple = (),
+            encode: Callable = encode_json, decode: Callable = decode_json, cache_if: Callable = None):
+        """
+        Get the output of a stage from the cache, or compute and cache it.
+
+        Args:
+            stage (str): Stage name, a key of STAGE_FIELDS.
+            args (dict): Configuration parameters.
+            compute (Callable): Computes the output when it is not cached.
+            depends_on (tuple): Upstream stages whose outputs the stage uses.
+            encode (Callable): Converts the output to bytes.
+            decode (Callable): Converts bytes back to the output.
+            cache_if (Callable, optional): Whether an output may be cached, e.g. not a failed generation.
+
+        Returns:
+            Output of the stage.
+        """
+        start = time.perf_counter()
+        key = self.key(stage, args, depends_on)
+        self.keys[stage] = key
+        path = os.path.join(self.cache_dir, stage, f'{key}.bin')
+
+        if self.enabled and os.path.exists(path):
+            with open(path, 'rb') as f:
+                value = decode(f.read())
+            print(f'Reusing the {stage} stage, its inputs did not change')
+            self.status[stage] = 'reused'
+            self.timings[stage] = round(time.perf_counter() - start, 3)
+            return value
+
+        value = compute()
+        self.status[stage] = 'executed'
+        self.timings[stage] = round(time.perf_counter() - start, 3)
+        if cache_if is not None and not cache_if(value):
+            return value
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encode(value))
+        os.replace(tmp_path, path)
+        return value
+
+    def reused(self) -> list:
+        """
+        List the stages reused from the cache.
+
+        Returns:
+            list: Stage names.
+        """
+        return [stage for stage, status in self.status.items() if status == 'reused']
@@ -0,0 +1,232 @@
+# Standard library imports
+import re
+import xml.etree.ElementTree as ET
+from collections import Counter
+from typing import Optional
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+
+# Namespaces of the SVGs written by svgwrite, kept with their usual prefixes
+NAMESPACES = {
+    '': SVG_NS,
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'ev': 'http://www.w3.org/2001/xml-events'
+}
+for prefix, uri in NAMESPACES.items():
+    ET.register_namespace(prefix, uri)
+
+# Elements without any effect on the rendering
+DROPPED_ELEMENTS = {'metadata'}
+
+# Attributes holding coordinates or lists of coordinates, rounded to the coordinate precision.
+# Opacities are fractions, rounding them like coordinates would hide or reveal elements.
+# Transforms are rounded by round_transform, only their translations are coordinates
+NUMERIC_ATTRIBUTES = {
+    'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry', 'width', 'height', 'dx', 'dy',
+    'points', 'd', 'stroke-width', 'font-size', 'viewBox'
+}
+
+TRANSFORM_PATTERN = re.compile(r'(\w+)\s*\(([^)]*)\)')
+
+NUMBER_PATTERN = re.compile(r'-?\d*\.\d+(?:[eE][-+]?\d+)?|-?\d+(?:[eE][-+]?\d+)?')
+
+class SVGValidationError(ValueError):
+    """
+    Raised when a generated SVG is not valid or exceeds the size limits.
+    """
+
+def _local_name(tag: str) -> str:
+    """
+    Get the tag of an element without its namespace.
+
+    Args:
+        tag (str): Tag, possibly '{namespace}name'.
+
+    Returns:
+        str: Local name.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+def validate_svg(svg: bytes) -> ET.Element:
+    """
+    Parse an SVG and check that it is an SVG document.
+
+    Args:
+        svg (bytes): SVG content.
+
+    Returns:
+        ET.Element: Root element.
+
+    Raises:
+        SVGValidationError: If the content is not well-formed XML or its root is not <svg>.
+    """
+    try:
+        root = ET.fromstring(svg)
+    except ET.ParseError as e:
+        raise SVGValidationError(f'The SVG is not well-formed: {e}')
+    if _local_name(root.tag) != 'svg':
+        raise SVGValidationError(f'The root element is <{_local_name(root.tag)}>, not <svg>')
+    return root
+
+def round_numbers(value: str, decimals: int) -> str:
+    """
+    Round the numbers of an attribute value.
+
+    A non-zero number is never rounded to 0, it keeps its first significant
+    digit instead (e.g. r="0.04" stays "0.04" with one decimal).
+
+    Args:
+        value (str): Attribute value, e.g. "10.123456" or "M 10.5 20.25 L 30 40".
+        decimals (int): Number of decimals kept.
+
+    Returns:
+        str: Value with rounded numbers, trailing zeros removed.
+    """
+    def round_match(match):
+        number = float(match.group(0))
+        digits = decimals
+        while number != 0 and round(number, digits) == 0 and digits < 15:
+            digits += 1
+        if round(number, digits) == 0 and number != 0:
+            return match.group(0)
+        number = round(number, digits)
+        text = f'{number:.{digits}f}'.rstrip('0').rstrip('.') if digits > 0 else str(int(number))
+        return '0' if text in ('-0', '') else text
+    return NUMBER_PATTERN.sub(round_match, value)
+
+def round_transform(value: str, decimals: int) -> str:
+    """
+    Round the translations of a transform attribute.
+
+    Only translate() and the e and f components of matrix() are coordinates.
+    Scale, rotation, skew and the other matrix coefficients are kept as they
+    are, rounding them would rescale or skew the drawing.
+
+    Args:
+        value (str): Transform, e.g. "translate(10.123 20) matrix(0.7071 0.7071 -0.7071 0.7071 10.55 10)".
+        decimals (int): Number of decimals kept in the translations.
+
+    Returns:
+        str: Transform with rounded translations.
+    """
+    def round_function(match):
+        name, arguments = match.group(1), match.group(2)
+        if name == 'translate':
+            return f'{name}({round_numbers(arguments, decimals)})'
+        if name == 'matrix':
+            numbers = list(NUMBER_PATTERN.finditer(arguments))
+            if len(numbers) == 6:
+                split = numbers[4].start()
+                return f'{name}({arguments[:split]}{round_numbers(arguments[split:], decimals)})'
+        return match.group(0)
+    return TRANSFORM_PATTERN.sub(round_function, value)
+
+def merge_styles(root: ET.Element) -> None:
+    """
+    Move the style attributes used by several elements into classes of a <style> element.
+
+    Args:
+        root (ET.Element): Root element, modified in place.
+    """
+    elements = [element for element in root.iter() if element.get('style')]
+    counts = Counter(element.get('style').strip().rstrip(';') for element in elements)
+    classes = {style: f's{i}' for i, (style, count) in enumerate(counts.most_common()) if count > 1}
+    if not classes:
+        return
+
+    for element in elements:
+        style = element.get('style').strip().rstrip(';')
+        if style in classes:
+            del element.attrib['style']
+            existing = element.get('class')
+            element.set('class', f'{existing} {classes[style]}' if existing else classes[style])
+
+    style_element = ET.Element(f'{{{SVG_NS}}}style')
+    style_element.text = ''.join(f'.{name}{{{style}}}' for style, name in classes.items())
+    root.insert(0, style_element)
+
+def minify_svg(root: ET.Element, decimals: int = 1) -> bytes:
+    """
+    Minify an SVG: drop comments and metadata, strip whitespace, round numbers and merge repeated styles.
+
+    Args:
+        root (ET.Element): Root element from validate_svg, modified in place.
+        decimals (int): Number of decimals kept in the coordinates.
+
+    Returns:
+        bytes: Minified SVG.
+    """
+    # Comments are already dropped by the parser
+    for parent in list(root.iter()):
+        for child in list(parent):
+            if _local_name(child.tag) in DROPPED_ELEMENTS:
+                parent.remove(child)
+
+    for element in root.iter():
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        if element.tail is not None and not element.tail.strip():
+            element.tail = None
+        for name, value in element.attrib.items():
+            if _local_name(name) in NUMERIC_ATTRIBUTES:
+                element.set(name, round_numbers(value, decimals))
+            elif _local_name(name) == 'transform':
+                element.set(name, round_transform(value, decimals))
+    merge_styles(root)
+    return ET.tostring(root, encoding='utf-8', xml_declaration=False, short_empty_elements=True)
+
+def rasterize_thumbnail(svg: bytes, size: int) -> Optional[bytes]:
+    """
+    Rasterize an SVG into a PNG thumbnail, in process.
+
+    Args:
+        svg (bytes): SVG content.
+        size (int): Width of the thumbnail in pixels.
+
+    Returns:
+        bytes or None: PNG thumbnail, None if CairoSVG is not installed or cannot render the SVG.
+    """
+    try:
+        import cairosvg
+    except (ImportError, OSError) as e:
+        # OSError when the cairo library itself is missing
+        print(f'SVG thumbnails not available ({e})')
+        return None
+    try:
+        return cairosvg.svg2png(bytestring=svg, output_width=size)
+    except Exception as e:
+        print(f'Could not rasterize the SVG thumbnail: {e}')
+        return None
+
+def postprocess_svg(svg: bytes, minify: bool = True, decimals: int = 1, max_elements: int = 0, max_bytes: int = 0, thumbnail_size: int = 0) -> dict:
+    """
+    Validate, minify and check the limits of a generated SVG, and optionally rasterize a thumbnail.
+
+    Args:
+        svg (bytes): SVG written by the generated code.
+        minify (bool): Whether to minify the SVG.
+        decimals (int): Number of decimals kept in the coordinates when minifying.
+        max_elements (int): Maximum number of elements, 0 for no limit.
+        max_bytes (int): Maximum size of the (minified) SVG in bytes, 0 for no limit.
+        thumbnail_size (int): Width of the PNG thumbnail, 0 for no thumbnail.
+
+    Returns:
+        dict: 'svg' bytes, 'thumbnail' PNG bytes or None, and 'stats' with the sizes and element count.
+
+    Raises:
+        SVGValidationError: If the SVG is not valid or exceeds a limit.
+    """
+    root = validate_svg(svg)
+    n_elements = sum(1 for _ in root.iter())
+    if max_elements and n_elements > max_elements:
+        raise SVGValidationError(f'The SVG has {n_elements} elements, more than the limit of {max_elements}')
+
+    output = minify_svg(root, decimals) if minify else svg
+    if max_bytes and len(output) > max_bytes:
+        raise SVGValidationError(f'The SVG is {len(output)} bytes, more than the limit of {max_bytes}')
+
+    return {
+        'svg': output,
+        'thumbnail': rasterize_thumbnail(output, thumbnail_size) if thumbnail_size else None,
+        'stats': {'original_bytes': len(svg), 'bytes': len(output), 'elements': n_elements}
+    }
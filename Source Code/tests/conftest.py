@@ -0,0 +1,6 @@
+# Standard library imports
+import os
+import sys
+
+# The pipeline modules are flat in the source directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
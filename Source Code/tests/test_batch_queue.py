@@ -0,0 +1,106 @@
+import pytest
+
+batch = pytest.importorskip('batch')
+from batch import BatchQueue, shard_of
+
+TASKS = [('EP1000000A1', '1'), ('EP2000000A1', '1'), ('EP3000000A1', '1')]
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = BatchQueue(str(tmp_path / 'batch.sqlite'), lease=60, max_attempts=2)
+    queue.load(TASKS, num_shards=4)
+    return queue
+
+def statuses(queue):
+    return {(task['patent_number'], task['claim_number']): task['status'] for task in queue.rows()}
+
+def test_load_keeps_existing_tasks_and_skips_checkpoints(tmp_path):
+    queue = BatchQueue(str(tmp_path / 'batch.sqlite'))
+    assert queue.load(TASKS, num_shards=4, skip={TASKS[0]}) == 3
+    assert queue.load(TASKS, num_shards=4) == 0
+    assert statuses(queue)[TASKS[0]] == 'done'
+
+def test_claim_leases_each_task_once(queue):
+    claimed = [queue.claim('worker') for _ in range(3)]
+    assert sorted((task['patent_number'], task['claim_number']) for task in claimed) == sorted(TASKS)
+    assert queue.claim('worker') is None
+    assert set(statuses(queue).values()) == {'running'}
+
+def test_claim_filters_shards(queue):
+    shard = shard_of('EP2000000A1', 4)
+    tasks = []
+    while (task := queue.claim('worker', shards=[shard])) is not None:
+        tasks.append(task)
+    assert tasks and all(task['shard'] == shard for task in tasks)
+
+def test_expired_lease_is_queued_again_then_failed(queue, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(batch.time, 'time', lambda: now[0])
+    for _ in range(3):
+        queue.claim('crashed')
+
+    # Within the lease nothing is taken back
+    now[0] += 30
+    assert queue.claim('worker') is None
+
+    # After the lease the tasks are queued again, and fail after max_attempts
+    now[0] += 60
+    second = queue.claim('worker')
+    assert second is not None
+    assert [task['attempts'] for task in queue.rows() if task['worker'] == 'worker'] == [2]
+    now[0] += 120
+    queue.claim('worker')
+    assert 'failed' in statuses(queue).values()
+    assert all(task['error'] == 'Lease expired' for task in queue.rows() if task['status'] == 'failed')
+
+def test_failed_task_is_retried_until_max_attempts(queue):
+    task = queue.claim('worker')
+    queue.finish(task, 'failed', error='boom')
+    key = (task['patent_number'], task['claim_number'])
+    assert statuses(queue)[key] == 'queued'
+
+    while (retry := queue.claim('worker')) is not None and (retry['patent_number'], retry['claim_number']) != key:
+        queue.finish(retry, 'done')
+    queue.finish(retry, 'failed', error='boom')
+    assert statuses(queue)[key] == 'failed'
+
+def test_finish_records_metrics(queue):
+    task = queue.claim('worker')
+    queue.finish(task, 'done', metrics={'1': {'overall_metrics': {'Cosine similarity': 0.5}}}, timings={'summary': 1.5})
+    row = next(row for row in queue.rows() if row['patent_number'] == task['patent_number'])
+    assert row['status'] == 'done'
+    assert row['metrics']['1']['overall_metrics']['Cosine similarity'] == 0.5
+    assert row['timings'] == {'summary': 1.5}
+
+def test_upcoming_follows_claim_order(queue):
+    upcoming = queue.upcoming(3)
+    assert [queue.claim('worker')['patent_number'] for _ in range(3)] == upcoming
+
+def test_heartbeat_keeps_a_long_task_leased(queue, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(batch.time, 'time', lambda: now[0])
+    task = queue.claim('worker')
+    for _ in range(3):
+        now[0] += 45
+        assert queue.heartbeat(task)
+    other = queue.claim('other')
+    assert (other['patent_number'], other['claim_number']) != (task['patent_number'], task['claim_number'])
+    assert queue.finish(task, 'done')
+
+def test_stale_worker_does_not_overwrite_the_new_attempt(queue, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(batch.time, 'time', lambda: now[0])
+    stale = queue.claim('stale', shards=[shard_of('EP1000000A1', 4)])
+    now[0] += 120
+    new = queue.claim('new', shards=[shard_of('EP1000000A1', 4)])
+    assert (new['patent_number'], new['claim_number']) == (stale['patent_number'], stale['claim_number'])
+
+    # The stale worker lost its lease: it stops at its next heartbeat and its outcome is dropped
+    assert not queue.heartbeat(stale)
+    assert not queue.finish(stale, 'done', metrics={'1': {}})
+    key = (new['patent_number'], new['claim_number'])
+    assert statuses(queue)[key] == 'running'
+
+    assert queue.finish(new, 'done', timings={'summary': 2.0})
+    row = next(row for row in queue.rows() if (row['patent_number'], row['claim_number']) == key)
+    assert row['status'] == 'done' and row['worker'] == 'new' and row['timings'] == {'summary': 2.0}
@@ -0,0 +1,51 @@
+import pytest
+
+from claim_graph import ClaimGraph, get_claim_graph, parse_claim_references
+
+@pytest.mark.parametrize('text, claim_number, expected', [
+    ('A device comprising a rotor.', 1, []),
+    ('The device of claim 1, wherein the rotor is hollow.', 2, [1]),
+    ('The device according to Claim 2 or 3, further comprising a shaft.', 4, [2, 3]),
+    ('The device according to any one of claims 1 to 3.', 5, [1, 2, 3]),
+    ('The device according to claims 1-2, 4.', 5, [1, 2, 4]),
+    ('The device according to any preceding claim.', 4, [1, 2, 3]),
+    # Only earlier claims can be referred to
+    ('The device of claim 7.', 3, []),
+    ('The method of claim 3 using the device of claim 1.', 5, [3, 1])
+])
+def test_parse_claim_references(text, claim_number, expected):
+    assert parse_claim_references(text, claim_number) == expected
+
+CLAIMS = {
+    1: 'A device comprising a rotor.',
+    2: 'The device of claim 1, wherein the rotor is hollow.',
+    3: 'The device of claim 2, further comprising a shaft.',
+    4: 'A method comprising rotating a rotor.',
+    5: 'The method of claim 4 using the device of claim 3.'
+}
+
+def test_closures():
+    graph = ClaimGraph.from_claims(CLAIMS)
+    assert graph.roots == [1, 4]
+    assert graph.ancestors(3) == [2, 1]
+    assert graph.ancestors(5) == [4, 3, 2, 1]
+    assert graph.descendants(1) == [2, 3, 5]
+    assert graph.claim_roots(5) == [4, 1]
+    assert graph.is_independent(4) and not graph.is_independent(2)
+
+def test_order_puts_ancestors_first():
+    assert ClaimGraph.from_claims(CLAIMS).order([5, 3, 4, 1, 3]) == [1, 3, 5, 4]
+
+def test_round_trip():
+    graph = ClaimGraph.from_claims(CLAIMS)
+    assert ClaimGraph.from_dict(graph.to_dict()).parents == graph.parents
+
+def test_get_claim_graph_is_cached_per_claims(tmp_path):
+    cache_dir = str(tmp_path)
+    graph = get_claim_graph('EP1000000A1', CLAIMS, cache_dir)
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    assert get_claim_graph('EP1000000A1', CLAIMS, cache_dir).parents == graph.parents
+
+    amended = {**CLAIMS, 3: 'A shaft.'}
+    assert get_claim_graph('EP1000000A1', amended, cache_dir).roots == [1, 3, 4]
+    assert len(list(tmp_path.glob('*.json'))) == 2
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+import pytest
+
+from epab_fetch import EPABFetcher, MockEPABClient, write_mock_patent
+
+CLAIMS = '<claims><claim num="1"><claim-text>A device comprising a rotor.</claim-text></claim></claims>'
+DESCRIPTION = '<description><p num="0001">The rotor 10 turns.</p></description>'
+
+@pytest.fixture
+def mock_dir(tmp_path):
+    write_mock_patent(str(tmp_path), 'EP1000000A1', CLAIMS, DESCRIPTION, [b'sheet one', b'sheet two'])
+    write_mock_patent(str(tmp_path), 'EP2000000A1', CLAIMS, DESCRIPTION)
+    return str(tmp_path)
+
+def test_mock_client_mirrors_the_epab_results(mock_dir):
+    query = MockEPABClient(mock_dir).query_epab_doc_id('EP1000000A1')
+    assert query.get_results('claims, description') == [{'claims': [{'text': CLAIMS}], 'description': {'text': DESCRIPTION}}]
+    assert query.get_results('claims') == [{'claims': [{'text': CLAIMS}]}]
+    assert [attachment['content'] for attachment in query.get_drawings()[0]['attachment']] == [b'sheet one', b'sheet two']
+    with pytest.raises(ValueError):
+        query.get_drawings(output_type='df')
+
+def test_mock_client_rejects_unknown_publications(mock_dir):
+    with pytest.raises(ValueError, match='not found'):
+        MockEPABClient(mock_dir).query_epab_doc_id('EP9999999A1')
+
+def test_clean_text():
+    assert MockEPABClient.clean_text('<p>The  rotor</p>\n<p>turns.</p>') == 'The rotor turns.'
+
+def test_fetch_runs_the_requests_concurrently(mock_dir):
+    fetcher = EPABFetcher(MockEPABClient(mock_dir, latency=0.3), max_workers=2)
+    start = time.perf_counter()
+    fetched = fetcher.fetch('EP1000000A1')
+    assert fetched.claims_description()[0]['claims'][0]['text'] == CLAIMS
+    assert fetched.attachments() == [b'sheet one', b'sheet two']
+    assert time.perf_counter() - start < 0.55
+
+def test_fetch_without_drawings(mock_dir):
+    fetched = EPABFetcher(MockEPABClient(mock_dir)).fetch('EP2000000A1', drawings=False)
+    assert fetched.attachments() is None
+    assert fetched.claims_description()[0]['description']['text'] == DESCRIPTION
+
+def test_errors_reach_both_requests(mock_dir):
+    fetched = EPABFetcher(MockEPABClient(mock_dir)).fetch('EP9999999A1')
+    with pytest.raises(ValueError):
+        fetched.claims_description()
+    with pytest.raises(ValueError):
+        fetched.attachments()
+
+def test_prefetched_publications_are_reused_or_dropped(mock_dir):
+    fetcher = EPABFetcher(MockEPABClient(mock_dir), prefetch=1)
+    fetcher.prefetch(['EP1000000A1', 'EP2000000A1'])
+    assert list(fetcher._pending) == ['EP1000000A1']
+    prefetched = fetcher._pending['EP1000000A1']
+    assert fetcher.fetch('EP1000000A1') is prefetched
+
+    fetcher.prefetch(['EP2000000A1'])
+    fetcher.prefetch(['EP1000000A1'])
+    assert list(fetcher._pending) == ['EP1000000A1']
+
+def test_prefetch_without_drawings_is_refetched_when_drawings_are_needed(mock_dir):
+    fetcher = EPABFetcher(MockEPABClient(mock_dir))
+    fetcher.prefetch(['EP1000000A1'], drawings=False)
+    assert fetcher.fetch('EP1000000A1').attachments() == [b'sheet one', b'sheet two']
+
+def test_fetch_async(mock_dir):
+    texts, drawings = asyncio.run(EPABFetcher(MockEPABClient(mock_dir)).fetch_async('EP1000000A1'))
+    assert texts[0]['claims'][0]['text'] == CLAIMS
+    assert drawings == [b'sheet one', b'sheet two']
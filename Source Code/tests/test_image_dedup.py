@@ -0,0 +1,33 @@
+import pytest
+
+from image_dedup import group_duplicates, hamming_distance, unique_indices
+
+def test_hamming_distance():
+    assert hamming_distance(0b1011, 0b1011) == 0
+    assert hamming_distance(0b1011, 0b0010) == 2
+
+def test_groups_near_duplicates_under_the_first_sheet():
+    hashes = [0b0000, 0b1111_0000, 0b0001, 0b1111_0001, 0b1010_1010_1010]
+    assert group_duplicates(hashes, threshold=1) == [0, 1, 0, 1, 4]
+
+def test_threshold_zero_only_groups_identical_hashes():
+    assert group_duplicates([5, 4, 5], threshold=0) == [0, 1, 0]
+
+def test_unique_indices():
+    assert unique_indices([0, 1, 0, 1, 4]) == [0, 1, 4]
+    assert unique_indices([]) == []
+
+def test_dhash_separates_sheets():
+    Image = pytest.importorskip('PIL.Image')
+    from image_dedup import dhash, DEFAULT_THRESHOLD
+
+    def sheet(offset):
+        image = Image.new('L', (200, 280), 255)
+        for x in range(20 + offset, 180, 40):
+            image.paste(0, (x, 20, x + 4, 260))
+        return image
+
+    rescan = sheet(0).resize((210, 294)).resize((200, 280))
+    assert dhash(sheet(0)) == dhash(sheet(0))
+    assert hamming_distance(dhash(sheet(0)), dhash(rescan)) <= DEFAULT_THRESHOLD
+    assert hamming_distance(dhash(sheet(0)), dhash(sheet(20))) > DEFAULT_THRESHOLD
@@ -0,0 +1,29 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+image_retrieval_pipeline = pytest.importorskip('image_retrieval_pipeline')
+from image_retrieval_pipeline import mmr_select
+
+def features(*vectors):
+    features = torch.tensor(vectors, dtype=torch.float32)
+    return features / features.norm(dim=1, keepdim=True)
+
+# Sheets 0 and 1 are near-identical, sheet 2 is different and slightly less relevant
+SCORES = torch.tensor([0.9, 0.89, 0.8])
+FEATURES = features([1.0, 0.0], [1.0, 0.01], [0.0, 1.0])
+
+def test_lambda_one_is_top_k():
+    assert mmr_select(SCORES, FEATURES, [0, 1, 2], top_k=2) == [0, 1]
+
+def test_mmr_skips_near_duplicates():
+    assert mmr_select(SCORES, FEATURES, [0, 1, 2], top_k=2, mmr_lambda=0.7) == [0, 2]
+
+def test_candidates_restrict_the_selection():
+    assert mmr_select(SCORES, FEATURES, [1, 2], top_k=1, mmr_lambda=0.7) == [1]
+
+def test_already_selected_count_as_redundant_but_are_not_returned():
+    assert mmr_select(SCORES, FEATURES, [1, 2], top_k=1, mmr_lambda=0.7, selected=[0]) == [2]
+
+@pytest.mark.parametrize('candidates, top_k', [([], 2), ([0, 1], 0)])
+def test_empty_selection(candidates, top_k):
+    assert mmr_select(SCORES, FEATURES, candidates, top_k=top_k, mmr_lambda=0.7) == []
@@ -0,0 +1,49 @@
+import pytest
+
+from utils import parse_json_stream, JSONStreamError
+
+def test_parses_object_split_across_chunks():
+    chunks = ['Here is the summary: {"summ', 'ary": "a {braced} \\"quoted\\" text", ', '"references": [1, 2]}']
+    assert parse_json_stream(chunks) == {'summary': 'a {braced} "quoted" text', 'references': [1, 2]}
+
+def test_stops_reading_once_the_object_closes():
+    consumed = []
+
+    def chunks():
+        for chunk in ['{"a": 1}', ' trailing text', ' more']:
+            consumed.append(chunk)
+            yield chunk
+
+    assert parse_json_stream(chunks()) == {'a': 1}
+    assert consumed == ['{"a": 1}']
+
+def test_closes_the_stream():
+    class Stream:
+        closed = False
+
+        def __iter__(self):
+            return iter(['{"a": 1}'])
+
+        def close(self):
+            self.closed = True
+
+    stream = Stream()
+    parse_json_stream(stream)
+    assert stream.closed
+
+def test_reports_partial_values():
+    partials = []
+    result = parse_json_stream(['{"summary": "The dev', 'ice com', 'prises\\n a', '", "references": []}'], partial_key='summary', on_partial=partials.append)
+    assert partials == ['The dev', 'The device com', 'The device comprises\n a']
+    assert result['summary'] == 'The device comprises\n a'
+
+@pytest.mark.parametrize('chunks, message', [
+    (['no json here'], 'No JSON object'),
+    (['{"a": [1, 2}'], 'Unbalanced'),
+    (['{"a": 1 oops}'], 'Unexpected character'),
+    (['{"a": 1'], 'ended before'),
+    (['{"a": 1,}'], 'Invalid JSON')
+])
+def test_rejects_invalid_streams(chunks, message):
+    with pytest.raises(JSONStreamError, match=message):
+        parse_json_stream(chunks)
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip('llama_index.core')
+from patent_chunking import chunk_paragraphs, format_paragraphs, nodes_from_chunks, split_paragraphs
+
+def words(text):
+    return len(text.split())
+
+def paragraph(number, n_words):
+    return (number, ' '.join(f'w{number}_{i}' for i in range(n_words)))
+
+def test_split_paragraphs_reads_the_numbers():
+    text = '[0001] First paragraph.\n\n  \n[0002] Second\nparagraph.\n\nUnnumbered.'
+    assert split_paragraphs(text) == [('0001', 'First paragraph.'), ('0002', 'Second\nparagraph.'), (None, 'Unnumbered.')]
+
+def test_split_paragraphs_uses_aligned_numbers():
+    assert split_paragraphs('A.\n\nB.', ['0010', '0011']) == [('0010', 'A.'), ('0011', 'B.')]
+    # Misaligned numbers are ignored
+    assert split_paragraphs('A.\n\nB.', ['0010']) == [(None, 'A.'), (None, 'B.')]
+
+def test_paragraphs_are_packed_without_cutting_them():
+    chunks = chunk_paragraphs([paragraph('1', 4), paragraph('2', 4), paragraph('3', 4)], chunk_size=10, chunk_overlap=0, count=words)
+    assert [chunk['paragraphs'] for chunk in chunks] == [['1', '2'], ['3']]
+    assert chunks[0]['text'] == paragraph('1', 4)[1] + '\n\n' + paragraph('2', 4)[1]
+
+def test_overlap_repeats_whole_trailing_paragraphs():
+    chunks = chunk_paragraphs([paragraph(str(i), 3) for i in range(1, 6)], chunk_size=9, chunk_overlap=3, count=words)
+    assert [chunk['paragraphs'] for chunk in chunks] == [['1', '2', '3'], ['3', '4', '5']]
+    assert all(words(chunk['text']) <= 9 for chunk in chunks)
+
+def test_long_paragraph_is_split_on_sentences():
+    text = 'One two three. Four five six. Seven eight nine.'
+    chunks = chunk_paragraphs([('7', text)], chunk_size=6, chunk_overlap=0, count=words)
+    assert [chunk['text'] for chunk in chunks] == ['One two three. Four five six.', 'Seven eight nine.']
+    assert all(chunk['paragraphs'] == ['7'] for chunk in chunks)
+
+def test_overlong_sentence_is_split_on_words():
+    chunks = chunk_paragraphs([(None, ' '.join(str(i) for i in range(10)))], chunk_size=4, chunk_overlap=0, count=words)
+    assert [chunk['text'] for chunk in chunks] == ['0 1 2 3', '4 5 6 7', '8 9']
+    assert all(chunk['paragraphs'] == [] for chunk in chunks)
+
+def test_nodes_keep_the_paragraphs_out_of_the_embedded_text():
+    from llama_index.core.schema import MetadataMode, NodeRelationship
+
+    nodes = nodes_from_chunks([{'text': 'A.', 'paragraphs': ['0001', '0002']}, {'text': 'B.', 'paragraphs': []}], {'category': 'patent_text'})
+    assert nodes[0].metadata == {'category': 'patent_text', 'paragraphs': '[0001]-[0002]'}
+    assert nodes[0].get_content(metadata_mode=MetadataMode.EMBED) == 'A.'
+    assert '[0001]-[0002]' in nodes[0].get_content(metadata_mode=MetadataMode.LLM)
+    assert nodes[1].relationships[NodeRelationship.PREVIOUS].node_id == nodes[0].node_id
+
+@pytest.mark.parametrize('numbers, expected', [([], ''), (['0012'], '[0012]'), (['0012', '0013', '0015'], '[0012]-[0015]')])
+def test_format_paragraphs(numbers, expected):
+    assert format_paragraphs(numbers) == expected
@@ -0,0 +1,76 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+pytest.importorskip('llama_index.core')
+from portfolio_store import PortfolioStore
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def patents(results):
+    return [(result['patent_number'], result['section'], result['text']) for result in results]
+
+@pytest.fixture
+def store(tmp_path):
+    store = PortfolioStore(str(tmp_path / 'store'), n_lists=2, n_probe=1)
+    store.add('EP1', 'claims', ['rotor', 'shaft'], [unit(1, 0, 0), unit(0, 1, 0)])
+    store.add('EP2', 'claims', ['housing'], [unit(0, 0, 1)])
+    return store
+
+def test_search_returns_the_closest_chunks(store):
+    assert patents(store.search(unit(1, 0.1, 0), top_k=2)) == [('EP1', 'claims', 'rotor'), ('EP1', 'claims', 'shaft')]
+
+def test_search_filters(store):
+    assert patents(store.search(unit(1, 0, 0), top_k=3, patent_numbers=['EP2'])) == [('EP2', 'claims', 'housing')]
+    assert [p for p, _, _ in patents(store.search(unit(1, 0, 0), top_k=3, exclude_patents=['EP1']))] == ['EP2']
+    assert store.search(unit(1, 0, 0), sections=['description']) == []
+
+def test_add_replaces_the_section(store):
+    store.add('EP1', 'claims', ['blade'], [unit(1, 0, 0)])
+    assert patents(store.search(unit(1, 0, 0), top_k=5, patent_numbers=['EP1'])) == [('EP1', 'claims', 'blade')]
+
+def test_delete(store):
+    store.delete('EP1')
+    assert not store.has('EP1')
+    assert store.has('EP2', 'claims')
+    assert patents(store.search(unit(1, 0, 0), top_k=5)) == [('EP2', 'claims', 'housing')]
+
+def test_compact_keeps_the_live_chunks(store):
+    store.add('EP1', 'claims', ['blade'], [unit(1, 0, 0)])
+    before = store.search(unit(1, 0.2, 0.1), top_k=5)
+    store.compact()
+    assert patents(store.search(unit(1, 0.2, 0.1), top_k=5)) == patents(before)
+    with sqlite3.connect(store.db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0] == 2
+    assert len(store._vectors()) == 2
+
+def test_rejects_another_dimension(store):
+    with pytest.raises(ValueError, match='dimension'):
+        store.add('EP3', 'claims', ['other'], [[1.0, 0.0]])
+    assert not store.has('EP3')
+
+def test_centroids_trained_by_another_process_are_used(store):
+    other = PortfolioStore(store.path, n_lists=2, n_probe=1)
+    store.train()
+    other.add('EP3', 'claims', ['blade'], [unit(1, 0.1, 0)])
+    assert other.centroids is not None
+    with sqlite3.connect(store.db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM chunks WHERE cluster IS NULL').fetchone()[0] == 0
+    assert patents(store.search(unit(1, 0.1, 0), top_k=1)) == [('EP3', 'claims', 'blade')]
+
+SIGNATURE = {'embed_model': 'BAAI/bge-m3', 'chunk_size': 512, 'chunk_overlap': 64}
+
+def test_signature_is_recorded_and_checked(tmp_path):
+    path = str(tmp_path / 'store')
+    PortfolioStore(path, signature=SIGNATURE).add('EP1', 'claims', ['rotor'], [unit(1, 0, 0)])
+    assert PortfolioStore(path, signature=dict(SIGNATURE)).has('EP1')
+    for changed in [{'embed_model': 'BAAI/bge-small-en-v1.5'}, {'chunk_size': 256}, {'chunk_overlap': 0}]:
+        with pytest.raises(ValueError, match='was built with'):
+            PortfolioStore(path, signature=dict(SIGNATURE, **changed))
+
+def test_unsigned_store_with_chunks_is_rejected(store):
+    with pytest.raises(ValueError, match='does not record'):
+        PortfolioStore(store.path, signature=SIGNATURE)
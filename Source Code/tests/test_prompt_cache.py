@@ -0,0 +1,46 @@
+import prompt_cache
+from prompt_cache import MockAnthropic, build_system_context, stream_cached_completion
+
+SECTIONS = 'Detailed description Information:\n' + 'word ' * 2000
+CLAIM_1 = 'Claims Information:\n1. A bicycle with a frame. ' * 50
+CLAIM_2 = 'Claims Information:\n2. The bicycle of claim 1 with a bell. ' * 50
+
+def request(client, context, instructions='Summarize the claim.'):
+    return ''.join(stream_cached_completion(client, 'model', context, instructions))
+
+def test_each_part_ends_with_a_breakpoint():
+    blocks = build_system_context(['sections', 'claims'])
+    assert [block['text'] for block in blocks] == ['Patent information:\nsections', 'claims']
+    assert all(block['cache_control'] == {'type': 'ephemeral'} for block in blocks)
+
+def test_empty_parts_are_skipped():
+    assert [block['text'] for block in build_system_context(['', 'claims'])] == ['Patent information:\nclaims']
+    assert [block['text'] for block in build_system_context('context')] == ['Patent information:\ncontext']
+
+def test_other_claim_reads_the_shared_sections_from_the_cache():
+    client = MockAnthropic(['{"summary": "a"}'])
+    request(client, [SECTIONS, CLAIM_1])
+    first = client.requests[-1]['usage']
+    assert first.cache_read_input_tokens == 0 and first.cache_creation_input_tokens > 0
+
+    request(client, [SECTIONS, CLAIM_2])
+    second = client.requests[-1]['usage']
+    sections_tokens = prompt_cache._count_tokens(build_system_context([SECTIONS])[0])
+    assert second.cache_read_input_tokens == sections_tokens
+    assert second.cache_creation_input_tokens == prompt_cache._count_tokens(CLAIM_2)
+
+def test_same_context_reads_the_whole_prefix():
+    client = MockAnthropic(['{"summary": "a"}'])
+    request(client, [SECTIONS, CLAIM_1])
+    request(client, [SECTIONS, CLAIM_1], instructions='Summarize the claim with the images.')
+    usage = client.requests[-1]['usage']
+    assert usage.cache_creation_input_tokens == 0
+    assert usage.cache_read_input_tokens == client.requests[0]['usage'].cache_creation_input_tokens
+
+def test_streamed_text_and_usage():
+    client = MockAnthropic(['{"summary": "a bicycle"}'])
+    snapshot = prompt_cache.usage_snapshot()
+    assert request(client, [SECTIONS, CLAIM_1]) == '{"summary": "a bicycle"}'
+    usage = prompt_cache.usage_since(snapshot)
+    assert usage['requests'] == 1
+    assert usage['output_tokens'] == client.requests[-1]['usage'].output_tokens
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip('pyarrow')
+from results import ClaimResult, PatentResult
+from results_store import ResultsStore, metric_column, result_rows
+
+METRICS = {
+    'overall_metrics': {'Cosine similarity': 0.5, 'Ratio summary terms': 0.25},
+    'summary_of_the_invention_text': {'Cosine similarity': 0.4, 'Ratio of summary terms': 0.2, 'Max chunk similarity': 0.6},
+    'text_processing': {'Tokenizer': 'regex', 'Stop words': 'scikit-learn'}
+}
+
+def claim_result(claim_number=1, timestamp='20240901_120000', patent_number='EP1000000A1', model_llm='claude-3-5-sonnet-20240620'):
+    return ClaimResult(
+        patent_number=patent_number, claim_number=claim_number, timestamp=timestamp, summary='A summary.',
+        references={'10': 'rotor'}, metrics=METRICS, timings={'summary': 2.5, 'unknown_stage': 1.0},
+        models={'model_llm': model_llm, 'embed_model': 'BAAI/bge-m3'}
+    )
+
+def test_metric_column():
+    assert metric_column('overall_metrics', 'Ratio summary terms') == 'overall_metrics__ratio_summary_terms'
+    assert metric_column('overall_metrics', 'Ratio of summary terms') == 'overall_metrics__ratio_summary_terms'
+
+def test_result_rows_flatten_the_metrics():
+    [row] = result_rows(claim_result())
+    assert row['overall_metrics__cosine_similarity'] == 0.5
+    assert row['summary_of_the_invention_text__ratio_summary_terms'] == 0.2
+    assert row['tokenizer'] == 'regex' and row['stop_words'] == 'scikit-learn'
+    assert row['summary_s'] == 2.5
+    assert 'unknown_stage_s' not in row
+    assert row['model_llm'] == 'claude-3-5-sonnet-20240620'
+
+def test_patent_result_gives_one_row_per_claim():
+    result = PatentResult('EP1000000A1', '20240901_120000', claims={1: claim_result(1), 5: claim_result(5)})
+    assert [row['claim_number'] for row in result_rows(result)] == [1, 5]
+
+def test_append_query_and_compact(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    store.append(claim_result(1, '20240901_120000'))
+    store.append(claim_result(2, '20240901_130000', model_llm='other-llm'))
+    store.append(claim_result(3, '20240902_090000', patent_number='EP2000000A1'))
+    assert store.dates() == ['2024-09-01', '2024-09-02']
+
+    table = store.query(['claim_number'], start_date='2024-09-01', end_date='2024-09-01')
+    assert sorted(table.column('claim_number').to_pylist()) == [1, 2]
+    assert store.query(['claim_number'], patent_numbers=['EP2000000A1']).column('claim_number').to_pylist() == [3]
+    assert store.query(['claim_number'], model_llm='other-llm').column('claim_number').to_pylist() == [2]
+
+    assert store.compact() == {'2024-09-01': 2}
+    assert len(list((tmp_path / 'date=2024-09-01').glob('*.parquet'))) == 1
+    assert store.query(['claim_number', 'timestamp'], start_date='2024-09-01', end_date='2024-09-01').column('claim_number').to_pylist() == [1, 2]
+
+def test_metric_summary(tmp_path):
+    store = ResultsStore(str(tmp_path))
+    store.append(claim_result(1))
+    store.append(claim_result(2))
+    summary = store.metric_summary().to_pylist()
+    assert len(summary) == 1
+    assert summary[0]['count_all'] == 2
+    assert summary[0]['overall_metrics__cosine_similarity_mean'] == 0.5
+
+def test_query_of_an_empty_store(tmp_path):
+    assert ResultsStore(str(tmp_path / 'missing')).query().num_rows == 0
@@ -0,0 +1,71 @@
+import pytest
+
+RAG_pipeline = pytest.importorskip('RAG_pipeline')
+from llama_index.core.schema import NodeWithScore, TextNode
+from hybrid_retrieval import HybridNodeWithScore
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(RAG_pipeline, 'count_tokens', lambda text: len(text.split()))
+
+def node(text, score, dense_score=None):
+    if dense_score is None:
+        return NodeWithScore(node=TextNode(text=text), score=score)
+    return HybridNodeWithScore(node=TextNode(text=text), score=score, dense_score=dense_score)
+
+def texts(selected):
+    return {section: [n.node.get_content() for n in nodes] for section, nodes in selected.items()}
+
+def test_ranks_across_sections_by_similarity():
+    section_nodes = {
+        'background_index': [node('weak background chunk', 0.30), node('weaker background chunk', 0.20)],
+        'detailed_index': [node('strong detail chunk', 0.90), node('second detail chunk', 0.80)]
+    }
+    selected = RAG_pipeline.select_context_nodes(section_nodes, token_budget=6)
+    assert texts(selected) == {'background_index': [], 'detailed_index': ['strong detail chunk', 'second detail chunk']}
+
+def test_single_hit_section_is_not_promoted():
+    section_nodes = {
+        'field_index': [node('only field chunk', 0.10)],
+        'detailed_index': [node('strong detail chunk', 0.90)]
+    }
+    assert texts(RAG_pipeline.select_context_nodes(section_nodes, token_budget=3))['field_index'] == []
+
+def test_hybrid_nodes_rank_on_dense_similarity():
+    section_nodes = {
+        # Fused score inflated by the per-section BM25 normalization
+        'summary_index': [node('lexical match chunk', 0.95, dense_score=0.40)],
+        'similar_patents_text_index': [node('semantic match chunk', 0.70)]
+    }
+    selected = RAG_pipeline.select_context_nodes(section_nodes, token_budget=3)
+    assert texts(selected) == {'summary_index': [], 'similar_patents_text_index': ['semantic match chunk']}
+
+def test_overlapping_chunks_are_dropped():
+    text = 'one two three four five six seven eight nine ten'
+    section_nodes = {'a_index': [node(text, 0.9)], 'b_index': [node(text + ' eleven', 0.8), node('other text', 0.1)]}
+    selected = RAG_pipeline.select_context_nodes(section_nodes)
+    assert texts(selected) == {'a_index': [text], 'b_index': ['other text']}
+
+def test_no_budget_keeps_everything():
+    section_nodes = {'a_index': [node('alpha', 0.1), node('beta', 0.2)]}
+    assert texts(RAG_pipeline.select_context_nodes(section_nodes)) == {'a_index': ['beta', 'alpha']}
+
+def test_fit_dependent_claims_keeps_the_first_claims():
+    claims = ['2. The device of claim 1', '3. The device of claim 2', '4. The device of claim 3']
+    assert RAG_pipeline.fit_dependent_claims(claims, 12) == claims[:2]
+    assert RAG_pipeline.fit_dependent_claims(claims, 100) == claims
+    assert RAG_pipeline.fit_dependent_claims(claims, 0) == []
+
+@pytest.mark.parametrize('max_tokens, expected', [(10, 'a b c'), (2, 'a b'), (0, '')])
+def test_truncate_to_tokens(max_tokens, expected):
+    assert RAG_pipeline.truncate_to_tokens('a b c', max_tokens) == expected
+
+def test_hybrid_retriever_reports_the_dense_similarity(monkeypatch):
+    from llama_index.core import Settings
+    from llama_index.core.embeddings import MockEmbedding
+    from hybrid_retrieval import HybridIndex
+
+    monkeypatch.setattr(Settings, '_embed_model', MockEmbedding(embed_dim=8))
+    index = HybridIndex([TextNode(text='a rotor 12 and a shaft'), TextNode(text='the housing 14')])
+    results = index.as_retriever(similarity_top_k=2).retrieve('rotor 12')
+    assert results and all(result.dense_score == pytest.approx(1.0) for result in results)
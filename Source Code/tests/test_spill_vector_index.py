@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+RAG_pipeline = pytest.importorskip('RAG_pipeline')
+from llama_index.core import VectorStoreIndex
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import TextNode
+
+@pytest.fixture
+def index():
+    nodes = [TextNode(text=f'chunk {i} of the detailed description') for i in range(5)]
+    return VectorStoreIndex(nodes, embed_model=MockEmbedding(embed_dim=8))
+
+def test_spill_maps_the_embeddings(index, tmp_path):
+    embeddings = dict(index.vector_store.data.embedding_dict)
+    assert RAG_pipeline.spill_vector_index(index, str(tmp_path / 'detailed.npy')) == 5
+    spilled = index.vector_store.data.embedding_dict
+    assert all(isinstance(embedding, np.memmap) for embedding in spilled.values())
+    for node_id, embedding in embeddings.items():
+        np.testing.assert_allclose(spilled[node_id], embedding, rtol=1e-6)
+    assert not (tmp_path / 'detailed.npy').exists()
+
+def test_spill_keeps_the_retrieval(index, tmp_path):
+    before = [n.node.node_id for n in index.as_retriever(similarity_top_k=3).retrieve('detailed description')]
+    RAG_pipeline.spill_vector_index(index, str(tmp_path / 'detailed.npy'))
+    after = [n.node.node_id for n in index.as_retriever(similarity_top_k=3).retrieve('detailed description')]
+    assert after == before
+
+def test_spilled_embeddings_are_not_spilled_again(index, tmp_path):
+    RAG_pipeline.spill_vector_index(index, str(tmp_path / 'first.npy'))
+    assert RAG_pipeline.spill_vector_index(index, str(tmp_path / 'second.npy')) == 0
@@ -0,0 +1,100 @@
+import pytest
+
+import stage_cache
+from stage_cache import StageCache, STAGE_FIELDS
+
+BASE_ARGS = {
+    'patent_number': 'EP1000000A1',
+    'claim_number': 1,
+    'model_llm': 'claude-3-5-sonnet-20240620',
+    'temperature': 0.0,
+    'max_tokens': 1024,
+    'max_tokens_code': 4096,
+    'output_filename': './images/output.svg',
+    'svg_minify': True,
+    'svg_decimals': 1,
+    'svg_max_elements': 0,
+    'svg_max_bytes': 0,
+    'svg_thumbnail_size': 0,
+    'chunk_size': 512,
+    'chunk_overlap': 64
+}
+
+@pytest.mark.parametrize('stage, field', [(stage, field) for stage, fields in STAGE_FIELDS.items() for field in fields])
+def test_every_stage_field_changes_the_key(stage, field):
+    cache = StageCache(enabled=False)
+    changed = dict(BASE_ARGS, **{field: 'changed value'})
+    assert cache.key(stage, BASE_ARGS) != cache.key(stage, changed)
+
+@pytest.mark.parametrize('field', ['temperature', 'svg_minify', 'svg_decimals', 'svg_max_elements', 'svg_max_bytes', 'svg_thumbnail_size'])
+def test_svg_key_covers_generation_and_postprocessing(field):
+    cache = StageCache(enabled=False)
+    assert cache.key('svg', BASE_ARGS) != cache.key('svg', dict(BASE_ARGS, **{field: 'other'}))
+
+def test_unrelated_field_keeps_the_key():
+    cache = StageCache(enabled=False)
+    assert cache.key('metrics', BASE_ARGS) == cache.key('metrics', dict(BASE_ARGS, model_llm='other-model'))
+
+def test_upstream_key_invalidates_downstream(tmp_path):
+    cache = StageCache(str(tmp_path))
+    cache.run('claims', BASE_ARGS, lambda: {'claim': 'a'})
+    first = cache.key('summary', BASE_ARGS, depends_on=('claims',))
+    cache.run('claims', dict(BASE_ARGS, claim_number=2), lambda: {'claim': 'b'})
+    assert cache.key('summary', BASE_ARGS, depends_on=('claims',)) != first
+
+def test_module_source_changes_the_key(monkeypatch):
+    cache = StageCache(enabled=False)
+    before = cache.key('svg', BASE_ARGS)
+    monkeypatch.setattr(stage_cache, 'module_hash', lambda filename: 'edited')
+    assert cache.key('svg', BASE_ARGS) != before
+
+def test_run_reuses_cached_output(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'summary': 'text'}
+
+    assert StageCache(str(tmp_path)).run('summary', BASE_ARGS, compute) == {'summary': 'text'}
+    cache = StageCache(str(tmp_path))
+    assert cache.run('summary', BASE_ARGS, compute) == {'summary': 'text'}
+    assert len(calls) == 1
+    assert cache.reused() == ['summary']
+
+def test_run_skips_outputs_rejected_by_cache_if(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return None
+
+    for _ in range(2):
+        StageCache(str(tmp_path)).run('svg', BASE_ARGS, compute, cache_if=lambda value: value is not None)
+    assert len(calls) == 2
+
+def test_cached_reports_stored_outputs(tmp_path):
+    cache = StageCache(str(tmp_path))
+    cache.run('claims', BASE_ARGS, lambda: {'claim': 'a'})
+    assert not cache.cached('summary', BASE_ARGS, depends_on=('claims',))
+    cache.run('summary', BASE_ARGS, lambda: {'summary': 'text'}, depends_on=('claims',))
+    assert cache.cached('summary', BASE_ARGS, depends_on=('claims',))
+    assert not StageCache(str(tmp_path), enabled=False).cached('claims', BASE_ARGS)
+
+def test_claim_of_a_multi_claim_run_reuses_a_single_claim_run(tmp_path):
+    # main_multi_claim runs every claim with its own cache and the arguments of a single claim run
+    single = StageCache(str(tmp_path))
+    single.run('claims', BASE_ARGS, lambda: {'claim': 'a'})
+    single.run('summary', BASE_ARGS, lambda: {'summary': 'text'}, depends_on=('claims',))
+    multi_args = dict(BASE_ARGS, claim_number=[1, 2])
+    claim_cache = StageCache(str(tmp_path))
+    claim_cache.run('claims', dict(multi_args, claim_number=1), lambda: {'claim': 'other'})
+    assert claim_cache.run('summary', dict(multi_args, claim_number=1), lambda: {'summary': 'other'}, depends_on=('claims',)) == {'summary': 'text'}
+    assert claim_cache.reused() == ['claims', 'summary']
+
+def test_run_records_the_time_of_each_stage(tmp_path):
+    cache = StageCache(str(tmp_path))
+    cache.run('claims', BASE_ARGS, lambda: {'claim': 'a'})
+    cache.run('summary', BASE_ARGS, lambda: {'summary': 'text'}, depends_on=('claims',))
+    assert set(cache.timings) == {'claims', 'summary'}
+    assert all(seconds >= 0 for seconds in cache.timings.values())
+    assert StageCache(str(tmp_path)).timings == {}
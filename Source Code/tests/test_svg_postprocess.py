@@ -0,0 +1,76 @@
+import pytest
+
+from svg_postprocess import postprocess_svg, round_numbers, round_transform, SVGValidationError
+
+SVG = b'''<?xml version="1.0"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="100.123" height="50">
+  <!-- comment -->
+  <metadata>generated</metadata>
+  <rect x="10.456" y="0.04" width="20" height="20" style="fill:none;stroke:black" opacity="0.25"/>
+  <circle cx="5.55" cy="5" r="0.04" style="fill:none;stroke:black" fill-opacity="0.05"/>
+  <path d="M 10.123 20.987 L 30.5 40.04"/>
+</svg>'''
+
+@pytest.mark.parametrize('value, decimals, expected', [
+    ('10.123456', 1, '10.1'),
+    ('M 10.56 20.25 L 30 40', 1, 'M 10.6 20.2 L 30 40'),
+    ('2.0', 1, '2'),
+    ('-0.01', 0, '-0.01'),
+    ('0.04', 1, '0.04'),
+    ('0', 1, '0'),
+    ('1e-5', 2, '0.00001')
+])
+def test_round_numbers(value, decimals, expected):
+    assert round_numbers(value, decimals) == expected
+
+@pytest.mark.parametrize('value, expected', [
+    ('matrix(0.7071 0.7071 -0.7071 0.7071 10.55 10.04) scale(1.25)', 'matrix(0.7071 0.7071 -0.7071 0.7071 10.6 10) scale(1.25)'),
+    ('matrix(0.7071,0.7071,-0.7071,0.7071,10.55,10.04)', 'matrix(0.7071,0.7071,-0.7071,0.7071,10.6,10)'),
+    ('translate(10.123,20.987) rotate(33.333 5.55 5.55)', 'translate(10.1,21) rotate(33.333 5.55 5.55)'),
+    ('skewX(12.345) scale(0.75, 1.125)', 'skewX(12.345) scale(0.75, 1.125)')
+])
+def test_round_transform_only_rounds_translations(value, expected):
+    assert round_transform(value, 1) == expected
+
+def test_minify_keeps_transform_coefficients():
+    svg = postprocess_svg(b'<svg xmlns="http://www.w3.org/2000/svg"><g transform="matrix(0.7071 0.7071 -0.7071 0.7071 10 10) scale(1.25)"/></svg>')['svg']
+    assert b'transform="matrix(0.7071 0.7071 -0.7071 0.7071 10 10) scale(1.25)"' in svg
+
+def test_minify_drops_comments_and_metadata():
+    svg = postprocess_svg(SVG)['svg']
+    assert b'comment' not in svg
+    assert b'metadata' not in svg
+    assert b'\n' not in svg
+
+def test_minify_rounds_coordinates_but_not_opacities():
+    svg = postprocess_svg(SVG, decimals=1)['svg']
+    assert b'x="10.5"' in svg
+    assert b'd="M 10.1 21 L 30.5 40"' in svg
+    assert b'r="0.04"' in svg
+    assert b'opacity="0.25"' in svg
+    assert b'fill-opacity="0.05"' in svg
+
+def test_minify_merges_repeated_styles():
+    svg = postprocess_svg(SVG)['svg']
+    assert svg.count(b'fill:none;stroke:black') == 1
+    assert b'class="s0"' in svg
+
+def test_stats():
+    stats = postprocess_svg(SVG)['stats']
+    assert stats['original_bytes'] == len(SVG)
+    assert stats['bytes'] < len(SVG)
+    # Counted before minification, with the metadata
+    assert stats['elements'] == 5
+
+def test_without_minify_keeps_the_svg():
+    assert postprocess_svg(SVG, minify=False)['svg'] == SVG
+
+@pytest.mark.parametrize('svg, kwargs, message', [
+    (b'<svg', {}, 'not well-formed'),
+    (b'<html/>', {}, 'not <svg>'),
+    (SVG, {'max_elements': 3}, 'elements'),
+    (SVG, {'max_bytes': 10}, 'bytes')
+])
+def test_rejects_invalid_svgs(svg, kwargs, message):
+    with pytest.raises(SVGValidationError, match=message):
+        postprocess_svg(svg, **kwargs)
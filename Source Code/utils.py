@@ -6,40 +6,54 @@ import base64
 
 # Third-party library imports
 import numpy as np
-from pynvml import *
 
-def encode_image_array(pil_image):
+# Custom imports
+import devices
+
+def encode_image_bytes(pil_image):
     """
-    Encode a PIL Image to a base64 string.
+    Encode a PIL Image to JPEG bytes.
 
     Args:
         pil_image (PIL.Image): The input PIL Image object.
 
     Returns:
-        str: Base64 encoded string of the image.
+        bytes: JPEG encoded image.
     """
     # Save PIL Image to a byte stream
     byte_stream = io.BytesIO()
     pil_image.save(byte_stream, format='JPEG')
-    byte_stream.seek(0)
+    return byte_stream.getvalue()
+
+def encode_image_array(pil_image, image_bytes=None):
+    """
+    Encode a PIL Image to a base64 string.
+
+    Args:
+        pil_image (PIL.Image): The input PIL Image object.
+        image_bytes (bytes, optional): JPEG bytes of the image from encode_image_bytes, to avoid encoding it again.
+
+    Returns:
+        str: Base64 encoded string of the image.
+    """
+    image_bytes = image_bytes or encode_image_bytes(pil_image)
     
     # Encode to base64
-    return base64.b64encode(byte_stream.getvalue()).decode('utf-8')
+    return base64.b64encode(image_bytes).decode('utf-8')
 
 def check_gpu_is_free(min_memory):
     """
     Check if the GPU has enough free memory.
 
+    The GPU is probed once per process, see devices.probe_gpu.
+
     Args:
         min_memory (float): Minimum required free memory in GB.
 
     Returns:
-        bool: True if GPU has enough free memory, False otherwise.
+        bool: True if GPU has enough free memory, False otherwise (or without a GPU).
     """
-    nvmlInit()
-    h = nvmlDeviceGetHandleByIndex(0)
-    info = nvmlDeviceGetMemoryInfo(h)
-    return info.free * 1e-9 > min_memory  # Convert bytes to GB
+    return devices.probe_gpu() > min_memory
 
 def get_json_from_text(text):
     """
@@ -85,4 +99,184 @@ def get_code_from_text(text):
                 code_lines.append(line)
             
     # Join all captured code lines into a single code block
-    return "\n".join(code_lines)
\ No newline at end of file
+    return "\n".join(code_lines)
+
+class JSONStreamError(ValueError):
+    """
+    Raised when a streamed completion cannot contain a valid JSON object.
+    """
+
+
+# Characters that may legally appear outside of a string inside a JSON object
+_JSON_STRUCTURAL_CHARS = set('{}[]:,-+.eE0123456789truefalsn \t\r\n')
+
+def _decode_partial_json_string(raw):
+    """
+    Decode the escapes of a (possibly unterminated) JSON string body.
+
+    Args:
+        raw (str): String body without the surrounding quotes.
+
+    Returns:
+        str: Decoded text. A trailing incomplete escape sequence is dropped.
+    """
+    try:
+        return json.loads('"' + raw + '"')
+    except json.JSONDecodeError:
+        # Drop an incomplete escape at the end of the partial string
+        cut = raw.rfind('\\')
+        if cut == -1:
+            return raw
+        try:
+            return json.loads('"' + raw[:cut] + '"')
+        except json.JSONDecodeError:
+            return raw[:cut]
+
+def parse_json_stream(chunks, partial_key=None, on_partial=None):
+    """
+    Incrementally parse the first JSON object of a streamed completion.
+
+    The chunks are consumed only until the top level object closes, so the
+    remainder of the completion is never waited for. Output that cannot be a
+    JSON object (unbalanced brackets, stray tokens outside of strings or an
+    early end of stream) raises as soon as it is detected.
+
+    Args:
+        chunks (iterable): Iterable of text deltas.
+        partial_key (str, optional): Top level string field to report while streaming.
+        on_partial (callable, optional): Called with the partial value of partial_key.
+
+    Returns:
+        dict: Parsed JSON data as a Python dictionary.
+
+    Raises:
+        JSONStreamError: If the stream does not contain a valid JSON object.
+    """
+    buffer = []
+    start = None
+    stack = []
+    in_string = False
+    escape = False
+    position = 0
+    # Offset of the partial_key value in the buffer and last reported length
+    partial_start = None
+    partial_reported = 0
+    partial_pattern = re.compile(r'"' + re.escape(partial_key) + r'"\s*:\s*"') if partial_key else None
+
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            buffer.append(chunk)
+            for char in chunk:
+                index = position
+                position += 1
+                if start is None:
+                    if char == '{':
+                        start = index
+                        stack.append('}')
+                    continue
+                if in_string:
+                    if escape:
+                        escape = False
+                    elif char == '\\':
+                        escape = True
+                    elif char == '"':
+                        in_string = False
+                    continue
+                if char == '"':
+                    in_string = True
+                elif char in '{[':
+                    stack.append('}' if char == '{' else ']')
+                elif char in '}]':
+                    if stack.pop() != char:
+                        raise JSONStreamError(f"Unbalanced '{char}' in streamed JSON at position {index}")
+                    if not stack:
+                        text = ''.join(buffer)[start:index + 1]
+                        try:
+                            return json.loads(text)
+                        except json.JSONDecodeError as e:
+                            raise JSONStreamError(f"Invalid JSON in streamed completion: {e}") from e
+                elif char not in _JSON_STRUCTURAL_CHARS:
+                    raise JSONStreamError(f"Unexpected character {char!r} in streamed JSON at position {index}")
+
+            # Report the partial value of the requested field
+            if on_partial and start is not None:
+                text = ''.join(buffer)
+                if partial_start is None:
+                    match = partial_pattern.search(text, start)
+                    if match:
+                        partial_start = match.end()
+                if partial_start is not None:
+                    end = text.find('"', partial_start)
+                    while end != -1 and _is_escaped(text, end):
+                        end = text.find('"', end + 1)
+                    raw = text[partial_start:] if end == -1 else text[partial_start:end]
+                    if len(raw) > partial_reported:
+                        partial_reported = len(raw)
+                        on_partial(_decode_partial_json_string(raw))
+    finally:
+        # Stop the underlying request as soon as the object is complete
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+    if start is None:
+        raise JSONStreamError("No JSON object found in streamed completion")
+    raise JSONStreamError("Streamed completion ended before the JSON object was closed")
+
+def _is_escaped(text, index):
+    """
+    Check whether the character at index is escaped by backslashes.
+
+    Args:
+        text (str): Input text.
+        index (int): Position of the character.
+
+    Returns:
+        bool: True if preceded by an odd number of backslashes.
+    """
+    backslashes = 0
+    index -= 1
+    while index >= 0 and text[index] == '\\':
+        backslashes += 1
+        index -= 1
+    return backslashes % 2 == 1
+
+def stream_json_completion(stream_fn, partial_key=None, on_partial=None, max_retries=2):
+    """
+    Stream a completion and parse its JSON, retrying on unparseable output.
+
+    Args:
+        stream_fn (callable): Function starting a new request and returning an iterable of text deltas.
+        partial_key (str, optional): Top level string field to report while streaming.
+        on_partial (callable, optional): Called with the partial value of partial_key.
+        max_retries (int): Number of new requests to issue after an invalid response.
+
+    Returns:
+        dict: Parsed JSON data as a Python dictionary.
+
+    Raises:
+        JSONStreamError: If no valid JSON was obtained after all retries.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return parse_json_stream(stream_fn(), partial_key=partial_key, on_partial=on_partial)
+        except JSONStreamError as e:
+            if attempt == max_retries:
+                raise
+            print(f'Invalid JSON in completion ({e}), retrying. Attempt: {attempt + 1}')
+
+def stream_llm_deltas(llm, prompt):
+    """
+    Stream the text deltas of a llama-index LLM completion.
+
+    Args:
+        llm: llama-index LLM instance.
+        prompt (str): Input prompt.
+
+    Returns:
+        generator: Text deltas of the completion.
+    """
+    for response in llm.stream_complete(prompt):
+        yield response.delta or ''
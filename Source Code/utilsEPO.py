@@ -1,107 +1,39 @@
 import os
-import io
 import re
-import json
 import numpy as np
 from bs4 import BeautifulSoup
-from PIL import Image as PILImage
-
-# EPO libraries
-from epo.tipdata.epab import EPABClient
 
 # Own libs
-import utils
-
-# llama-index
-from llama_index.core.prompts import PromptTemplate
-from llama_index.core import Settings
-from llama_index.llms.anthropic import Anthropic
+import figure_index
+import claim_graph
+from patent_data import SECTIONS, PatentData, PatentImages
+import memory_budget
+import epab_fetch
 
-# Initialize EPAB Client for production environment
-epab = EPABClient(env='PROD')
-
-def extract_dependent_claims(selected_claim, claim_number, model_llm, claim_info, flag_alt, dependent_claim_exists=None):
+def get_epab_client():
     """
-    Recursively extract dependent claims for a given claim.
-    
-    Args:
-        selected_claim (str): The claim to extract dependents for.
-        claim_number (int): The number of the selected claim.
-        model_llm (str): The language model to use for extraction.
-        claim_info (list): Information about all claims.
-        flag_alt (bool): Flag to determine text cleaning method.
-        dependent_claim_exists (set, optional): Set to track processed claims.
-    
+    Get the EPAB client of the configured backend, created on first use.
+
     Returns:
-        list: List of dependent claim texts.
+        EPABClient or MockEPABClient: Production client, or the mock backend if epab_mock_dir is set.
     """
-    dependent_claim_exists = dependent_claim_exists or set()
-    dependent_claims_info = get_dependent_claims(selected_claim, claim_number, model_llm)
-    dependent_claims_text = []
+    return epab_fetch.get_client(epab_fetch.fetch_config['epab_mock_dir'] or '')
 
-    if dependent_claims_info['dependent_claims']:
-        print('Found dependent claims', dependent_claims_info["dependent_claims"])
-
-        for dependent_claim_number in dependent_claims_info['dependent_claims']:
-            if dependent_claim_number not in dependent_claim_exists:
-                dependent_claim_exists.add(dependent_claim_number)
-                
-                # Format dependent claim text based on flag_alt
-                if flag_alt:
-                    dependent_claim_text = epab.clean_text(claim_info[dependent_claim_number-1][0])
-                    dependent_claims_text.append(f'Claim {dependent_claim_number}\n{dependent_claim_text}')
-                else:
-                    dependent_claim_text = f'Claim {dependent_claim_number}\n{claim_info[dependent_claim_number-1]}'
-                dependent_claims_text.append(dependent_claim_text)
-                
-                # Recursively get nested dependent claims
-                nested_claims = extract_dependent_claims(dependent_claim_text, dependent_claim_number, model_llm, claim_info, flag_alt, dependent_claim_exists)
-                dependent_claims_text.extend(nested_claims)
-
-    return dependent_claims_text
-
-def get_dependent_claims(claim_info, claim_number, model_llm):
+def extract_dependent_claims(patent, claim_number):
     """
-    Use a language model to identify dependent claims.
+    Get the texts of the claims a claim depends on, directly or through other claims.
     
     Args:
-        claim_info (str): The claim text.
-        claim_number (int): The number of the claim.
-        model_llm (str): The language model to use.
+        patent (dict): Patent returned by fetch_patent.
+        claim_number (int): The number of the selected claim.
     
     Returns:
-        dict: Dictionary containing dependent claim numbers.
+        list: Dependent claim texts, each direct reference followed by its own references.
     """
-    # Initialize language model based on the model name
-    llm = Anthropic(model=model_llm, temperature=0.0, max_tokens=1024)
-    Settings.llm = llm
-    
-    # Define prompt template for the language model
-    prompt_template = '''You are an expert patent examiner. I want to know information about claim number {claim_number}. The claim text is the following:
-    {claim_info}
-    Are there any dependent claims? Return the number of claims I need to know for this specific claim.
-    Only return dependent claims if it is explicitly mentioned in the claim information.
-    Do not infer information.
-    Return the information as a JSON using the following template:
-    "dependent_claims":"list of integer claims"
-    Do not return any additional information or explanation.'''
-
-    input_prompt = PromptTemplate((prompt_template))
-
-    # Get response from the language model
-    summary = Settings.llm.complete(input_prompt.format(claim_number=claim_number, claim_info=claim_info))
-    response = summary.text
-
-    # Extract and parse JSON from the response
-    json_start = response.index('{')
-    json_end = response.rindex('}') + 1
-    json_str = response[json_start:json_end]
-    data_dict = json.loads(json_str)
-
-    # Filter out invalid dependent claims
-    data_dict['dependent_claims'] = [num for num in data_dict['dependent_claims'] if num < claim_number]
-
-    return data_dict
+    dependent_claim_numbers = patent['claim_graph'].ancestors(claim_number)
+    if dependent_claim_numbers:
+        print('Found dependent claims', dependent_claim_numbers)
+    return [f'Claim {dependent_claim_number}\n{get_claim_text(patent, dependent_claim_number)}' for dependent_claim_number in dependent_claim_numbers]
 
 def count_claims(input_text):
     """
@@ -167,15 +99,18 @@ def get_n_claim(input_text, number_of_claims):
 
     return claim_info
 
-def get_patent_info_from_description(query):
+def get_patent_info_from_description(query, with_paragraph_numbers=False):
     """
     Extract patent information from the description.
     
     Args:
         query (list): List containing patent information.
+        with_paragraph_numbers (bool): Whether to also return the paragraph numbers of each section.
     
     Returns:
-        dict: Dictionary of patent information sections.
+        dict: Dictionary of patent information sections, their paragraphs separated by blank lines.
+        With with_paragraph_numbers, a tuple of this dictionary and the paragraph numbers
+        (None where the description has none) of each section.
     """
     # Input validation
     if not query or not isinstance(query, list) or len(query) == 0:
@@ -211,52 +146,182 @@ def get_patent_info_from_description(query):
         "description of embodiments",
     ]
     
-    patent_dict = {heading: "" for heading in headings_patent}
+    patent_paragraphs = {heading: [] for heading in headings_patent}
     current_heading = None
     detailed_description_found = False
 
-    # Extract content for each heading
+    # Extract the paragraphs and their numbers (<p num="0012">) for each heading
     for element in elements:
         text = element.text.strip()
         if text.strip().lower() in headings_patent:
             current_heading = text.strip().lower()
             if current_heading.lower() in ["detailed description of the embodiments", "description of embodiments"]:
                 detailed_description_found = True
-        elif current_heading:
+        elif current_heading and text:
             if detailed_description_found or current_heading not in ["detailed description of the embodiments", "description of embodiments"]:
-                patent_dict[current_heading] += f"{text}"
+                patent_paragraphs[current_heading].append((element.get('num'), text))
 
-    # Clean up the extracted content
-    for heading in patent_dict:
-        patent_dict[heading] = patent_dict[heading].strip()
+    # The parse tree is several times larger than the HTML, free it before the sections are joined
+    soup.decompose()
+    del soup, elements
 
-    patent_dict = {k: v if v else None for k, v in patent_dict.items()}
+    # Paragraphs are separated by blank lines so the node parser can chunk on them
+    patent_dict = {heading: "\n\n".join(text for _, text in paragraphs) or None for heading, paragraphs in patent_paragraphs.items()}
+    if with_paragraph_numbers:
+        paragraph_numbers = {heading: [number for number, _ in paragraphs] for heading, paragraphs in patent_paragraphs.items() if paragraphs}
+        return patent_dict, paragraph_numbers
     return patent_dict
 
-def get_data_from_patent(**kwargs):
+def fetch_patent(patent_number, retrieve_patent_images=False, extract_sheet_labels=True):
     """
-    Retrieve and process patent data based on provided parameters.
+    Retrieve and parse the claims, description and drawings of a patent once.
+    
+    The result holds everything that does not depend on the selected claim, so
+    it can be shared between several calls of get_claim_data.
     
     Args:
-        **kwargs: Input parameters for data retrieval and processing.
+        patent_number (str): Publication number of the patent.
+        retrieve_patent_images (bool): Whether to retrieve the drawings.
+        extract_sheet_labels (bool): Whether to read the figure captions and numerals of the drawings.
+    
+    Returns:
+        dict: Parsed claims, description sections and images of the patent.
+    """
+    patent = {
+        'patent_number': patent_number,
+        'claim_info': None,
+        'flag_alt': False,
+        'number_of_claims': 0,
+        'patent_desc_info': None,
+        'paragraph_numbers': None,
+        'claim_graph': None,
+        'reference_index': None,
+        'sheet_labels': None,
+        'images': None
+    }
+
+    # Retrieve patent data
+    print('Patent number:', patent_number)
+    # Claims, description and drawings are requested at the same time, or were prefetched
+    fetched = epab_fetch.get_fetcher().fetch(patent_number, drawings=retrieve_patent_images)
+    query_claims_description = fetched.claims_description()
+    patent['patent_desc_info'], patent['paragraph_numbers'] = get_patent_info_from_description(query_claims_description, with_paragraph_numbers=True)
+    desc_info = patent['patent_desc_info']
+
+    # Link the reference numerals of the description to the figures showing them
+    patent['reference_index'] = figure_index.build_reference_index(
+        desc_info['brief description of the drawings'] or desc_info['brief description of drawings'],
+        desc_info['detailed description of the embodiments'] or desc_info['description of embodiments']
+    )
+
+    # Process claim information
+    claim_text = query_claims_description[0]['claims'][0]['text']
+    # Only the parsed sections and claims are kept, not the raw HTML
+    del query_claims_description
+    if memory_budget.enabled():
+        memory_budget.release()
+    number_of_claims = count_claims(claim_text)
+
+    if number_of_claims == 0:
+        # Handle alternative claim structure
+        patent['claim_info'] = get_n_claim_alt(claim_text)
+        patent['number_of_claims'] = len(patent['claim_info'])
+    else:
+        # Handle standard claim structure
+        patent['claim_info'] = get_n_claim(claim_text, number_of_claims=number_of_claims)
+        patent['number_of_claims'] = number_of_claims
+        patent['flag_alt'] = True
+
+    # Dependencies between the claims, built once per patent and persisted
+    patent['claim_graph'] = claim_graph.get_claim_graph(
+        patent_number,
+        {claim_number: get_claim_text(patent, claim_number) for claim_number in get_claim_numbers(patent)}
+    )
+
+    # Retrieve and process patent images if requested
+    if retrieve_patent_images:
+        attachments = fetched.attachments()
+        number_images = len(attachments)
+        
+        if number_images < 1:
+            print('No attachments were found')
+        else:        
+            print('Found', number_images, 'images')
+            # Sheets are decoded and encoded on first use, shared by every claim
+            patent['images'] = PatentImages(attachments)
+
+            # Figures and numerals printed on each sheet, cached by attachment hash
+            if extract_sheet_labels:
+                import sheet_labels
+                patent['sheet_labels'] = sheet_labels.get_sheet_labels(patent['images'])
+
+    return patent
+
+def get_claim_text(patent, claim_number):
+    """
+    Get the text of a claim from a fetched patent.
+    
+    Args:
+        patent (dict): Patent returned by fetch_patent.
+        claim_number (int): The number of the claim.
     
     Returns:
-        dict: Processed patent data including claims, descriptions, and images.
+        str: The claim text.
+    """
+    if claim_number > patent['number_of_claims']:
+        raise ValueError(f"Claim number not available, the number of claims for this patent is: {patent['number_of_claims']}")
+    if patent['flag_alt']:
+        return get_epab_client().clean_text(patent['claim_info'][claim_number-1][0])
+    return patent['claim_info'][claim_number]
+
+def get_claim_numbers(patent):
     """
-    # Extract parameters from kwargs
-    search_number = kwargs.get('patent_number', False)
-    claim_number = kwargs.get('claim_number')
-    dependent_claims = kwargs.get('dependent_claims')
-    field_of_invention = kwargs.get('field_of_invention', False)
-    background_of_the_invention = kwargs.get('background_of_the_invention', False)
-    summary_of_the_invention = kwargs.get('summary_of_the_invention', False)
-    brief_description_of_the_drawings = kwargs.get('brief_description_of_the_drawings', False)
-    detailed_description_of_the_embodiments = kwargs.get('detailed_description_of_the_embodiments', False)
-    retrieve_patent_images = kwargs.get('retrieve_patent_images', False)
-    model_llm = kwargs.get('model_llm')
+    List the claim numbers of a patent.
     
+    Args:
+        patent (dict): Patent returned by fetch_patent.
+    
+    Returns:
+        range: Claim numbers, following the indexing of get_claim_text for both claim structures.
+    """
+    if patent['flag_alt']:
+        return range(1, patent['number_of_claims'] + 1)
+    return range(1, patent['number_of_claims'])
+
+def get_independent_claims(patent):
+    """
+    Find the independent claims of a patent, i.e. claims not referring to another claim.
+    
+    Args:
+        patent (dict): Patent returned by fetch_patent.
+    
+    Returns:
+        list: Numbers of the independent claims, the roots of the claim graph.
+    """
+    return list(patent['claim_graph'].roots)
+
+def get_claim_data(patent, claim_number, dependent_claims=False, field_of_invention=False,
+                   background_of_the_invention=False, summary_of_the_invention=False,
+                   brief_description_of_the_drawings=False, detailed_description_of_the_embodiments=False):
+    """
+    Build the data of a single claim from a fetched patent.
+    
+    Args:
+        patent (dict): Patent returned by fetch_patent.
+        claim_number (int): The number of the selected claim.
+        dependent_claims (bool): Whether to extract the dependent claims.
+        field_of_invention, background_of_the_invention, summary_of_the_invention,
+        brief_description_of_the_drawings, detailed_description_of_the_embodiments (bool):
+            Patent description sections to include.
+    
+    Returns:
+        PatentData: Processed patent data including claims, descriptions, and images.
+    """
+    patent_desc_info = patent['patent_desc_info']
+
     # Initialize output data structure
     output_data = {
+        'patent_number': patent['patent_number'],
         'claim_text': None,
         'dependent_claims_text': None,
         'field_of_invention_text': None,
@@ -264,39 +329,15 @@ def get_data_from_patent(**kwargs):
         'summary_of_the_invention_text': None,
         'brief_description_of_the_drawings_text': None,
         'detailed_description_of_the_embodiments_text': None,
-        'pil_image': None,
-        'encoded_image': None
+        'images': patent['images'],
+        'reference_index': patent['reference_index'],
+        'sheet_labels': patent['sheet_labels']
     }
 
-    # Retrieve patent data
-    print('Patent number:', search_number)
-    q = epab.query_epab_doc_id(search_number)
-    query_claims_description = q.get_results('claims, description', output_type='list')
-    patent_desc_info = get_patent_info_from_description(query_claims_description)
-
-    # Process claim information
-    claim_text = query_claims_description[0]['claims'][0]['text']    
-    number_of_claims = count_claims(claim_text)
+    selected_claim = get_claim_text(patent, claim_number)
     dependent_claims_text = []
-
-    if number_of_claims == 0:
-        # Handle alternative claim structure
-        claim_info = get_n_claim_alt(claim_text)
-        if claim_number > len(claim_info):
-            raise ValueError(f'Claim number not available, the number of claims for this patent is: {len(claim_info)}')
-        selected_claim = claim_info[claim_number]
-        if dependent_claims:
-            dependent_claims_text = extract_dependent_claims(selected_claim, claim_number, model_llm, claim_info, False)
-    elif number_of_claims != 0:
-        # Handle standard claim structure
-        if claim_number > number_of_claims:
-            raise ValueError(f'Claim number not available, the number of claims for this patent is: {number_of_claims}')
-        claim_info = get_n_claim(claim_text, number_of_claims=number_of_claims)
-        selected_claim = epab.clean_text(claim_info[claim_number-1][0])
-        if dependent_claims:
-            dependent_claims_text = extract_dependent_claims(selected_claim, claim_number, model_llm, claim_info, True, None)
-    else:
-        raise ValueError("Could not read Claim information. Is the HTML in a correct format?")
+    if dependent_claims:
+        dependent_claims_text = extract_dependent_claims(patent, claim_number)
 
     # Populate output data
     output_data['claim_text'] = selected_claim
@@ -339,23 +380,40 @@ def get_data_from_patent(**kwargs):
         elif patent_desc_info['description of embodiments']:
             output_data['detailed_description_of_the_embodiments_text'] = patent_desc_info['description of embodiments']
 
-    # Retrieve and process patent images if requested
-    if retrieve_patent_images:
-        result = q.get_drawings(output_type="dataframe")
-        number_images = len(result["attachment"][0])
-        
-        if number_images < 1:
-            print('No attachments were found')
-        else:        
-            print('Found', number_images, 'images')
-            output_data['pil_image'] = [None] * number_images
-            output_data['encoded_image'] = [None] * number_images
-    
-            for idx, image in enumerate(result["attachment"][0]):
-                image_bytes = io.BytesIO(result["attachment"][0][idx]['content'])
-                pil_image = PILImage.open(image_bytes)
-                encoded_image = utils.encode_image_array(pil_image)
-                output_data['encoded_image'][idx] = encoded_image
-                output_data['pil_image'][idx] = pil_image
+    # Paragraph numbers of the selected sections, found by the heading each text was taken from
+    paragraph_numbers = patent.get('paragraph_numbers') or {}
+    output_data['paragraph_numbers'] = {
+        section: paragraph_numbers[heading]
+        for section in SECTIONS
+        for heading in paragraph_numbers
+        if output_data[section] is not None and patent_desc_info.get(heading) is output_data[section]
+    } or None
+
+    return PatentData(claim_number=claim_number, **output_data)
 
-    return output_data
\ No newline at end of file
+def get_data_from_patent(**kwargs):
+    """
+    Retrieve and process patent data based on provided parameters.
+    
+    Args:
+        **kwargs: Input parameters for data retrieval and processing.
+    
+    Returns:
+        PatentData: Processed patent data including claims, descriptions, and images.
+    """
+    patent = fetch_patent(
+        kwargs.get('patent_number', False),
+        kwargs.get('retrieve_patent_images', False),
+        kwargs.get('figure_label_extraction', True)
+    )
+
+    return get_claim_data(
+        patent,
+        kwargs.get('claim_number'),
+        dependent_claims=kwargs.get('dependent_claims'),
+        field_of_invention=kwargs.get('field_of_invention', False),
+        background_of_the_invention=kwargs.get('background_of_the_invention', False),
+        summary_of_the_invention=kwargs.get('summary_of_the_invention', False),
+        brief_description_of_the_drawings=kwargs.get('brief_description_of_the_drawings', False),
+        detailed_description_of_the_embodiments=kwargs.get('detailed_description_of_the_embodiments', False)
+    )
@@ -1,14 +1,73 @@
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+import re
+from collections import Counter
+from functools import lru_cache
+from scipy.sparse import csr_matrix, vstack
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer, TfidfTransformer, ENGLISH_STOP_WORDS
 from sklearn.metrics.pairwise import cosine_similarity
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterator, List
 
-# Download required NLTK data
-nltk.download('punkt', quiet=True)
-nltk.download('stopwords', quiet=True)
-nltk.download('punkt_tab', quiet=True)
+import memory_budget
+from patent_data import SECTIONS, PatentData
+from patent_chunking import DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+
+# NLTK data used by the metrics, install with: python -m nltk.downloader punkt_tab stopwords
+NLTK_RESOURCES = {
+    'punkt_tab': 'tokenizers/punkt_tab/english/',
+    'stopwords': 'corpora/stopwords'
+}
+
+@lru_cache(maxsize=1)
+def load_nltk() -> tuple:
+    """
+    Load the NLTK tokenizer and stop words from the local NLTK data, without downloading.
+
+    Missing resources fall back to a regex tokenizer and the scikit-learn stop
+    words. The metrics depend on them, so the ones used are reported with the
+    metrics under 'text_processing'.
+
+    Returns:
+        tuple: Tokenize function, set of stop words and the names of the tokenizer and stop words used.
+    """
+    import nltk
+
+    missing = []
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(name)
+    if missing:
+        print(f"NLTK data not found: {', '.join(missing)}. Install it with: python -m nltk.downloader {' '.join(missing)}")
+
+    if 'punkt_tab' in missing:
+        tokenize = lambda text: re.findall(r'\w+|[^\w\s]', text)
+    else:
+        from nltk.tokenize import word_tokenize as tokenize
+
+    if 'stopwords' in missing:
+        stop_words = set(ENGLISH_STOP_WORDS)
+    else:
+        from nltk.corpus import stopwords
+        stop_words = set(stopwords.words('english'))
+
+    text_processing = {
+        'Tokenizer': 'regex' if 'punkt_tab' in missing else 'nltk',
+        'Stop words': 'scikit-learn' if 'stopwords' in missing else 'nltk'
+    }
+    return tokenize, stop_words, text_processing
+
+def word_tokenize(text: str) -> List[str]:
+    """
+    Tokenize a text with the NLTK tokenizer, or the fallback tokenizer without NLTK data.
+
+    Args:
+        text (str): Input text.
+
+    Returns:
+        List[str]: Tokens.
+    """
+    tokenize, _, _ = load_nltk()
+    return tokenize(text)
 
 def preprocess_text(text: str) -> str:
     """
@@ -21,87 +80,127 @@ def preprocess_text(text: str) -> str:
     Returns:
         str: Preprocessed text.
     """
+    _, stop_words, _ = load_nltk()
     tokens = word_tokenize(text.lower())
-    stop_words = set(stopwords.words('english'))
     return ' '.join([word for word in tokens if word.isalnum() and word not in stop_words])
 
-def generate_patent_info_string(data_patent: Dict[str, Any]) -> str:
+def generate_patent_info_string(data_patent: PatentData) -> str:
     """
     Generate a single string containing all relevant patent information.
 
     Args:
-        data_patent (Dict[str, Any]): Dictionary containing patent data.
+        data_patent (PatentData): Patent data of the claim.
 
     Returns:
-        str: Concatenated string of patent information.
+        str: Dependent claims and patent sections, concatenated once per claim.
     """
-    info_parts = []
-    
-    # Add dependent claims if available
-    if data_patent.get('dependent_claims_text'):
-        info_parts.append(' '.join(data_patent['dependent_claims_text']))
-    
-    # Add other patent sections if available
-    for key in ['field_of_invention_text', 'background_of_the_invention_text',
-                'summary_of_the_invention_text', 'brief_description_of_the_drawings_text',
-                'detailed_description_of_the_embodiments_text']:
-        if data_patent.get(key):
-            info_parts.append(data_patent[key])
-    
-    return " ".join(info_parts)
+    return data_patent.info_text
+
+def iter_paragraphs(text: str) -> Iterator[str]:
+    """
+    Iterate over the paragraphs of a section without splitting it into a list.
 
-def check_patent_info(data_patent: Dict[str, Any]) -> bool:
+    Args:
+        text (str): Section text, paragraphs separated by blank lines.
+
+    Yields:
+        str: Paragraph.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find('\n\n', start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 2
+
+def stream_patent_info_tfidf(data_patent: PatentData, claim_processed: str, summary_processed: str) -> tuple:
+    """
+    Compute the TF-IDF vectors of the claim, the summary and the patent information paragraph by paragraph.
+
+    Gives the same vectors as vectorizing the concatenated patent information,
+    but only one paragraph is preprocessed at a time and the concatenation is
+    never built. The term counts of each part are kept instead.
+
+    Args:
+        data_patent (PatentData): Patent data of the claim.
+        claim_processed (str): Preprocessed claim.
+        summary_processed (str): Preprocessed summary.
+
+    Returns:
+        tuple: TF-IDF matrix of the claim, summary and patent information, the vectorize
+        function of preprocessed texts, the patent information terms and the
+        (part name, TF-IDF vector, terms) of each part.
+    """
+    analyze = CountVectorizer().build_analyzer()
+
+    parts = {}
+    if data_patent.dependent_claims_text:
+        parts['dependent_claims_text'] = data_patent.dependent_claims_text
+    for section, text in data_patent.sections().items():
+        parts[section] = iter_paragraphs(text)
+
+    part_counts = {}
+    for name, paragraphs in parts.items():
+        counts, terms = Counter(), set()
+        for paragraph in paragraphs:
+            paragraph_processed = preprocess_text(paragraph)
+            counts.update(analyze(paragraph_processed))
+            terms.update(word_tokenize(paragraph_processed))
+        part_counts[name] = (counts, terms)
+
+    info_counts = sum((counts for counts, _ in part_counts.values()), Counter())
+    patent_terms = set().union(*(terms for _, terms in part_counts.values()))
+
+    vocabulary_terms = sorted(set(analyze(claim_processed)) | set(analyze(summary_processed)) | set(info_counts))
+    vocabulary = {term: idx for idx, term in enumerate(vocabulary_terms)}
+    vectorizer = CountVectorizer(vocabulary=vocabulary)
+
+    def counts_row(counts: Counter) -> csr_matrix:
+        indices = [vocabulary[term] for term in counts]
+        return csr_matrix((list(counts.values()), ([0] * len(indices), indices)), shape=(1, len(vocabulary)))
+
+    transformer = TfidfTransformer()
+    tfidf_matrix = transformer.fit_transform(vstack([vectorizer.transform([claim_processed, summary_processed]), counts_row(info_counts)]))
+    vectorize = lambda texts: transformer.transform(vectorizer.transform(texts))
+    flag_parts = [(name, transformer.transform(counts_row(counts)), terms) for name, (counts, terms) in part_counts.items()]
+    return tfidf_matrix, vectorize, patent_terms, flag_parts
+
+def check_patent_info(data_patent: PatentData) -> bool:
     """
     Check if any relevant patent information is present in the data.
 
     Args:
-        data_patent (Dict[str, Any]): Dictionary containing patent data.
+        data_patent (PatentData): Patent data of the claim.
 
     Returns:
         bool: True if any relevant information is present, False otherwise.
     """
-    patent_info_flags = [
-        'field_of_invention_text',
-        'background_of_the_invention_text',
-        'summary_of_the_invention_text',
-        'brief_description_of_the_drawings_text',
-        'detailed_description_of_the_embodiments_text'
-    ]
-    
-    # Check if any main flags are present
-    main_flags_present = any(data_patent[flag] for flag in patent_info_flags)
-    
-    # Check if dependent claims are present
-    dependent_claims = data_patent['dependent_claims_text']
-    dependent_claims_present = dependent_claims is not None and len(dependent_claims) > 0
-    
-    return main_flags_present or dependent_claims_present
+    return data_patent.has_patent_info
 
-def evaluate_patent_claim_summary(data_patent: Dict[str, Any], summary: str) -> Dict[str, Any]:
+def evaluate_patent_claim_summary(data_patent: PatentData, summary: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> Dict[str, Any]:
     """
     Evaluate the quality of a patent claim summary by comparing it to the original claim and patent information.
 
+    Each description section is also compared chunk by chunk, with the chunks
+    retrieved by the RAG pipeline, to find the passage the summary is closest to.
+    Under a memory budget the patent information is vectorized paragraph by
+    paragraph instead of as one concatenated string.
+
     Args:
-        data_patent (Dict[str, Any]): Dictionary containing patent data.
+        data_patent (PatentData): Patent data of the claim.
         summary (str): Summary of the patent claim.
+        chunk_size (int): Maximum number of tokens of a section chunk, as used for retrieval.
+        chunk_overlap (int): Maximum number of tokens repeated from the previous chunk, as used for retrieval.
 
     Returns:
-        Dict[str, Any]: Dictionary containing evaluation metrics.
+        Dict[str, Any]: Dictionary containing evaluation metrics, and the tokenizer and stop words used under 'text_processing'.
     """
-    patent_info_flags = [
-        'dependent_claims_text',
-        'field_of_invention_text',
-        'background_of_the_invention_text',
-        'summary_of_the_invention_text',
-        'brief_description_of_the_drawings_text',
-        'detailed_description_of_the_embodiments_text'
-    ]
-
     # Check if patent information is present
     patent_info_present = check_patent_info(data_patent)
 
     # Extract claim text
-    claim = data_patent['claim_text']
+    claim = data_patent.claim_text
     
     # Preprocess texts
     claim_processed = preprocess_text(claim)
@@ -133,9 +232,12 @@ def evaluate_patent_claim_summary(data_patent: Dict[str, Any], summary: str) ->
         "Cosine similarity": round(float(claim_summary_similarity),4),
         "Ratio summary terms": technical_term_retention,
     }
+    results["text_processing"] = dict(load_nltk()[2])
 
     # Process additional patent info if present
-    if patent_info_present:
+    if patent_info_present and memory_budget.enabled():
+        tfidf_matrix, vectorize, patent_terms, flag_parts = stream_patent_info_tfidf(data_patent, claim_processed, summary_processed)
+    elif patent_info_present:
         patent_info = generate_patent_info_string(data_patent)
         patent_info_processed = preprocess_text(patent_info)
         texts_to_vectorize.append(patent_info_processed)
@@ -143,7 +245,13 @@ def evaluate_patent_claim_summary(data_patent: Dict[str, Any], summary: str) ->
 
         # Recalculate TF-IDF matrix with patent info
         tfidf_matrix = tfidf.fit_transform(texts_to_vectorize)
+        vectorize = tfidf.transform
+
+        # Individual patent info flags, sliced from the concatenated view
+        flag_texts = ((flag, preprocess_text(data_patent.part_text(flag))) for flag in data_patent.char_offsets if data_patent.part_text(flag))
+        flag_parts = ((flag, tfidf.transform([flag_processed]), set(word_tokenize(flag_processed))) for flag, flag_processed in flag_texts)
 
+    if patent_info_present:
         # Calculate additional metrics
         summary_patent_info_similarity = cosine_similarity(tfidf_matrix[1:2], tfidf_matrix[2:3])[0][0]
         patent_info_incorporation = len(summary_terms.intersection(patent_terms)) / len(patent_terms)
@@ -155,23 +263,22 @@ def evaluate_patent_claim_summary(data_patent: Dict[str, Any], summary: str) ->
         })
 
         # Process individual patent info flags
-        for flag in patent_info_flags:
-            flag_text = data_patent.get(flag)
-            if flag_text:
-                flag_text = ' '.join(flag_text) if isinstance(flag_text, list) else flag_text
-                flag_processed = preprocess_text(flag_text)
-                
-                # Calculate cosine similarity
-                flag_tfidf = tfidf.transform([flag_processed])
-                cosine_sim = cosine_similarity(tfidf_matrix[1:2], flag_tfidf)[0][0]
-                
-                # Calculate ratio of summary terms
-                flag_terms = set(word_tokenize(flag_processed))
-                term_ratio = len(summary_terms.intersection(flag_terms)) / len(flag_terms) if flag_terms else 0
-                
-                results[flag] = {
-                    "Cosine similarity": round(float(cosine_sim),4),
-                    "Ratio of summary terms": term_ratio
-                }
+        for flag, flag_tfidf, flag_terms in flag_parts:
+            # Calculate cosine similarity
+            cosine_sim = cosine_similarity(tfidf_matrix[1:2], flag_tfidf)[0][0]
+
+            # Calculate ratio of summary terms
+            term_ratio = len(summary_terms.intersection(flag_terms)) / len(flag_terms) if flag_terms else 0
+
+            results[flag] = {
+                "Cosine similarity": round(float(cosine_sim),4),
+                "Ratio of summary terms": term_ratio
+            }
+
+            # Closest chunk of the section to the summary
+            if flag in SECTIONS:
+                chunks = data_patent.chunks(flag, chunk_size, chunk_overlap)
+                chunk_tfidf = vectorize([preprocess_text(chunk['text']) for chunk in chunks])
+                results[flag]["Max chunk similarity"] = round(float(cosine_similarity(tfidf_matrix[1:2], chunk_tfidf).max()), 4)
 
     return results
\ No newline at end of file